@@ -8,13 +8,19 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'StudyBud.settings.dev')
 
 django_asgi_app = get_asgi_application()
 
+from django.conf import settings
+from base.middleware import JWTAuthMiddleware
 from base.routing import websocket_urlpatterns
 
+if settings.WARMUP_ON_STARTUP:
+    from base.warmup import warm_up
+    warm_up()
+
 application = ProtocolTypeRouter({
     "http": django_asgi_app,
     "websocket": AllowedHostsOriginValidator(
         AuthMiddlewareStack(
-            URLRouter(websocket_urlpatterns)
+            JWTAuthMiddleware(URLRouter(websocket_urlpatterns))
         )
     ),
 })
@@ -74,6 +74,8 @@ AUTH_USER_MODEL ='base.User'
 
 
 MIDDLEWARE = [
+    'base.middleware.RequestIdMiddleware',
+    'base.middleware.RequestInstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -108,6 +110,17 @@ TEMPLATES = [
 WSGI_APPLICATION = 'StudyBud.wsgi.application'
 ASGI_APPLICATION = 'StudyBud.asgi.application'
 
+# Cache for user records and throttle counters. The default keeps one copy per
+# process; point CACHE_BACKEND/CACHE_LOCATION at a shared store (e.g.
+# django.core.cache.backends.redis.RedisCache and redis://...) when running
+# several workers
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('CACHE_LOCATION', ''),
+    },
+}
+
 # Channel Layers (In-Memory for development)
 CHANNEL_LAYERS = {
     'default': {
@@ -126,6 +139,22 @@ DATABASES = {
     }
 }
 
+# Optional: spread messages over MESSAGE_SHARDS SQLite files by room (see
+# base/sharding.py). Shrinking N? Keep MESSAGE_SHARD_DATABASES at the old N
+# until `rebalance_message_shards` has drained the retired shards.
+MESSAGE_SHARDS = int(os.getenv('MESSAGE_SHARDS', '0'))
+MESSAGE_SHARD_DATABASES = max(MESSAGE_SHARDS, int(os.getenv('MESSAGE_SHARD_DATABASES', '0')))
+for _shard in range(MESSAGE_SHARD_DATABASES):
+    DATABASES[f'messages_{_shard}'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / f'db.messages_{_shard}.sqlite3',
+        # Inserts read the room's last seq first; taking the write lock up
+        # front makes concurrent writers queue instead of failing as locked
+        'OPTIONS': {'transaction_mode': 'IMMEDIATE', 'timeout': 20},
+    }
+if MESSAGE_SHARD_DATABASES:
+    DATABASE_ROUTERS = ['base.sharding.MessageShardRouter']
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -264,6 +293,12 @@ SPECTACULAR_SETTINGS = {
     'SCHEMA_PATH_PREFIX': r'/api/v1',
 }
 
+# /api/v1/schema/ is generated once per code version (see base/api/schema.py).
+# Set CODE_VERSION to the release's git SHA; unset, the source tree is hashed at startup.
+API_SCHEMA_VERSION = os.getenv('CODE_VERSION', '')
+API_SCHEMA_CACHE_DIR = os.getenv('API_SCHEMA_CACHE_DIR', os.path.join(BASE_DIR, 'cache', 'schema'))
+API_SCHEMA_CACHE_MAX_AGE = 86400
+
 # ==============================================================================
 # DJANGO ALLAUTH (OAuth2)
 # ==============================================================================
@@ -331,10 +366,151 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 FILE_UPLOAD_MAX_MEMORY_SIZE = 5242880  # 5MB
 DATA_UPLOAD_MAX_MEMORY_SIZE = 5242880  # 5MB
 
+# Avatar processing (see base/avatars.py)
+AVATAR_MAX_UPLOAD_SIZE = 5242880  # 5MB
+AVATAR_MAX_PIXELS = 40_000_000
+AVATAR_VARIANT_SIZES = (32, 64, 128)
+AVATAR_VARIANT_FORMATS = ('webp', 'png')
+AVATAR_PROCESSING_WORKERS = 2
+
+# ==============================================================================
+# ACTIVITY FEED
+# ==============================================================================
+
+# Rooms with more members than this are merged into feeds at read time
+FEED_FANOUT_MAX_RECIPIENTS = 1000
+FEED_MAX_LENGTH = 500
+FEED_TRIM_INTERVAL = 50
+FEED_PAGE_SIZE = 20
+FEED_MAX_PAGE_SIZE = 100
+
+# ==============================================================================
+# USERS
+# ==============================================================================
+
+# Serialized users cached for /api/v1/users/ and room detail (see base/users.py).
+# With the default per-process cache, other processes may show a user's old
+# name or avatar for up to this long after an edit
+USER_CACHE_TIMEOUT = int(os.getenv('USER_CACHE_TIMEOUT', '60'))
+USER_LOOKUP_MAX_IDS = 100
+
+# ==============================================================================
+# ROOMS
+# ==============================================================================
+
+# Members embedded in room list/detail responses; the rest are paged from
+# /api/v1/rooms/<id>/participants/
+ROOM_PARTICIPANT_PREVIEW_SIZE = 5
+
+# ==============================================================================
+# TOPIC AUTOCOMPLETE
+# ==============================================================================
+
+# In-memory prefix index (see base/topic_index.py), rebuilt from the database
+# after this many seconds to pick up writes from other processes
+TOPIC_INDEX_MAX_AGE = int(os.getenv('TOPIC_INDEX_MAX_AGE', '300'))
+TOPIC_AUTOCOMPLETE_LIMIT = 10
+TOPIC_AUTOCOMPLETE_MAX_LIMIT = 50
+
+# ==============================================================================
+# WORKER WARM-UP
+# ==============================================================================
+
+# Compile URLs, build serializers and connect to the database before serving
+# (see base/warmup.py). Pair with CONN_MAX_AGE so the warmed connection is reused.
+WARMUP_ON_STARTUP = os.getenv('WARMUP_ON_STARTUP', 'False') == 'True'
+
+# ==============================================================================
+# BATCH REQUESTS
+# ==============================================================================
+
+# POST /api/v1/batch/: sub-requests per batch and threads for concurrent GETs
+BATCH_MAX_REQUESTS = 20
+BATCH_MAX_WORKERS = 4
+
+# ==============================================================================
+# WEBSOCKET LIMITS
+# ==============================================================================
+
+# Checked on every inbound chat frame (see base/ratelimit.py). Frames over
+# WS_MAX_FRAME_BYTES are rejected before parsing; rates are events per second
+# with bursts up to the matching *_BURST, per connection and per user.
+WS_MAX_FRAME_BYTES = int(os.getenv('WS_MAX_FRAME_BYTES', '8192'))
+WS_MAX_MESSAGE_LENGTH = 2000
+WS_CONNECTION_RATE = float(os.getenv('WS_CONNECTION_RATE', '5'))
+WS_CONNECTION_BURST = int(os.getenv('WS_CONNECTION_BURST', '20'))
+WS_USER_RATE = float(os.getenv('WS_USER_RATE', '10'))
+WS_USER_BURST = int(os.getenv('WS_USER_BURST', '40'))
+# What happens to a rejected frame: 'drop' it silently, 'warn' the client with
+# an error event, or 'close' the socket with WS_LIMIT_CLOSE_CODE
+WS_LIMIT_ACTION = os.getenv('WS_LIMIT_ACTION', 'warn')
+WS_LIMIT_CLOSE_CODE = 4008
+# Rooms one multiplexed connection (ws/chat/) may subscribe to at once
+WS_MAX_SUBSCRIPTIONS = int(os.getenv('WS_MAX_SUBSCRIPTIONS', '50'))
+# Chat sockets that neither send nor receive a frame for this many seconds
+# are closed with WS_IDLE_CLOSE_CODE (0 keeps them open). Dead peers are
+# detected sooner by the server's WebSocket pings (daphne --ping-interval).
+WS_IDLE_TIMEOUT = int(os.getenv('WS_IDLE_TIMEOUT', '0'))
+WS_IDLE_CLOSE_CODE = 4009
+
+# ws/rooms/ subscribers get the room list deltas of each window of this many
+# seconds merged into one frame (see base/room_events.py)
+ROOM_LIST_WINDOW = float(os.getenv('ROOM_LIST_WINDOW', '0.5'))
+
+# ==============================================================================
+# BULK INGESTION
+# ==============================================================================
+
+# POST /api/v1/messages/bulk/ and `ingest_messages`: items per transaction and
+# per request
+INGEST_CHUNK_SIZE = 5000
+INGEST_MAX_ITEMS = 100000
+
+# ==============================================================================
+# MESSAGE ARCHIVE
+# ==============================================================================
+
+# Messages older than this are moved to compressed segments by `archive_messages`
+MESSAGE_ARCHIVE_AFTER_DAYS = int(os.getenv('MESSAGE_ARCHIVE_AFTER_DAYS', '365'))
+MESSAGE_ARCHIVE_SEGMENT_SIZE = 500
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 200
+
+# ==============================================================================
+# MESSAGE SHARDS
+# ==============================================================================
+
+# Sharded inserts leave Room.last_seq (and so unread counts) behind by at most
+# this many seconds
+MESSAGE_SHARD_SEQ_FLUSH_INTERVAL = float(os.getenv('MESSAGE_SHARD_SEQ_FLUSH_INTERVAL', '0.5'))
+
+# ==============================================================================
+# ADMIN
+# ==============================================================================
+
+# Admin changelists of large tables count up to this many rows and show
+# "about N" beyond it (see base/admin.py)
+ADMIN_EXACT_COUNT_LIMIT = int(os.getenv('ADMIN_EXACT_COUNT_LIMIT', '10000'))
+
+# ==============================================================================
+# REQUEST INSTRUMENTATION
+# ==============================================================================
+
+# Server-Timing headers, per-request query/timing logs and N+1 detection
+REQUEST_INSTRUMENTATION_ENABLED = os.getenv('REQUEST_INSTRUMENTATION', 'False') == 'True'
+REQUEST_INSTRUMENTATION_N_PLUS_ONE_THRESHOLD = 5
+
 # ==============================================================================
 # LOGGING
 # ==============================================================================
 
+# Handlers write from a background thread (see base/log.py); log calls never block on I/O.
+# Records below WARNING are sampled per logger to LOG_SAMPLE_RATE per second.
+LOG_SAMPLE_RATE = int(os.getenv('LOG_SAMPLE_RATE', '50'))
+LOG_SAMPLE_BURST = int(os.getenv('LOG_SAMPLE_BURST', '200'))
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', str(50 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', '5'))
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -347,16 +523,30 @@ LOGGING = {
             'format': '{levelname} {message}',
             'style': '{',
         },
+        'json': {
+            '()': 'base.log.JsonFormatter',
+        },
+    },
+    'filters': {
+        'sampling': {
+            '()': 'base.log.SamplingFilter',
+            'rate': LOG_SAMPLE_RATE,
+            'burst': LOG_SAMPLE_BURST,
+        },
     },
     'handlers': {
         'console': {
-            'class': 'logging.StreamHandler',
-            'formatter': 'verbose'
+            'class': 'base.log.BackgroundHandler',
+            'formatter': 'verbose',
+            'filters': ['sampling'],
         },
         'file': {
-            'class': 'logging.FileHandler',
+            'class': 'base.log.BackgroundHandler',
             'filename': os.path.join(BASE_DIR, 'logs', 'django.log'),
-            'formatter': 'verbose'
+            'max_bytes': LOG_MAX_BYTES,
+            'backup_count': LOG_BACKUP_COUNT,
+            'formatter': 'json',
+            'filters': ['sampling'],
         },
     },
     'root': {
@@ -2,4 +2,6 @@ from .base import *
 
 DEBUG = True
 
-ALLOWED_HOSTS = ["127.0.0.1", "localhost"]
\ No newline at end of file
+ALLOWED_HOSTS = ["127.0.0.1", "localhost"]
+
+REQUEST_INSTRUMENTATION_ENABLED = os.getenv('REQUEST_INSTRUMENTATION', 'True') == 'True'
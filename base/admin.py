@@ -1,10 +1,142 @@
-from django.contrib import admin
+"""
+Admin for tables that grow to millions of rows.
+
+The default changelist counts the whole table, pages with OFFSET (so page
+1000 reads and throws away 99,900 rows) and renders a foreign key as a
+<select> of every user. LargeTableAdmin instead:
 
-# Register your models here.
+  - counts with EstimatedCountPaginator: the planner's row estimate for an
+    unfiltered table above ADMIN_EXACT_COUNT_LIMIT rows, and otherwise a
+    count that stops after that many rows
+  - orders by -id and pages by keyset: "Older" links to `?id__lt=<last id
+    shown>`, which the primary key index answers directly however deep
+    the page
+  - does not offer sorting by other columns, which would need a full sort
+
+Foreign keys use raw-id or autocomplete widgets, the changelists select
+their related rows in the same query, and list_filter only offers columns
+with an index behind them.
+"""
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList
+from django.core.paginator import Paginator
+from django.db import DatabaseError, connections
+from django.utils.functional import cached_property
 
+from . import feed
 from .models import Room , Topic, Message, User
 
-admin.site.register(User)
-admin.site.register(Room)
-admin.site.register(Topic)
-admin.site.register(Message)
\ No newline at end of file
+# Table size as the database last measured it, without reading the table
+_ESTIMATES = {
+    'postgresql': 'SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass',
+    'mysql': 'SELECT table_rows FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = %s',
+    # Only there once ANALYZE has run; the first number is the row count
+    'sqlite': 'SELECT stat FROM sqlite_stat1 WHERE tbl = %s LIMIT 1',
+}
+
+
+def estimated_count(model, using):
+    """The database's estimate of how many rows `model`'s table holds, or None without one"""
+    connection = connections[using]
+    sql = _ESTIMATES.get(connection.vendor)
+    if sql is None:
+        return None
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [model._meta.db_table])
+            row = cursor.fetchone()
+    except DatabaseError:
+        return None
+    if row is None or row[0] is None:
+        return None
+    estimate = int(str(row[0]).split()[0])
+    # Postgres reports -1 for a table that was never analyzed
+    return estimate if estimate >= 0 else None
+
+
+class EstimatedCountPaginator(Paginator):
+    """Counts no further than ADMIN_EXACT_COUNT_LIMIT rows; `estimated` says the count is not exact"""
+    estimated = False
+
+    @cached_property
+    def count(self):
+        limit = settings.ADMIN_EXACT_COUNT_LIMIT
+        queryset = self.object_list
+        if not queryset.query.has_filters():
+            estimate = estimated_count(queryset.model, queryset.db)
+            if estimate is not None and estimate > limit:
+                self.estimated = True
+                return estimate
+        count = queryset.order_by()[:limit + 1].count()
+        if count > limit:
+            # Enough to know there is more than one page; the rest is never read
+            self.estimated = True
+        return count
+
+
+class KeysetChangeList(ChangeList):
+    """Shows the page of rows below `id__lt` instead of skipping to an offset"""
+    keyset = True
+
+    def get_results(self, request):
+        # Page numbers would bring OFFSET back
+        self.page_num = 1
+        super().get_results(request)
+        rows = list(self.result_list)
+        self.next_url = None
+        if self.multi_page and len(rows) == self.list_per_page:
+            self.next_url = self.get_query_string({'id__lt': rows[-1].pk})
+        self.first_url = self.get_query_string(remove=['id__lt']) if 'id__lt' in self.filter_params else None
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    ordering = ('-id',)
+    sortable_by = ()
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
+
+
+@admin.register(User)
+class UserAdmin(LargeTableAdmin):
+    list_display = ('id', 'username', 'email', 'name', 'is_staff')
+    # Prefix searches on the unique username and email; also backs the autocomplete widgets
+    search_fields = ('^username', '^email')
+
+
+@admin.register(Topic)
+class TopicAdmin(admin.ModelAdmin):
+    list_display = ('id', 'name')
+    search_fields = ('name',)
+    ordering = ('name',)
+
+
+@admin.register(Room)
+class RoomAdmin(LargeTableAdmin):
+    list_display = ('id', 'name', 'topic', 'host', 'last_seq', 'updated')
+    list_select_related = ('topic', 'host')
+    list_filter = ('topic',)
+    autocomplete_fields = ('host', 'topic')
+    raw_id_fields = ('participants',)
+
+
+@admin.register(Message)
+class MessageAdmin(LargeTableAdmin):
+    list_display = ('id', 'room', 'user', 'seq', '__str__', 'created')
+    list_select_related = ('room', 'user')
+    # A message's room and author are filtered from the URL (?room__id__exact=, ?user__id__exact=),
+    # both indexed; a list_filter over rooms or users would itself load every row
+    raw_id_fields = ('user', 'room')
+
+    def delete_model(self, request, obj):
+        message_id = obj.pk
+        super().delete_model(request, obj)
+        feed.remove_messages([message_id])
+
+    def delete_queryset(self, request, queryset):
+        message_ids = list(queryset.values_list('id', flat=True))
+        super().delete_queryset(request, queryset)
+        feed.remove_messages(message_ids)
@@ -0,0 +1,155 @@
+"""
+Batch endpoint: several API calls in one HTTP round trip.
+
+Every item becomes a request of its own, carrying the batch's headers (so
+its credentials and cookies), and goes through the full middleware chain
+to its view, where it is authenticated, permission-checked and throttled
+like a standalone request. Writes run one at a time in request order;
+consecutive GETs run concurrently. The batch itself is throttled too.
+"""
+import contextvars
+import io
+import json
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from rest_framework import status
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import AllowAny
+from rest_framework.response import Response
+from django.conf import settings
+from django.core.handlers.base import BaseHandler
+from django.core.handlers.wsgi import WSGIRequest
+from django.db import close_old_connections
+from django.urls import Resolver404, resolve, reverse
+
+METHODS = ('GET', 'POST', 'PUT', 'PATCH', 'DELETE')
+
+_executor = None
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=settings.BATCH_MAX_WORKERS,
+            thread_name_prefix='batch',
+        )
+    return _executor
+
+
+def _get_handler():
+    # Built per batch so it follows the current MIDDLEWARE and settings; loading is cheap
+    handler = BaseHandler()
+    handler.load_middleware()
+    return handler
+
+
+def _sub_request(parent, index, method, path, body):
+    """The WSGIRequest for one item, with the batch's headers and a request id derived from the batch's"""
+    url = urlsplit(path)
+    payload = json.dumps(body).encode() if body is not None else b''
+    environ = {key: value for key, value in parent.META.items() if isinstance(value, str)}
+    environ.update({
+        'REQUEST_METHOD': method,
+        'PATH_INFO': url.path,
+        'SCRIPT_NAME': '',
+        'QUERY_STRING': url.query,
+        'CONTENT_TYPE': 'application/json',
+        'CONTENT_LENGTH': str(len(payload)),
+        'wsgi.input': io.BytesIO(payload),
+    })
+    parent_id = getattr(parent, 'id', None)
+    if parent_id:
+        environ['HTTP_X_REQUEST_ID'] = f'{parent_id}.{index}'
+    return WSGIRequest(environ)
+
+
+def _run_in_thread(handler, request):
+    try:
+        return handler.get_response(request)
+    finally:
+        close_old_connections()
+
+
+def _envelope(response):
+    if hasattr(response, 'data'):
+        body = response.data
+    else:
+        body = response.content.decode(response.charset)
+    return {'status': response.status_code, 'body': body}
+
+
+def _error(status_code, message):
+    return {'status': status_code, 'body': {'error': message}}
+
+
+def _run_concurrently(handler, pending):
+    if len(pending) == 1:
+        return [handler.get_response(pending[0])]
+    executor = _get_executor()
+    # Each item gets a copy of this thread's context
+    futures = [
+        executor.submit(contextvars.copy_context().run, _run_in_thread, handler, request) for request in pending
+    ]
+    return [future.result() for future in futures]
+
+
+@api_view(['POST'])
+@permission_classes([AllowAny])
+def batch(request):
+    """
+    Run several API requests in one round trip
+    POST: { "requests": [{ "method": "GET", "path": "/api/v1/rooms/" },
+                         { "method": "POST", "path": "/api/v1/messages/", "body": {...} }] }
+    Every item is throttled and permission-checked like a standalone request.
+    """
+    items = request.data.get('requests')
+    if not isinstance(items, list) or not items:
+        return Response({'error': 'requests must be a non-empty list'}, status=status.HTTP_400_BAD_REQUEST)
+    if len(items) > settings.BATCH_MAX_REQUESTS:
+        return Response({'error': f'At most {settings.BATCH_MAX_REQUESTS} requests per batch'},
+                        status=status.HTTP_400_BAD_REQUEST)
+
+    batch_path = reverse('api-batch')
+    handler = _get_handler()
+    results = [None] * len(items)
+    # Consecutive GETs run together; anything else waits for them and runs alone, in order
+    pending, pending_indexes = [], []
+
+    def flush():
+        if pending:
+            for index, response in zip(pending_indexes, _run_concurrently(handler, pending)):
+                results[index] = _envelope(response)
+        pending.clear()
+        pending_indexes.clear()
+
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            results[index] = _error(400, 'Each request must be an object')
+            continue
+        method = str(item.get('method', 'GET')).upper()
+        path = item.get('path')
+        if method not in METHODS:
+            results[index] = _error(405, f'Method {method} is not allowed')
+            continue
+        if not isinstance(path, str) or not path.startswith('/api/') or urlsplit(path).path == batch_path:
+            results[index] = _error(400, 'path must be an API path other than the batch endpoint')
+            continue
+
+        if method != 'GET':
+            flush()
+        try:
+            resolve(urlsplit(path).path)
+        except Resolver404:
+            results[index] = _error(404, 'Not found')
+            continue
+        sub_request = _sub_request(request, index, method, path, item.get('body'))
+        if method == 'GET':
+            pending.append(sub_request)
+            pending_indexes.append(index)
+        else:
+            results[index] = _envelope(handler.get_response(sub_request))
+    flush()
+
+    return Response({'responses': results})
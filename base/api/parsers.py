@@ -0,0 +1,14 @@
+from rest_framework.parsers import BaseParser
+
+from base.ingest import read_jsonl
+
+
+class JSONLinesParser(BaseParser):
+    """
+    Newline-delimited JSON. Returns a lazy iterator over the items, so the body
+    is consumed one line at a time instead of being loaded whole.
+    """
+    media_type = 'application/x-ndjson'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        return read_jsonl(stream if stream is not None else ())
@@ -0,0 +1,121 @@
+"""
+Precomputed OpenAPI schema.
+
+Generating the schema introspects every view and serializer, which takes
+hundreds of milliseconds. The rendered document is built once per code
+version (`build_api_schema` at deploy time, or on the first request), kept in
+memory and on disk under API_SCHEMA_CACHE_DIR, and served with an ETag.
+
+The code version is CODE_VERSION from the environment (e.g. the git SHA of
+the release) or, when that is unset, a hash of the project's Python sources
+and the versions of the libraries that shape the schema.
+"""
+import hashlib
+import os
+import threading
+from functools import lru_cache
+from importlib import import_module
+from importlib.metadata import version as package_version
+from pathlib import Path
+
+from django.apps import apps
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_cache_control
+from drf_spectacular.settings import spectacular_settings
+from drf_spectacular.views import SpectacularAPIView
+
+SCHEMA_PACKAGES = ('django', 'djangorestframework', 'drf-spectacular')
+
+_memory = {}
+_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def code_version():
+    if settings.API_SCHEMA_VERSION:
+        return settings.API_SCHEMA_VERSION
+    base_dir = Path(settings.BASE_DIR).resolve()
+    roots = {Path(import_module(settings.ROOT_URLCONF).__file__).resolve().parent}
+    roots.update(
+        Path(config.path).resolve() for config in apps.get_app_configs()
+        if Path(config.path).resolve().is_relative_to(base_dir)
+    )
+    digest = hashlib.sha256()
+    for package in SCHEMA_PACKAGES:
+        digest.update(f'{package}=={package_version(package)}\n'.encode())
+    for path in sorted(p for root in roots for p in root.rglob('*.py')):
+        digest.update(str(path.relative_to(base_dir)).encode())
+        digest.update(path.read_bytes())
+    return digest.hexdigest()[:16]
+
+
+def _path(fmt):
+    return Path(settings.API_SCHEMA_CACHE_DIR) / f'{code_version()}.{fmt}'
+
+
+def _etag(content):
+    return '"%s"' % hashlib.sha256(content).hexdigest()[:32]
+
+
+def build(renderer, generator_class=None):
+    """Generate and render the schema with `renderer`, then store it on disk"""
+    generator_class = generator_class or spectacular_settings.DEFAULT_GENERATOR_CLASS
+    schema = generator_class(urlconf=spectacular_settings.SERVE_URLCONF).get_schema(request=None, public=True)
+    content = renderer.render(schema, accepted_media_type=renderer.media_type, renderer_context={})
+
+    path = _path(renderer.format)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temporary = path.with_suffix(f'.{os.getpid()}.tmp')
+    temporary.write_bytes(content)
+    os.replace(temporary, path)
+    return content
+
+
+def get(renderer, generator_class=None):
+    """(etag, content) of the schema rendered by `renderer`, from memory, disk or a fresh build"""
+    key = (code_version(), renderer.format)
+    cached = _memory.get(key)
+    if cached is None:
+        with _lock:
+            cached = _memory.get(key)
+            if cached is None:
+                path = _path(renderer.format)
+                content = path.read_bytes() if path.exists() else build(renderer, generator_class)
+                cached = _memory[key] = (_etag(content), content)
+    return cached
+
+
+def prune():
+    """Delete cached schemas of other code versions; returns how many were removed"""
+    directory = Path(settings.API_SCHEMA_CACHE_DIR)
+    if not directory.exists():
+        return 0
+    stale = [path for path in directory.iterdir() if path.stem != code_version()]
+    for path in stale:
+        path.unlink()
+    return len(stale)
+
+
+def clear():
+    _memory.clear()
+    code_version.cache_clear()
+
+
+class CachedSpectacularAPIView(SpectacularAPIView):
+    """SpectacularAPIView serving the precomputed schema"""
+
+    def _get_schema_response(self, request):
+        # Per-request variants (language, API version, per-user schemas) are still generated live
+        if request.GET.get('lang') or request.GET.get('version') or self.api_version or not self.serve_public:
+            return super()._get_schema_response(request)
+
+        etag, content = get(request.accepted_renderer, self.generator_class)
+        if etag in request.headers.get('If-None-Match', ''):
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(content, content_type=request.accepted_renderer.media_type)
+            response['Content-Disposition'] = f'inline; filename="{self._get_filename(request, None)}"'
+        response['ETag'] = etag
+        patch_cache_control(response, public=True, max_age=settings.API_SCHEMA_CACHE_MAX_AGE)
+        return response
@@ -1,15 +1,43 @@
 from rest_framework import serializers
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from base.models import Room, Topic, Message
+from base.avatars import variant_url
+from base.instrumentation import InstrumentedSerializerMixin
+from base.users import user_loader
 
 User = get_user_model()
 
 
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(InstrumentedSerializerMixin, serializers.ModelSerializer):
+    avatar_small = serializers.SerializerMethodField()
+    
     class Meta:
         model = User
-        fields = ['id', 'username', 'email', 'name', 'bio', 'avatar']
+        fields = ['id', 'username', 'email', 'name', 'bio', 'avatar', 'avatar_small']
         read_only_fields = ['id']
+    
+    def get_avatar_small(self, obj):
+        url = variant_url(obj)
+        request = self.context.get('request')
+        # Absolute like `avatar`, for clients served from another origin
+        return request.build_absolute_uri(url) if url and request is not None else url
+    
+    def validate_avatar(self, value):
+        if value and value.size > settings.AVATAR_MAX_UPLOAD_SIZE:
+            raise serializers.ValidationError("Avatar file is too large")
+        return value
+
+
+class UserRecordField(serializers.Field):
+    """A user id rendered as its UserSerializer record, resolved through the response's UserLoader"""
+    
+    def __init__(self, **kwargs):
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+    
+    def to_representation(self, user_id):
+        return user_loader(self.context).load(user_id)
 
 
 class RegisterSerializer(serializers.ModelSerializer):
@@ -36,7 +64,7 @@ class RegisterSerializer(serializers.ModelSerializer):
         return user
 
 
-class TopicSerializer(serializers.ModelSerializer):
+class TopicSerializer(InstrumentedSerializerMixin, serializers.ModelSerializer):
     room_count = serializers.SerializerMethodField()
     
     class Meta:
@@ -44,24 +72,26 @@ class TopicSerializer(serializers.ModelSerializer):
         fields = ['id', 'name', 'room_count']
     
     def get_room_count(self, obj):
-        return obj.room_set.count()
+        # Annotated by the views; fall back to a query for bare instances
+        count = getattr(obj, 'room_count', None)
+        return obj.room_set.count() if count is None else count
 
 
-class MessageSerializer(serializers.ModelSerializer):
+class MessageSerializer(InstrumentedSerializerMixin, serializers.ModelSerializer):
     user = UserSerializer(read_only=True)
     user_id = serializers.IntegerField(write_only=True, required=False)
     
     class Meta:
         model = Message
-        fields = ['id', 'user', 'user_id', 'room', 'body', 'created', 'updated']
-        read_only_fields = ['id', 'created', 'updated']
+        fields = ['id', 'user', 'user_id', 'room', 'body', 'seq', 'created', 'updated']
+        read_only_fields = ['id', 'seq', 'created', 'updated']
 
 
-class RoomSerializer(serializers.ModelSerializer):
+class RoomSerializer(InstrumentedSerializerMixin, serializers.ModelSerializer):
     host = UserSerializer(read_only=True)
     topic = TopicSerializer(read_only=True)
     topic_id = serializers.IntegerField(write_only=True, required=False, allow_null=True)
-    participants = UserSerializer(many=True, read_only=True)
+    participant_preview = serializers.SerializerMethodField()
     message_count = serializers.SerializerMethodField()
     participant_count = serializers.SerializerMethodField()
     
@@ -69,20 +99,49 @@ class RoomSerializer(serializers.ModelSerializer):
         model = Room
         fields = [
             'id', 'host', 'topic', 'topic_id', 'name', 'description',
-            'participants', 'message_count', 'participant_count',
-            'created', 'updated'
+            'participant_preview', 'message_count', 'participant_count',
+            'last_seq', 'created', 'updated'
         ]
-        read_only_fields = ['id', 'created', 'updated']
+        read_only_fields = ['id', 'last_seq', 'created', 'updated']
     
     def get_message_count(self, obj):
-        return obj.message_set.count()
+        count = getattr(obj, 'message_count', None)
+        return obj.message_set.count() if count is None else count
+    
+    def get_participant_preview(self, obj):
+        # Attached to a whole page at once by the views; fall back to a query for bare instances
+        preview = getattr(obj, 'participant_preview', None)
+        if preview is None:
+            preview = Room.participant_previews([obj.pk], settings.ROOM_PARTICIPANT_PREVIEW_SIZE)[obj.pk]
+        return UserSerializer(preview, many=True, context=self.context).data
     
     def get_participant_count(self, obj):
-        return obj.participants.count()
+        count = getattr(obj, 'participant_count', None)
+        return obj.participants.count() if count is None else count
+
+
+class RoomMessageSerializer(MessageSerializer):
+    user = UserRecordField(source='user_id')
 
 
 class RoomDetailSerializer(RoomSerializer):
-    messages = MessageSerializer(many=True, read_only=True, source='message_set')
+    host = UserRecordField(source='host_id')
+    # Set by RoomDetailView: hot and archived messages, newest first
+    messages = RoomMessageSerializer(many=True, read_only=True)
     
     class Meta(RoomSerializer.Meta):
         fields = RoomSerializer.Meta.fields + ['messages']
+    
+    def to_representation(self, instance):
+        # Host and message authors overlap; resolve them all with one lookup
+        user_loader(self.context).want([instance.host_id, *(message.user_id for message in instance.messages)])
+        return super().to_representation(instance)
+
+
+class FeedItemSerializer(InstrumentedSerializerMixin, serializers.Serializer):
+    message_id = serializers.IntegerField()
+    room = serializers.IntegerField(source='room_id')
+    room_name = serializers.CharField()
+    user = UserSerializer()
+    body = serializers.CharField()
+    created = serializers.DateTimeField()
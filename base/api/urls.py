@@ -1,17 +1,19 @@
 from django.urls import path, include
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
-from drf_spectacular.views import SpectacularAPIView, SpectacularSwaggerView, SpectacularRedocView
-from . import views, auth_views
+from drf_spectacular.views import SpectacularSwaggerView, SpectacularRedocView
+from . import views, auth_views, batch_views
+from .schema import CachedSpectacularAPIView
 
 # API v1 URLs
 v1_patterns = [
     # API Documentation
-    path('schema/', SpectacularAPIView.as_view(), name='api-schema'),
+    path('schema/', CachedSpectacularAPIView.as_view(), name='api-schema'),
     path('docs/', SpectacularSwaggerView.as_view(url_name='api-schema'), name='api-docs'),
     path('redoc/', SpectacularRedocView.as_view(url_name='api-schema'), name='api-redoc'),
     
     # API Routes
     path('', views.getRoutes, name='api-routes'),
+    path('batch/', batch_views.batch, name='api-batch'),
     
     # Authentication
     path('auth/register/', views.register, name='api-register'),
@@ -25,21 +27,32 @@ v1_patterns = [
     # User Profile
     path('profile/', views.get_user_profile, name='api-profile'),
     path('profile/update/', views.update_user_profile, name='api-profile-update'),
+    path('users/', views.get_users, name='api-users'),
     path('users/<str:pk>/', views.get_user_by_id, name='api-user-detail'),
+    path('feed/', views.get_feed, name='api-feed'),
     
     # Rooms
     path('rooms/', views.RoomListCreateView.as_view(), name='api-rooms'),
+    path('rooms/unread/', views.get_unread_counts, name='api-rooms-unread'),
+    path('rooms/read/', views.mark_rooms_read, name='api-rooms-read'),
     path('rooms/<str:pk>/', views.RoomDetailView.as_view(), name='api-room-detail'),
     path('rooms/<str:pk>/join/', views.join_room, name='api-room-join'),
     path('rooms/<str:pk>/leave/', views.leave_room, name='api-room-leave'),
+    path('rooms/<str:pk>/participants/', views.RoomParticipantListView.as_view(), name='api-room-participants'),
+    path('rooms/<str:pk>/history/', views.get_room_history, name='api-room-history'),
     
     # Topics
     path('topics/', views.TopicListCreateView.as_view(), name='api-topics'),
+    path('topics/autocomplete/', views.autocomplete_topics, name='api-topics-autocomplete'),
     path('topics/<str:pk>/', views.TopicDetailView.as_view(), name='api-topic-detail'),
     
     # Messages
     path('messages/', views.MessageListCreateView.as_view(), name='api-messages'),
+    path('messages/bulk/', views.ingest_messages, name='api-messages-bulk'),
     path('messages/<str:pk>/', views.MessageDetailView.as_view(), name='api-message-detail'),
+    
+    # Monitoring
+    path('metrics/', views.metrics, name='api-metrics'),
 ]
 
 urlpatterns = [
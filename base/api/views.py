@@ -1,22 +1,31 @@
 from rest_framework import generics, status, permissions
-from rest_framework.decorators import api_view, permission_classes, throttle_classes
+from rest_framework.exceptions import NotFound
+from rest_framework.authentication import SessionAuthentication
+from rest_framework.decorators import api_view, authentication_classes, parser_classes, permission_classes, throttle_classes
+from rest_framework.parsers import JSONParser
 from rest_framework.response import Response
-from rest_framework.permissions import AllowAny, IsAuthenticated
+from rest_framework.permissions import AllowAny, IsAdminUser, IsAuthenticated
 from rest_framework.throttling import AnonRateThrottle, UserRateThrottle
+from rest_framework_simplejwt.authentication import JWTAuthentication
 from rest_framework_simplejwt.tokens import RefreshToken
-from django.contrib.auth import get_user_model
-from django.db.models import Q
+from rest_framework.utils.urls import replace_query_param
+from django.conf import settings
+from django.db.models import Count, OuterRef, Prefetch, Q, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django.http import HttpResponse
 from django_ratelimit.decorators import ratelimit
 from django.utils.decorators import method_decorator
 
-from base.models import Room, Topic, Message
+from base import archive, feed, ingest, room_events, sharding, topic_index, users
+from base.models import ArchiveSegment, Room, Topic, Message, ReadMarker
+from base.avatars import schedule_avatar_processing
+from base.metrics import REGISTRY
+from .parsers import JSONLinesParser
 from .serializers import (
     RegisterSerializer, UserSerializer, RoomSerializer,
-    RoomDetailSerializer, TopicSerializer, MessageSerializer
+    RoomDetailSerializer, TopicSerializer, MessageSerializer, FeedItemSerializer
 )
 
-User = get_user_model()
-
 
 # Custom Throttle Classes
 class LoginRateThrottle(AnonRateThrottle):
@@ -39,7 +48,7 @@ def register(request):
         user = serializer.save()
         refresh = RefreshToken.for_user(user)
         return Response({
-            'user': UserSerializer(user).data,
+            'user': UserSerializer(user, context={'request': request}).data,
             'refresh': str(refresh),
             'access': str(refresh.access_token),
             'message': 'Registration successful. Please check your email to verify your account.'
@@ -51,7 +60,7 @@ def register(request):
 @permission_classes([IsAuthenticated])
 def get_user_profile(request):
     """Get current user profile"""
-    serializer = UserSerializer(request.user)
+    serializer = UserSerializer(request.user, context={'request': request})
     return Response(serializer.data)
 
 
@@ -59,9 +68,14 @@ def get_user_profile(request):
 @permission_classes([IsAuthenticated])
 def update_user_profile(request):
     """Update current user profile"""
-    serializer = UserSerializer(request.user, data=request.data, partial=True)
+    serializer = UserSerializer(request.user, data=request.data, partial=True, context={'request': request})
     if serializer.is_valid():
-        serializer.save()
+        if 'avatar' in serializer.validated_data:
+            # Variants are regenerated off the request thread
+            user = serializer.save(avatar_hash='')
+            schedule_avatar_processing(user)
+        else:
+            serializer.save()
         return Response(serializer.data)
     return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
@@ -71,15 +85,76 @@ def update_user_profile(request):
 def get_user_by_id(request, pk):
     """Get user by ID"""
     try:
-        user = User.objects.get(id=pk)
-        serializer = UserSerializer(user)
-        return Response(serializer.data)
-    except User.DoesNotExist:
+        record = users.get_records([int(pk)], request).get(int(pk))
+    except ValueError:
+        record = None
+    if record is None:
         return Response({'error': 'User not found'}, status=status.HTTP_404_NOT_FOUND)
+    return Response(record)
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def get_users(request):
+    """Many users by ID (?ids=1,2,3) as {"users": {id: user}, "missing": [ids]}"""
+    raw = request.query_params.get('ids', '')
+    try:
+        user_ids = list(dict.fromkeys(int(part) for part in raw.split(',') if part.strip()))
+    except ValueError:
+        return Response({'error': 'ids must be a comma-separated list of integers'}, status=status.HTTP_400_BAD_REQUEST)
+    if not user_ids:
+        return Response({'error': 'ids is required'}, status=status.HTTP_400_BAD_REQUEST)
+    if len(user_ids) > settings.USER_LOOKUP_MAX_IDS:
+        return Response(
+            {'error': f'At most {settings.USER_LOOKUP_MAX_IDS} ids can be looked up at once'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    
+    records = users.get_records(user_ids, request)
+    return Response({
+        'users': {str(user_id): records[user_id] for user_id in user_ids if user_id in records},
+        'missing': [user_id for user_id in user_ids if user_id not in records],
+    })
 
 
 # ==================== ROOMS ====================
 
+def with_room_counts(queryset):
+    """
+    Annotate message (hot and archived) and participant counts and prefetch topics with their room counts.
+    With message shards only archived messages are counted here; attach_room_extras() adds the hot ones.
+    """
+    message_count = Coalesce(Subquery(
+        ArchiveSegment.objects.filter(room=OuterRef('pk'))
+        .order_by().values('room').annotate(total=Sum('message_count')).values('total')
+    ), 0)
+    if not sharding.enabled():
+        message_count += Coalesce(Subquery(
+            Message.objects.filter(room=OuterRef('pk'))
+            .order_by().values('room').annotate(total=Count('id')).values('total')
+        ), 0)
+    participants = (
+        Room.participants.through.objects.filter(room=OuterRef('pk'))
+        .order_by().values('room').annotate(total=Count('id')).values('total')
+    )
+    return queryset.annotate(
+        message_count=message_count,
+        participant_count=Coalesce(Subquery(participants), 0),
+    ).prefetch_related(
+        Prefetch('topic', queryset=Topic.objects.annotate(room_count=Count('room'))),
+    )
+
+
+def attach_room_extras(rooms):
+    """Set `participant_preview` on each room with one query for all of them, and count hot messages on shards"""
+    previews = Room.participant_previews([room.pk for room in rooms], settings.ROOM_PARTICIPANT_PREVIEW_SIZE)
+    hot_counts = sharding.hot_message_counts([room.pk for room in rooms]) if sharding.enabled() else {}
+    for room in rooms:
+        room.participant_preview = previews[room.pk]
+        room.message_count += hot_counts.get(room.pk, 0)
+    return rooms
+
+
 class RoomListCreateView(generics.ListCreateAPIView):
     """List all rooms or create a new room"""
     serializer_class = RoomSerializer
@@ -102,11 +177,16 @@ class RoomListCreateView(generics.ListCreateAPIView):
         if topic:
             queryset = queryset.filter(topic__name__icontains=topic)
         
-        return queryset.select_related('host', 'topic').prefetch_related('participants')
+        return with_room_counts(queryset.select_related('host'))
+    
+    def paginate_queryset(self, queryset):
+        page = super().paginate_queryset(queryset)
+        return attach_room_extras(page) if page is not None else None
     
     def perform_create(self, serializer):
         room = serializer.save(host=self.request.user)
         room.participants.add(self.request.user)
+        room_events.room_created(room, participant_count=1)
 
 
 class RoomDetailView(generics.RetrieveUpdateDestroyAPIView):
@@ -120,7 +200,17 @@ class RoomDetailView(generics.RetrieveUpdateDestroyAPIView):
         return RoomSerializer
     
     def get_queryset(self):
-        return Room.objects.select_related('host', 'topic').prefetch_related('participants', 'message_set__user')
+        if self.request.method == 'GET':
+            # RoomDetailSerializer resolves the host and authors through the user record cache
+            return with_room_counts(Room.objects.all())
+        return with_room_counts(Room.objects.select_related('host'))
+    
+    def get_object(self):
+        room = attach_room_extras([super().get_object()])[0]
+        if self.request.method == 'GET':
+            # Hot messages from the room's shard, then archived ones
+            room.messages = list(archive.RoomHistory(room.pk, sharding.room_messages(room.pk)))
+        return room
     
     def perform_update(self, serializer):
         if serializer.instance.host != self.request.user:
@@ -128,7 +218,8 @@ class RoomDetailView(generics.RetrieveUpdateDestroyAPIView):
                 {'error': 'You are not the host of this room'},
                 status=status.HTTP_403_FORBIDDEN
             )
-        serializer.save()
+        previous_topic_id = serializer.instance.topic_id
+        room_events.room_updated(serializer.save(), previous_topic_id)
     
     def perform_destroy(self, instance):
         if instance.host != self.request.user:
@@ -136,7 +227,9 @@ class RoomDetailView(generics.RetrieveUpdateDestroyAPIView):
                 {'error': 'You are not the host of this room'},
                 status=status.HTTP_403_FORBIDDEN
             )
+        room_id, topic_id = instance.pk, instance.topic_id
         instance.delete()
+        room_events.room_deleted(room_id, topic_id)
 
 
 @api_view(['POST'])
@@ -146,6 +239,11 @@ def join_room(request, pk):
     try:
         room = Room.objects.get(pk=pk)
         room.participants.add(request.user)
+        # History from before joining does not count as unread
+        ReadMarker.objects.bulk_create(
+            [ReadMarker(user=request.user, room=room, last_read_seq=room.last_seq)], ignore_conflicts=True,
+        )
+        room_events.counts_changed(room)
         return Response({'message': 'Joined room successfully'})
     except Room.DoesNotExist:
         return Response({'error': 'Room not found'}, status=status.HTTP_404_NOT_FOUND)
@@ -158,11 +256,115 @@ def leave_room(request, pk):
     try:
         room = Room.objects.get(pk=pk)
         room.participants.remove(request.user)
+        room_events.counts_changed(room)
         return Response({'message': 'Left room successfully'})
     except Room.DoesNotExist:
         return Response({'error': 'Room not found'}, status=status.HTTP_404_NOT_FOUND)
 
 
+class RoomParticipantListView(generics.ListAPIView):
+    """A room's members in the order they joined, paginated"""
+    serializer_class = UserSerializer
+    permission_classes = [permissions.IsAuthenticatedOrReadOnly]
+    
+    def get_queryset(self):
+        if not Room.objects.filter(pk=self.kwargs['pk']).exists():
+            raise NotFound('Room not found')
+        return Room.participants.through.objects.filter(room_id=self.kwargs['pk']).select_related('user').order_by('id')
+    
+    def paginate_queryset(self, queryset):
+        page = super().paginate_queryset(queryset)
+        return [membership.user for membership in page] if page is not None else None
+
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAuthenticatedOrReadOnly])
+def get_room_history(request, pk):
+    """A room's messages newest first, including archived ones (?before=<seq>&limit=<n>)"""
+    try:
+        before = request.query_params.get('before')
+        before = int(before) if before else None
+        limit = int(request.query_params.get('limit', settings.HISTORY_PAGE_SIZE))
+    except ValueError:
+        return Response({'error': 'before and limit must be integers'}, status=status.HTTP_400_BAD_REQUEST)
+    limit = max(1, min(limit, settings.HISTORY_MAX_PAGE_SIZE))
+    if not Room.objects.filter(pk=pk).exists():
+        return Response({'error': 'Room not found'}, status=status.HTTP_404_NOT_FOUND)
+    
+    messages = archive.get_history(pk, before=before, limit=limit)
+    next_url = None
+    if len(messages) == limit:
+        next_url = replace_query_param(request.build_absolute_uri(), 'before', messages[-1].seq)
+    return Response({
+        'next': next_url,
+        'results': MessageSerializer(messages, many=True).data,
+    })
+
+
+MAX_BULK_ROOMS = 500
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def get_unread_counts(request):
+    """Unread message counts for every room the current user has joined"""
+    read_seq = ReadMarker.objects.filter(room=OuterRef('pk'), user=request.user).values('last_read_seq')[:1]
+    rooms = (
+        Room.objects.filter(participants=request.user)
+        .annotate(read_seq=Coalesce(Subquery(read_seq), 0))
+        .order_by().values_list('id', 'last_seq', 'read_seq')
+    )
+    return Response({
+        'rooms': [
+            {'room': room_id, 'last_seq': last_seq, 'last_read_seq': read, 'unread': max(last_seq - read, 0)}
+            for room_id, last_seq, read in rooms
+        ]
+    })
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def mark_rooms_read(request):
+    """
+    Mark rooms as read
+    POST: { "rooms": [1, 2] }          (up to their latest message)
+    POST: { "rooms": {"1": 57} }       (up to a sequence number)
+    """
+    rooms = request.data.get('rooms')
+    try:
+        if isinstance(rooms, list):
+            targets = {int(room_id): None for room_id in rooms}
+        elif isinstance(rooms, dict):
+            targets = {int(room_id): int(seq) for room_id, seq in rooms.items()}
+        else:
+            raise ValueError
+    except (TypeError, ValueError):
+        return Response({'error': 'rooms must be a list of ids or a map of id to sequence number'},
+                        status=status.HTTP_400_BAD_REQUEST)
+    if len(targets) > MAX_BULK_ROOMS:
+        return Response({'error': f'At most {MAX_BULK_ROOMS} rooms per request'}, status=status.HTTP_400_BAD_REQUEST)
+    
+    read_seq = ReadMarker.objects.filter(room=OuterRef('pk'), user=request.user).values('last_read_seq')[:1]
+    latest = (
+        Room.objects.filter(pk__in=targets, participants=request.user)
+        .annotate(read_seq=Coalesce(Subquery(read_seq), 0))
+        .order_by().values_list('id', 'last_seq', 'read_seq')
+    )
+    # An explicit seq behind the marker (from a stale tab, say) leaves it where it is
+    markers = [
+        ReadMarker(
+            user=request.user, room_id=room_id,
+            last_read_seq=last_seq if targets[room_id] is None else max(read, min(targets[room_id], last_seq)),
+        )
+        for room_id, last_seq, read in latest
+    ]
+    ReadMarker.objects.bulk_create(
+        markers, update_conflicts=True,
+        unique_fields=['user', 'room'], update_fields=['last_read_seq', 'updated'],
+    )
+    return Response({'rooms': {str(marker.room_id): marker.last_read_seq for marker in markers}})
+
+
 # ==================== TOPICS ====================
 
 class TopicListCreateView(generics.ListCreateAPIView):
@@ -172,16 +374,29 @@ class TopicListCreateView(generics.ListCreateAPIView):
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
     
     def get_queryset(self):
-        queryset = Topic.objects.all()
+        queryset = Topic.objects.annotate(room_count=Count('room'))
         q = self.request.query_params.get('q', '')
         if q:
             queryset = queryset.filter(name__icontains=q)
         return queryset
 
 
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def autocomplete_topics(request):
+    """Topics with a word starting with ?q=, most rooms first, from the in-memory index (?limit=<n>)"""
+    try:
+        limit = int(request.query_params.get('limit', settings.TOPIC_AUTOCOMPLETE_LIMIT))
+    except ValueError:
+        return Response({'error': 'limit must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+    limit = max(1, min(limit, settings.TOPIC_AUTOCOMPLETE_MAX_LIMIT))
+    q = request.query_params.get('q', '')
+    return Response({'results': topic_index.get_index().search(q, limit)})
+
+
 class TopicDetailView(generics.RetrieveUpdateDestroyAPIView):
     """Retrieve, update or delete a topic"""
-    queryset = Topic.objects.all()
+    queryset = Topic.objects.annotate(room_count=Count('room'))
     serializer_class = TopicSerializer
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
 
@@ -194,7 +409,7 @@ class MessageListCreateView(generics.ListCreateAPIView):
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
     
     def get_queryset(self):
-        queryset = Message.objects.select_related('user', 'room')
+        queryset = Message.objects.all()
         
         # Filter by room
         room_id = self.request.query_params.get('room', None)
@@ -206,12 +421,47 @@ class MessageListCreateView(generics.ListCreateAPIView):
         if user_id:
             queryset = queryset.filter(user_id=user_id)
         
+        if not sharding.enabled():
+            queryset = queryset.select_related('user', 'room')
+        elif room_id:
+            queryset = queryset.using(sharding.shard_for_room(room_id)).prefetch_related('user')
+        else:
+            # Other filters span rooms, so every shard is asked
+            return sharding.ShardedQuery(queryset, prefetch=('user',))
+        if room_id and not user_id:
+            # A room's archived messages follow its hot ones on the later pages
+            return archive.RoomHistory(room_id, queryset)
         return queryset
     
     def perform_create(self, serializer):
         message = serializer.save(user=self.request.user)
         # Add user to room participants
         message.room.participants.add(self.request.user)
+        # Their own message is read, and so is the history before it if they just joined
+        ReadMarker.advance(self.request.user.id, message.room_id, message.seq)
+        feed.publish_message(message)
+        room_events.counts_changed(message.room)
+
+
+@api_view(['POST'])
+@permission_classes([IsAdminUser])
+@parser_classes([JSONParser, JSONLinesParser])
+def ingest_messages(request):
+    """
+    Create many messages at once (staff only)
+    POST a JSON array (or {"messages": [...]}) or a JSONL stream (Content-Type: application/x-ndjson)
+    of {"room": <id>, "body": "..."}, optionally with "user" and "created".
+    """
+    items = request.data
+    if isinstance(items, dict):
+        items = items.get('messages')
+    if items is None or isinstance(items, (str, dict)):
+        return Response({'error': 'Expected a list of messages'}, status=status.HTTP_400_BAD_REQUEST)
+    
+    result = ingest.ingest(
+        items, default_user_id=request.user.id, trusted=True, max_items=settings.INGEST_MAX_ITEMS,
+    )
+    return Response(result)
 
 
 class MessageDetailView(generics.RetrieveUpdateDestroyAPIView):
@@ -220,6 +470,13 @@ class MessageDetailView(generics.RetrieveUpdateDestroyAPIView):
     serializer_class = MessageSerializer
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
     
+    def get_object(self):
+        if not sharding.enabled():
+            return super().get_object()
+        message = sharding.get_message(self.kwargs['pk'])
+        self.check_object_permissions(self.request, message)
+        return message
+    
     def perform_update(self, serializer):
         if serializer.instance.user != self.request.user:
             return Response(
@@ -234,7 +491,43 @@ class MessageDetailView(generics.RetrieveUpdateDestroyAPIView):
                 {'error': 'You can only delete your own messages'},
                 status=status.HTTP_403_FORBIDDEN
             )
+        message_id = instance.pk
         instance.delete()
+        feed.remove_messages([message_id])
+
+
+# ==================== ACTIVITY FEED ====================
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def get_feed(request):
+    """Recent messages in the current user's rooms (?before=<message_id>&limit=<n>)"""
+    try:
+        before = request.query_params.get('before')
+        before = int(before) if before else None
+        limit = int(request.query_params.get('limit', settings.FEED_PAGE_SIZE))
+    except ValueError:
+        return Response({'error': 'before and limit must be integers'}, status=status.HTTP_400_BAD_REQUEST)
+    limit = max(1, min(limit, settings.FEED_MAX_PAGE_SIZE))
+    
+    items = feed.get_feed(request.user, before=before, limit=limit)
+    next_url = None
+    if len(items) == limit:
+        next_url = replace_query_param(request.build_absolute_uri(), 'before', items[-1].message_id)
+    return Response({
+        'next': next_url,
+        'results': FeedItemSerializer(items, many=True).data,
+    })
+
+
+# ==================== METRICS ====================
+
+@api_view(['GET'])
+@authentication_classes([JWTAuthentication, SessionAuthentication])
+@permission_classes([IsAdminUser])
+def metrics(request):
+    """Process metrics in the Prometheus text exposition format"""
+    return HttpResponse(REGISTRY.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
 
 # ==================== API ROUTES ====================
@@ -250,7 +543,9 @@ def getRoutes(request):
             'POST /api/token/refresh/': 'Refresh JWT token',
             'GET /api/profile/': 'Get current user profile',
             'PUT /api/profile/': 'Update current user profile',
+            'GET /api/users/?ids=1,2,3': 'Get many users by ID in one request',
             'GET /api/users/<id>/': 'Get user by ID',
+            'GET /api/feed/': 'Recent activity in your rooms (supports ?before=<message_id>&limit=<n>)',
         },
         'Rooms': {
             'GET /api/rooms/': 'List all rooms (supports ?q=search&topic=filter)',
@@ -260,9 +555,14 @@ def getRoutes(request):
             'DELETE /api/rooms/<id>/': 'Delete room',
             'POST /api/rooms/<id>/join/': 'Join room',
             'POST /api/rooms/<id>/leave/': 'Leave room',
+            'GET /api/rooms/<id>/participants/': 'Room members in join order (paginated)',
+            'GET /api/rooms/<id>/history/': 'Room messages newest first, including archived ones',
+            'GET /api/rooms/unread/': 'Unread message counts for your rooms',
+            'POST /api/rooms/read/': 'Mark rooms as read',
         },
         'Topics': {
             'GET /api/topics/': 'List all topics',
+            'GET /api/topics/autocomplete/': 'Topic suggestions for a prefix, most rooms first (supports ?q=prefix&limit=<n>)',
             'POST /api/topics/': 'Create a new topic',
             'GET /api/topics/<id>/': 'Get topic details',
             'PUT /api/topics/<id>/': 'Update topic',
@@ -271,9 +571,13 @@ def getRoutes(request):
         'Messages': {
             'GET /api/messages/': 'List messages (supports ?room=<id>&user=<id>)',
             'POST /api/messages/': 'Create a new message',
+            'POST /api/messages/bulk/': 'Create many messages from a JSON array or JSONL stream',
             'GET /api/messages/<id>/': 'Get message details',
             'PUT /api/messages/<id>/': 'Update message',
             'DELETE /api/messages/<id>/': 'Delete message',
+        },
+        'Batch': {
+            'POST /api/batch/': 'Run several requests in one round trip ({"requests": [{"method", "path", "body"}]})',
         }
     }
     return Response(routes)
@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class BaseConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'base'
+
+    def ready(self):
+        # Connects the signals that keep the topic autocomplete index, the
+        # user record cache and feed previews current, and the message shards' cleanup
+        from . import feed, sharding, topic_index, users  # noqa: F401
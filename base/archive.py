@@ -0,0 +1,226 @@
+"""
+Hot/cold message storage.
+
+Messages older than MESSAGE_ARCHIVE_AFTER_DAYS are moved out of the Message
+table into ArchiveSegment rows: zlib-compressed JSON lines holding a run of
+consecutive sequence numbers from one room. Archiving always takes a room's
+oldest messages, so every archived seq is lower than every hot seq and
+history reads can page through hot storage first and fall back to the
+archive once it runs out. The page-numbered message list (?room=) and room
+detail list the archive after the hot messages through RoomHistory.
+
+Segments are append-only. Rehydrating moves the newest segment of a room back
+into Message, which keeps that invariant intact.
+
+With message shards, a room's hot messages are read and written on its shard
+while segments stay in `default`. Both transactions are open while a batch
+moves and the side that gains the messages commits first, so a failure in
+between leaves messages in both places (hidden from history, which reads the
+archive only below the oldest hot seq) rather than in neither.
+"""
+import json
+import zlib
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.functional import cached_property
+
+from . import sharding
+from .models import ArchiveSegment, Message, User
+
+
+def _encode(messages):
+    lines = (
+        json.dumps({
+            'id': m.id, 'user': m.user_id, 'body': m.body, 'seq': m.seq,
+            'created': m.created.isoformat(), 'updated': m.updated.isoformat(),
+        }, separators=(',', ':'))
+        for m in messages
+    )
+    return zlib.compress('\n'.join(lines).encode('utf8'))
+
+
+def _decode(segment):
+    for line in zlib.decompress(segment.data).decode('utf8').splitlines():
+        row = json.loads(line)
+        yield Message(
+            id=row['id'], room_id=segment.room_id, user_id=row['user'], body=row['body'], seq=row['seq'],
+            created=datetime.fromisoformat(row['created']), updated=datetime.fromisoformat(row['updated']),
+        )
+
+
+def archive_cutoff(days=None):
+    if days is None:
+        days = settings.MESSAGE_ARCHIVE_AFTER_DAYS
+    return timezone.now() - timedelta(days=days)
+
+
+def rooms_with_archivable_messages(cutoff, room_ids=None):
+    """Ids of the rooms (of `room_ids`, if given) with messages created before `cutoff`"""
+    old = Message.objects.filter(created__lt=cutoff)
+    if room_ids is not None:
+        old = old.filter(room_id__in=room_ids)
+    if not sharding.enabled():
+        return old.order_by().values_list('room_id', flat=True).distinct()
+    return sorted({
+        room_id
+        for alias in sharding.aliases()
+        for room_id in old.using(alias).order_by().values_list('room_id', flat=True).distinct()
+    })
+
+
+def archive_batch(room_id, cutoff, batch_size=None):
+    """
+    Move up to `batch_size` of the room's oldest messages created before
+    `cutoff` into a new segment. Returns the number of messages archived.
+    """
+    batch_size = batch_size or settings.MESSAGE_ARCHIVE_SEGMENT_SIZE
+    alias = sharding.shard_for_room(room_id)
+    hot = sharding.room_messages(room_id).filter(seq__isnull=False)
+    with transaction.atomic(using=alias), transaction.atomic(savepoint=False):
+        # Stop at the first recent message so the archive stays a prefix of the room
+        boundary = hot.filter(created__gte=cutoff).order_by('seq').values_list('seq', flat=True).first()
+        batch = hot.order_by('seq')
+        if boundary is not None:
+            batch = batch.filter(seq__lt=boundary)
+        messages = list(batch.filter(created__lt=cutoff)[:batch_size])
+        if not messages:
+            return 0
+
+        ArchiveSegment.objects.create(
+            room_id=room_id,
+            first_seq=messages[0].seq,
+            last_seq=messages[-1].seq,
+            message_count=len(messages),
+            first_created=messages[0].created,
+            last_created=messages[-1].created,
+            data=_encode(messages),
+        )
+        hot.filter(id__in=[m.id for m in messages]).delete()
+    return len(messages)
+
+
+def rehydrate_batch(room_id):
+    """Move the room's newest archive segment back into Message. Returns the segment's message count."""
+    alias = sharding.shard_for_room(room_id)
+    with transaction.atomic(), transaction.atomic(using=alias, savepoint=False):
+        segment = (
+            ArchiveSegment.objects.select_for_update()
+            .filter(room_id=room_id).order_by('-first_seq').first()
+        )
+        if segment is None:
+            return 0
+        messages = list(_decode(segment))
+        count = len(messages)
+        # Messages of users deleted since archiving were cascaded away in hot storage too
+        existing = set(User.objects.filter(id__in={m.user_id for m in messages}).values_list('id', flat=True))
+        messages = [m for m in messages if m.user_id in existing]
+        # bulk_create() stamps auto_now fields, so put the original times back afterwards
+        timestamps = [(m.created, m.updated) for m in messages]
+        Message.objects.using(alias).bulk_create(messages)
+        for message, (created, updated) in zip(messages, timestamps):
+            message.created, message.updated = created, updated
+        Message.objects.using(alias).bulk_update(messages, ['created', 'updated'], batch_size=500)
+        segment.delete()
+    return count
+
+
+def read_archive(room_id, before=None, limit=50):
+    """The newest `limit` archived messages of a room with seq below `before`, newest first"""
+    segments = ArchiveSegment.objects.filter(room_id=room_id).order_by('-first_seq')
+    if before is not None:
+        segments = segments.filter(first_seq__lt=before)
+
+    messages = []
+    for segment in segments.iterator(chunk_size=4):
+        rows = [m for m in _decode(segment) if before is None or m.seq < before]
+        messages.extend(reversed(rows))
+        if len(messages) >= limit:
+            break
+    return _with_users(messages[:limit])
+
+
+def _with_users(messages):
+    # Segments keep the author's id only; authors deleted since are dropped
+    users = User.objects.in_bulk({m.user_id for m in messages})
+    for message in messages:
+        message.user = users.get(message.user_id)
+    return [m for m in messages if m.user is not None]
+
+
+def get_history(room_id, before=None, limit=50):
+    """A room's messages with seq below `before`, newest first, from hot storage then the archive"""
+    hot = sharding.with_users(sharding.room_messages(room_id).filter(seq__isnull=False)).order_by('-seq')
+    if before is not None:
+        hot = hot.filter(seq__lt=before)
+    messages = list(hot[:limit])
+    if len(messages) < limit and ArchiveSegment.objects.filter(room_id=room_id).exists():
+        older_than = messages[-1].seq if messages else before
+        messages.extend(read_archive(room_id, before=older_than, limit=limit - len(messages)))
+    return messages
+
+
+class RoomHistory:
+    """
+    Every message of a room: `hot` (its Message queryset, in that queryset's
+    order) followed by the archived ones, newest first. Supports count(),
+    iteration and slicing for pagination; a slice decodes only the segments
+    it reaches into, found from their message counts.
+    """
+    ordered = True
+
+    def __init__(self, room_id, hot):
+        self.room_id = room_id
+        self.hot = hot
+
+    @cached_property
+    def hot_count(self):
+        return self.hot.count()
+
+    @cached_property
+    def segments(self):
+        # (id, message_count) newest first, without the data
+        return list(
+            ArchiveSegment.objects.filter(room_id=self.room_id).order_by('-first_seq').values_list('id', 'message_count')
+        )
+
+    def count(self):
+        return self.hot_count + sum(count for _, count in self.segments)
+
+    def __iter__(self):
+        yield from self.hot
+        yield from self._archived(0, None)
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self[index:index + 1][0]
+        start, stop = index.start or 0, index.stop
+        if start < 0 or (stop is not None and stop < 0) or index.step not in (None, 1):
+            raise ValueError('RoomHistory supports non-negative slices only')
+        messages = []
+        if start < self.hot_count:
+            messages.extend(self.hot[start:stop])
+        if stop is None or stop > self.hot_count:
+            messages.extend(self._archived(max(start - self.hot_count, 0), None if stop is None else stop - self.hot_count))
+        return messages
+
+    def _archived(self, start, stop):
+        """Archived messages `start` to `stop` counting from the newest"""
+        wanted, skipped, position = [], 0, 0
+        for segment_id, count in self.segments:
+            if stop is not None and position >= stop:
+                break
+            if position + count <= start:
+                # Entirely above the slice; skipped without decoding
+                skipped += count
+            else:
+                wanted.append(segment_id)
+            position += count
+        if not wanted:
+            return []
+        messages = []
+        for segment in ArchiveSegment.objects.filter(pk__in=wanted).order_by('-first_seq'):
+            messages.extend(reversed(list(_decode(segment))))
+        return _with_users(messages[start - skipped:None if stop is None else stop - skipped])
@@ -0,0 +1,151 @@
+"""
+Avatar processing pipeline.
+
+Uploaded avatars are decoded once with Pillow, stripped of metadata and
+rendered into a fixed set of square variants. Variant filenames embed a hash
+of the original upload, so a given URL never changes content and can be cached
+forever by browsers and CDNs.
+"""
+import hashlib
+import io
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, transaction
+from PIL import Image, ImageOps
+
+from . import users
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_AVATAR = 'avatar.svg'
+SMALL_VARIANT = (64, 'webp')
+
+_SAVE_OPTIONS = {
+    'webp': {'format': 'WEBP', 'quality': 80, 'method': 4},
+    'png': {'format': 'PNG', 'optimize': True},
+}
+
+_executor = None
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=settings.AVATAR_PROCESSING_WORKERS,
+            thread_name_prefix='avatar',
+        )
+    return _executor
+
+
+def variant_name(digest, size, fmt):
+    """Storage name of a processed variant"""
+    return f'avatars/{digest[:2]}/{digest}-{size}.{fmt}'
+
+
+def variant_url(user, size=SMALL_VARIANT[0], fmt=SMALL_VARIANT[1]):
+    """URL of a processed variant, falling back to the original upload"""
+    if user.avatar_hash:
+        return default_storage.url(variant_name(user.avatar_hash, size, fmt))
+    if user.avatar:
+        return user.avatar.url
+    return None
+
+
+def is_processable(name):
+    return bool(name) and name != DEFAULT_AVATAR and not name.lower().endswith('.svg')
+
+
+def _hash_file(fileobj):
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: fileobj.read(65536), b''):
+        digest.update(chunk)
+    fileobj.seek(0)
+    return digest.hexdigest()[:32]
+
+
+def _decode(fileobj, largest):
+    """
+    Decode an image with bounded memory.
+
+    JPEGs are decoded straight into a reduced scale via draft mode. Other
+    formats are decoded at full size, which AVATAR_MAX_PIXELS bounds, and
+    shrunk with reduce() before anything copies them: EXIF rotation and the
+    resize filters only ever run on the reduced image.
+    """
+    image = Image.open(fileobj)
+    width, height = image.size
+    if width * height > settings.AVATAR_MAX_PIXELS:
+        raise ValueError(f'Avatar is too large ({width}x{height})')
+
+    image.draft('RGB', (largest * 2, largest * 2))
+
+    # The shorter side decides the factor, so it is the same before and after rotation
+    factor = min(image.size) // (largest * 2)
+    if factor > 1:
+        image = image.reduce(factor)
+    image = ImageOps.exif_transpose(image)
+
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if image.has_transparency_data else 'RGB')
+    return image
+
+
+def render_variants(fileobj):
+    """Return {(size, fmt): bytes} for every configured variant"""
+    sizes = sorted(settings.AVATAR_VARIANT_SIZES, reverse=True)
+    image = _decode(fileobj, sizes[0])
+
+    variants = {}
+    for size in sizes:
+        # Resize from the previous (larger) variant to keep each step cheap
+        image = ImageOps.fit(image, (size, size), Image.Resampling.LANCZOS)
+        image.info = {}  # drop EXIF, ICC and text chunks
+        for fmt in settings.AVATAR_VARIANT_FORMATS:
+            buffer = io.BytesIO()
+            image.save(buffer, **_SAVE_OPTIONS[fmt])
+            variants[(size, fmt)] = buffer.getvalue()
+    return variants
+
+
+def process_avatar(user_id):
+    """Generate variants for a user's current avatar and record their hash"""
+    User = get_user_model()
+
+    user = User.objects.filter(pk=user_id).only('id', 'avatar', 'avatar_hash').first()
+    if user is None or not is_processable(user.avatar.name):
+        return None
+
+    original = user.avatar.name
+    with user.avatar.open('rb') as fileobj:
+        digest = _hash_file(fileobj)
+        if digest != user.avatar_hash:
+            for (size, fmt), content in render_variants(fileobj).items():
+                name = variant_name(digest, size, fmt)
+                if not default_storage.exists(name):
+                    default_storage.save(name, ContentFile(content))
+
+    # Only record the hash if the avatar was not replaced in the meantime
+    if User.objects.filter(pk=user_id, avatar=original).update(avatar_hash=digest):
+        users.forget(user_id)
+    return digest
+
+
+def _process_in_background(user_id):
+    try:
+        process_avatar(user_id)
+    except Exception:
+        logger.exception('Avatar processing failed for user %s', user_id)
+    finally:
+        close_old_connections()
+
+
+def schedule_avatar_processing(user):
+    """Process the user's avatar on a worker thread once the upload is committed"""
+    user_id = user.pk
+    transaction.on_commit(lambda: _get_executor().submit(_process_in_background, user_id))
@@ -0,0 +1,155 @@
+"""
+Helpers shared by the benchmark management commands.
+
+Results are plain dicts of {scenario: {metric: value}} so they can be written
+to and compared against a JSON baseline file.
+"""
+import asyncio
+import gc
+import json
+import math
+import os
+import resource
+import tracemalloc
+from pathlib import Path
+
+LATENCY_KEYS = ('p50_ms', 'p95_ms', 'p99_ms')
+
+
+def percentile(sorted_values, quantile):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(math.ceil(quantile * len(sorted_values)) - 1, 0)
+    return sorted_values[rank]
+
+
+def summarize(durations, wall_time=None):
+    """Latency percentiles (ms) and throughput for a list of durations in seconds"""
+    values = sorted(durations)
+    count = len(values)
+    total = wall_time if wall_time is not None else sum(values)
+    return {
+        'requests': count,
+        'throughput': round(count / total, 1) if total else 0.0,
+        'mean_ms': round(sum(values) / count * 1000, 3) if count else 0.0,
+        'p50_ms': round(percentile(values, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(values, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(values, 0.99) * 1000, 3),
+        'max_ms': round(values[-1] * 1000, 3) if values else 0.0,
+    }
+
+
+def process_usage(pid=None):
+    """
+    CPU seconds (user + system) and resident set size in bytes.
+
+    Reads /proc for other processes (Linux only); falls back to getrusage()
+    for the current process, in which case RSS is the peak rather than the
+    current value on platforms without /proc.
+    """
+    proc = Path(f'/proc/{pid or "self"}')
+    if proc.exists():
+        fields = (proc / 'stat').read_text().rsplit(')', 1)[1].split()
+        ticks = os.sysconf('SC_CLK_TCK')
+        cpu = (int(fields[11]) + int(fields[12])) / ticks
+        rss = int((proc / 'statm').read_text().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        return cpu, rss
+    if pid is not None:
+        raise OSError(f'Cannot read usage of process {pid} on this platform')
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime, usage.ru_maxrss * 1024
+
+
+async def idle_connection_bytes(application, paths):
+    """
+    Python heap bytes per connection held by idle WebSockets to `paths`.
+
+    Connections are opened in-process through channels' WebsocketCommunicator
+    and measured with tracemalloc, so the figure includes the communicator's
+    own queues and tasks (compare against a bare consumer to remove them) but
+    not a real server's sockets and buffers. They are closed afterwards.
+    """
+    from channels.testing import WebsocketCommunicator
+
+    # One connection first, so lazily built routes and caches are not counted
+    warm_up = WebsocketCommunicator(application, paths[0])
+    await warm_up.connect()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        communicators = []
+        for path in paths:
+            communicator = WebsocketCommunicator(application, path)
+            connected, _ = await communicator.connect()
+            if not connected:
+                raise ValueError(f'Connection to {path} was refused')
+            communicators.append(communicator)
+        # Let connect-time work that is not awaited (hub start, sweeper) settle
+        await asyncio.sleep(0)
+        gc.collect()
+        held = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    for communicator in communicators + [warm_up]:
+        await communicator.disconnect()
+    return held / len(paths)
+
+
+class QueryCounter:
+    """execute_wrapper counting the queries run while it is installed"""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def load_baseline(path):
+    return json.loads(Path(path).read_text())
+
+
+def save_baseline(path, results):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(results, indent=2, sort_keys=True) + '\n')
+
+
+def compare(results, baseline, tolerance, latency_keys=LATENCY_KEYS, exact_keys=(), slack=1.0):
+    """
+    Return a list of human-readable regressions.
+
+    Latency metrics may grow by `tolerance` (a fraction) and by at least
+    `slack` in absolute terms before they count as a regression, so timer
+    noise on sub-millisecond scenarios does not fail a run. `exact_keys`
+    (e.g. query counts) may not grow at all.
+    """
+    regressions = []
+    for scenario, current in results.items():
+        previous = baseline.get(scenario)
+        if previous is None:
+            continue
+        for key in latency_keys:
+            allowed = max(previous.get(key, 0) * (1 + tolerance), previous.get(key, 0) + slack)
+            if key in previous and current.get(key, 0) > allowed:
+                regressions.append(
+                    f'{scenario}: {key} {current[key]} > {previous[key]} (+{tolerance:.0%} allowed)'
+                )
+        for key in exact_keys:
+            if key in previous and current.get(key, 0) > previous[key]:
+                regressions.append(f'{scenario}: {key} {current[key]} > {previous[key]}')
+    return regressions
+
+
+def format_table(results, columns, label='scenario'):
+    """Render {row: {column: value}} as a fixed-width text table"""
+    header = [label] + list(columns)
+    rows = [[name] + [str(values.get(column, '')) for column in columns] for name, values in results.items()]
+    widths = [max(len(row[i]) for row in [header] + rows) for i in range(len(header))]
+    lines = ['  '.join(cell.ljust(width) for cell, width in zip(header, widths))]
+    lines.append('  '.join('-' * width for width in widths))
+    lines.extend('  '.join(cell.ljust(width) for cell, width in zip(row, widths)) for row in rows)
+    return '\n'.join(lines)
@@ -1,69 +1,147 @@
+import asyncio
 import json
+import logging
+import time
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from .models import Room, Message
+from .models import Room, Message, ReadMarker
+from .ratelimit import BucketMap, TokenBucket
+from . import feed, log, metrics, room_events, sockets, wire
 
 User = get_user_model()
+logger = logging.getLogger(__name__)
 
+_user_buckets = None
 
-class ChatConsumer(AsyncWebsocketConsumer):
-    async def connect(self):
-        self.room_id = self.scope['url_route']['kwargs']['room_id']
-        self.room_group_name = f'chat_{self.room_id}'
-        
-        # Join room group
-        await self.channel_layer.group_add(
-            self.room_group_name,
-            self.channel_name
-        )
-        
-        await self.accept()
+
+def user_buckets():
+    """Per-user (or, for anonymous connections, per-address) buckets shared by every connection in this process"""
+    global _user_buckets
+    if _user_buckets is None or (_user_buckets.rate, _user_buckets.capacity) != (settings.WS_USER_RATE, settings.WS_USER_BURST):
+        _user_buckets = BucketMap(settings.WS_USER_RATE, settings.WS_USER_BURST)
+    return _user_buckets
+
+
+def frame_too_large(frame, limit):
+    # A str of n characters is at most 4n bytes of UTF-8, so most frames are sized without encoding
+    if len(frame) > limit:
+        return True
+    return isinstance(frame, str) and len(frame) * 4 > limit and len(frame.encode()) > limit
+
+
+def as_room_id(value):
+    """The integer room id in a client frame, or None"""
+    if isinstance(value, bool):
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class LimitedConsumer(AsyncWebsocketConsumer):
+    """
+    Inbound frame limits and message saving shared by the chat consumers.
+    Chat events reach them through the per-room hubs in base/sockets.py, so
+    they hold no channel layer channel of their own.
+    """
+    channel_layer_alias = None
+    state = None
+    
+    async def start(self, user_key, codec):
+        # Anonymous connections share a bucket per client address; a user id
+        # sent in frames is the client's own claim and never picks the bucket
+        client = self.scope.get('client')
+        self.state = sockets.ConnectionState(user_key, codec, ('address', client[0]) if client else None)
+        # Every handler of this connection runs in the same task, so the id sticks to its log records
+        log.connection_id.set(self.state.connection_id)
+        sockets.register(self)
+    
+    async def release(self):
+        """Leave every room; safe to call more than once"""
+        sockets.unregister(self)
     
     async def disconnect(self, close_code):
-        # Leave room group
-        await self.channel_layer.group_discard(
-            self.room_group_name,
-            self.channel_name
-        )
+        if self.state is not None:
+            await self.release()
     
-    async def receive(self, text_data):
-        data = json.loads(text_data)
-        message_type = data.get('type', 'message')
+    async def reject(self, reason, retry_after=None):
+        """Apply WS_LIMIT_ACTION to a frame that broke a limit"""
+        metrics.WS_FRAMES_REJECTED.labels(reason).inc()
+        action = settings.WS_LIMIT_ACTION
+        if action == 'close':
+            metrics.WS_LIMIT_CLOSES.inc()
+            logger.warning('Closing WebSocket %s: %s', self.scope['path'], reason)
+            await self.close(code=settings.WS_LIMIT_CLOSE_CODE)
+        elif action == 'warn':
+            # At most one warning a second, so a flood is not echoed back frame for frame
+            now = time.monotonic()
+            if now - self.state.last_warning >= 1:
+                self.state.last_warning = now
+                await self.send_frame(self.state.codec.encode_error(reason, retry_after))
+    
+    async def send_frame(self, frame):
+        self.state.last_active = time.monotonic()
+        if isinstance(frame, bytes):
+            await self.send(bytes_data=frame)
+        else:
+            await self.send(text_data=frame)
+    
+    async def read_frame(self, text_data, bytes_data):
+        """The decoded frame, or None once a frame that broke a limit has been rejected"""
+        metrics.WS_MESSAGES_RECEIVED.inc()
+        state = self.state
+        state.last_active = time.monotonic()
+        frame = text_data if text_data is not None else bytes_data
         
-        if message_type == 'message':
-            message_body = data['message']
-            user_id = data['user_id']
-            
-            # Save message to database
-            message = await self.save_message(user_id, self.room_id, message_body)
-            
-            # Send message to room group
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'chat_message',
-                    'message': message_body,
-                    'user_id': user_id,
-                    'username': message['username'],
-                    'created': message['created'],
-                    'message_id': message['id']
-                }
-            )
-    
-    async def chat_message(self, event):
-        # Send message to WebSocket
-        await self.send(text_data=json.dumps({
-            'type': 'message',
-            'message': event['message'],
-            'user_id': event['user_id'],
-            'username': event['username'],
-            'created': event['created'],
-            'message_id': event['message_id']
-        }))
+        # Cheapest checks first: nothing is parsed for oversized or rate-limited frames
+        if frame is None or frame_too_large(frame, settings.WS_MAX_FRAME_BYTES):
+            return await self.reject('frame_too_large')
+        if state.bucket is None:
+            state.bucket = TokenBucket(settings.WS_CONNECTION_RATE, settings.WS_CONNECTION_BURST)
+        if not state.bucket.take():
+            return await self.reject('connection_rate', state.bucket.retry_after())
+        try:
+            data = state.codec.decode(frame)
+        except ValueError:
+            return await self.reject('malformed')
+        if not isinstance(data, dict):
+            return await self.reject('malformed')
+        if state.rate_key is not None:
+            bucket = user_buckets().get(state.rate_key)
+            if not bucket.take():
+                return await self.reject('user_rate', bucket.retry_after())
+        return data
+    
+    async def broadcast(self, room_id, user_id, body, received):
+        """Save a chat message and send it to everyone subscribed to its room"""
+        message = await self.save_message(user_id, room_id, body, queued_at=time.perf_counter())
+        await sockets.publish(
+            room_id,
+            {
+                'type': 'chat_message',
+                'room': int(room_id),
+                'message': body,
+                'user_id': user_id,
+                'username': message['username'],
+                'created': message['created'],
+                'created_ms': message['created_ms'],
+                'message_id': message['id'],
+                'seq': message['seq'],
+                'sent_at': time.time()
+            }
+        )
+        metrics.WS_RECEIVE_TO_BROADCAST.observe(time.perf_counter() - received)
     
     @database_sync_to_async
-    def save_message(self, user_id, room_id, body):
+    def save_message(self, user_id, room_id, body, queued_at=None):
+        started = time.perf_counter()
+        if queued_at is not None:
+            metrics.WS_SAVE_QUEUE_WAIT.observe(started - queued_at)
+        
         user = User.objects.get(id=user_id)
         room = Room.objects.get(id=room_id)
         message = Message.objects.create(user=user, room=room, body=body)
@@ -71,9 +149,185 @@ class ChatConsumer(AsyncWebsocketConsumer):
         # Add user to room participants if not already
         if user not in room.participants.all():
             room.participants.add(user)
+        ReadMarker.advance(user.id, room.id, message.seq)
+        feed.publish_message(message)
+        room_events.counts_changed(room)
         
+        metrics.WS_SAVE_DURATION.observe(time.perf_counter() - started)
         return {
             'id': message.id,
+            'seq': message.seq,
             'username': user.username,
-            'created': message.created.isoformat()
+            'created': message.created.isoformat(),
+            'created_ms': wire.epoch_ms(message.created)
         }
+
+
+class ChatConsumer(LimitedConsumer):
+    async def connect(self):
+        self.room_id = self.scope['url_route']['kwargs']['room_id']
+        user = self.scope.get('user')
+        codec = wire.negotiate(self.scope.get('subprotocols', ()))
+        await self.start(user.pk if user is not None and user.is_authenticated else None, codec)
+        metrics.WS_CONNECTS.inc()
+        metrics.WS_CONNECTIONS.inc()
+        
+        await sockets.join(self.room_id, self)
+        await self.accept(codec.subprotocol)
+        logger.info('WebSocket connected to room %s', self.room_id)
+    
+    async def release(self):
+        await super().release()
+        await sockets.leave(self.room_id, self)
+    
+    async def disconnect(self, close_code):
+        if self.state is not None:
+            metrics.WS_CONNECTIONS.dec()
+            logger.info('WebSocket disconnected from room %s (code %s)', self.room_id, close_code)
+        await super().disconnect(close_code)
+    
+    async def receive(self, text_data=None, bytes_data=None):
+        received = time.perf_counter()
+        data = await self.read_frame(text_data, bytes_data)
+        if data is None:
+            return
+        message_type = data.get('type', 'message')
+        
+        if message_type == 'message':
+            message_body = data.get('message')
+            user_id = data.get('user_id')
+            if not isinstance(message_body, str) or user_id is None:
+                return await self.reject('malformed')
+            if len(message_body) > settings.WS_MAX_MESSAGE_LENGTH:
+                return await self.reject('message_too_long')
+            await self.broadcast(self.room_id, user_id, message_body, received)
+
+
+class MultiplexConsumer(LimitedConsumer):
+    """
+    One connection for many rooms. Clients send {"type": "subscribe" |
+    "unsubscribe", "room": id} to pick the rooms they hear from and
+    {"type": "message", "room": id, "message": ...} to post; every event
+    carries its room. Only members of a room may subscribe to it, so the
+    connection must be authenticated. JSON frames only.
+    """
+    rooms = ()
+    
+    async def connect(self):
+        user = self.scope.get('user')
+        if user is None or not user.is_authenticated:
+            await self.close()
+            return
+        await self.start(user.pk, wire.JSON)
+        self.rooms = set()
+        metrics.WS_CONNECTS.inc()
+        metrics.WS_MULTIPLEX_CONNECTIONS.inc()
+        await self.accept()
+        logger.info('Multiplexed WebSocket connected for user %s', self.state.user_key)
+    
+    async def release(self):
+        await super().release()
+        rooms, self.rooms = self.rooms, set()
+        metrics.WS_SUBSCRIPTIONS.dec(len(rooms))
+        for room_id in rooms:
+            await sockets.leave(room_id, self)
+    
+    async def disconnect(self, close_code):
+        if self.state is not None:
+            metrics.WS_MULTIPLEX_CONNECTIONS.dec()
+            logger.info('Multiplexed WebSocket disconnected (code %s, %d rooms)', close_code, len(self.rooms))
+        await super().disconnect(close_code)
+    
+    async def send_event(self, payload):
+        await self.send_frame(json.dumps(payload))
+    
+    async def receive(self, text_data=None, bytes_data=None):
+        received = time.perf_counter()
+        data = await self.read_frame(text_data, bytes_data)
+        if data is None:
+            return
+        message_type = data.get('type', 'message')
+        room_id = as_room_id(data.get('room'))
+        if room_id is None or message_type not in ('subscribe', 'unsubscribe', 'message'):
+            return await self.reject('malformed')
+        
+        if message_type == 'subscribe':
+            await self.subscribe(room_id)
+        elif message_type == 'unsubscribe':
+            if room_id in self.rooms:
+                self.rooms.discard(room_id)
+                metrics.WS_SUBSCRIPTIONS.dec()
+                await sockets.leave(room_id, self)
+            await self.send_event({'type': 'unsubscribed', 'room': room_id})
+        else:
+            message_body = data.get('message')
+            if not isinstance(message_body, str):
+                return await self.reject('malformed')
+            if len(message_body) > settings.WS_MAX_MESSAGE_LENGTH:
+                return await self.reject('message_too_long')
+            if room_id not in self.rooms:
+                return await self.send_event({'type': 'error', 'code': 'not_subscribed', 'room': room_id})
+            await self.broadcast(room_id, self.state.user_key, message_body, received)
+    
+    async def subscribe(self, room_id):
+        if room_id not in self.rooms:
+            if len(self.rooms) >= settings.WS_MAX_SUBSCRIPTIONS:
+                return await self.send_event({'type': 'error', 'code': 'too_many_subscriptions', 'room': room_id})
+            if not await self.is_member(room_id):
+                return await self.send_event({'type': 'error', 'code': 'not_a_member', 'room': room_id})
+            self.rooms.add(room_id)
+            metrics.WS_SUBSCRIPTIONS.inc()
+            await sockets.join(room_id, self)
+        await self.send_event({'type': 'subscribed', 'room': room_id})
+    
+    @database_sync_to_async
+    def is_member(self, room_id):
+        return Room.participants.through.objects.filter(room_id=room_id, user_id=self.state.user_key).exists()
+
+
+class RoomListConsumer(AsyncWebsocketConsumer):
+    """Pushes room list deltas (see base/room_events.py), optionally for one topic via ?topic=<id>"""
+
+    async def connect(self):
+        self.connection_id = log.new_id()
+        log.connection_id.set(self.connection_id)
+        topic = parse_qs(self.scope.get('query_string', b'').decode()).get('topic', [''])[0]
+        if topic and not topic.isdigit():
+            await self.close()
+            return
+        self.group_name = room_events.topic_group(topic) if topic else room_events.ALL_GROUP
+        self.pending = {}
+        self.flush_task = None
+        metrics.ROOM_LIST_CONNECTIONS.inc()
+        
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await self.accept()
+        logger.info('Room list WebSocket connected to %s', self.group_name)
+    
+    async def disconnect(self, close_code):
+        if not hasattr(self, 'group_name'):
+            return
+        metrics.ROOM_LIST_CONNECTIONS.dec()
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+        await self.channel_layer.group_discard(self.group_name, self.channel_name)
+        logger.info('Room list WebSocket disconnected from %s (code %s)', self.group_name, close_code)
+    
+    async def receive(self, text_data=None, bytes_data=None):
+        # Subscribers only listen; the topic is fixed when connecting
+        pass
+    
+    async def room_event(self, event):
+        metrics.ROOM_LIST_EVENTS.inc()
+        room_events.merge(self.pending, event['event'])
+        if self.flush_task is None:
+            self.flush_task = asyncio.ensure_future(self.flush_later())
+    
+    async def flush_later(self):
+        """Send everything merged during the window as one frame"""
+        await asyncio.sleep(settings.ROOM_LIST_WINDOW)
+        events, self.pending, self.flush_task = list(self.pending.values()), {}, None
+        if any('changed' in event for event in events):
+            events = await database_sync_to_async(room_events.fill_counts)(events)
+        await self.send(text_data=json.dumps({'type': 'rooms', 'events': events}))
+        metrics.ROOM_LIST_FRAMES.inc()
@@ -0,0 +1,142 @@
+"""
+Personalized activity feeds.
+
+New messages are appended to the feed of every other member of the room
+(fan-out-on-write), so reading a feed is a single indexed range scan. Rooms
+with more than FEED_FANOUT_MAX_RECIPIENTS members are skipped on write and
+merged in at read time instead (fan-out-on-read), which keeps one message in a
+huge room from turning into thousands of inserts.
+
+Feed entries copy the message preview and refer to the message by id only,
+since messages may live on shard databases. Editing a message updates its
+entries through the receiver below. Deleting one goes through
+remove_messages(), which the API and admin call; deleting a room or user
+takes its entries along by cascade. Nothing listens for Message deletes, so
+Django still deletes a room's messages with one query instead of loading
+each of them.
+"""
+import heapq
+from dataclasses import dataclass
+from datetime import datetime
+
+from django.conf import settings
+from django.db.models import Count, F, Window
+from django.db.models.functions import RowNumber
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from . import sharding
+from .models import FeedEntry, Message, Room, User
+
+Membership = Room.participants.through
+
+
+@dataclass
+class FeedItem:
+    message_id: int
+    room_id: int
+    room_name: str
+    user: User
+    body: str
+    created: datetime
+
+
+def _preview(body):
+    return body[:FeedEntry._meta.get_field('preview').max_length]
+
+
+def publish_message(message):
+    """Append a new message to its room members' feeds"""
+    limit = settings.FEED_FANOUT_MAX_RECIPIENTS
+    # Counted like large_room_ids() counts them, so a room is either pushed or pulled
+    members = list(Membership.objects.filter(room_id=message.room_id).values_list('user_id', flat=True)[:limit + 1])
+    recipients = [user_id for user_id in members if user_id != message.user_id]
+    if not recipients or len(members) > limit:
+        return
+
+    preview = _preview(message.body)
+    FeedEntry.objects.bulk_create([
+        FeedEntry(
+            owner_id=user_id, room_id=message.room_id, author_id=message.user_id,
+            message_id=message.id, preview=preview, created=message.created,
+        )
+        for user_id in recipients
+    ])
+
+    # Trimming is amortized: each feed is cut back to FEED_MAX_LENGTH roughly
+    # once every FEED_TRIM_INTERVAL messages instead of on every insert
+    if message.id % settings.FEED_TRIM_INTERVAL == 0:
+        trim_feeds(recipients)
+
+
+@receiver(post_save, sender=Message, dispatch_uid='feed_message_saved')
+def message_saved(sender, instance, created, update_fields=None, **kwargs):
+    if created or (update_fields is not None and 'body' not in update_fields):
+        return
+    FeedEntry.objects.filter(message_id=instance.pk).update(preview=_preview(instance.body))
+
+
+def remove_messages(message_ids):
+    """Take deleted messages out of every feed"""
+    return FeedEntry.objects.filter(message_id__in=message_ids).delete()[0]
+
+
+def trim_feeds(user_ids):
+    """Delete all but the newest FEED_MAX_LENGTH entries of each user's feed"""
+    overflow = (
+        FeedEntry.objects.filter(owner_id__in=user_ids)
+        .annotate(rank=Window(RowNumber(), partition_by=F('owner_id'), order_by=F('message_id').desc()))
+        .filter(rank__gt=settings.FEED_MAX_LENGTH)
+        .values_list('id', flat=True)
+    )
+    return FeedEntry.objects.filter(id__in=list(overflow)).delete()[0]
+
+
+def large_room_ids(user):
+    """Rooms of `user` that are read with fan-out-on-read"""
+    return list(
+        Membership.objects.filter(room__in=Room.objects.filter(participants=user))
+        .values('room_id')
+        .annotate(members=Count('id'))
+        .filter(members__gt=settings.FEED_FANOUT_MAX_RECIPIENTS)
+        .values_list('room_id', flat=True)
+    )
+
+
+def get_feed(user, before=None, limit=20):
+    """
+    The newest `limit` feed items older than message id `before`.
+
+    Pushed entries and messages pulled from large rooms are merged by message
+    id, which is also the pagination cursor.
+    """
+    entries = FeedEntry.objects.filter(owner=user).select_related('room', 'author').order_by('-message_id')
+    if before is not None:
+        entries = entries.filter(message_id__lt=before)
+    pushed = [
+        FeedItem(e.message_id, e.room_id, e.room.name, e.author, e.preview, e.created)
+        for e in entries[:limit]
+    ]
+
+    pulled = []
+    rooms = large_room_ids(user)
+    if rooms:
+        messages = Message.objects.filter(room_id__in=rooms).exclude(user=user)
+        if before is not None:
+            messages = messages.filter(id__lt=before)
+        if sharding.enabled():
+            messages = sharding.ShardedQuery(messages, ordering=('-id',), prefetch=('room', 'user'))
+        else:
+            messages = messages.select_related('room', 'user').order_by('-id')
+        pulled = [
+            FeedItem(m.id, m.room_id, m.room.name, m.user, _preview(m.body), m.created)
+            for m in messages[:limit]
+        ]
+
+    merged = heapq.merge(pushed, pulled, key=lambda item: item.message_id, reverse=True)
+    # A room that grew past the fan-out limit has both pushed and pulled copies of older messages
+    items = []
+    for item in merged:
+        if not items or items[-1].message_id != item.message_id:
+            items.append(item)
+    return items[:limit]
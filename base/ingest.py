@@ -0,0 +1,229 @@
+"""
+Bulk message ingestion for bots, importers and migrations.
+
+ingest() consumes any iterable of message dicts ({"room", "body"} plus, when
+allowed, "user" and "created"), so a JSON array and a JSONL stream are handled
+the same way. Items are validated one chunk at a time with one query each for
+the referenced rooms and users. Each chunk is then written in its own
+transaction:
+  - sequence numbers are reserved per room with one allocate_seq() call
+  - messages go in through one executemany() of a prepared INSERT, which
+    skips model instances entirely (so no Message signals fire) and lets
+    imported history keep its original timestamps
+  - authors who are not yet members are added with one bulk INSERT, and
+    get a read marker at their last message in the chunk with another
+
+With message shards, each chunk's messages go to their rooms' shards, one
+transaction per shard, after `default` has reserved their sequence numbers.
+
+Invalid items are reported by index and skipped; they never fail their chunk.
+Messages are sequenced in input order within each room. Once a chunk is
+written, room list subscribers get one counts event per room it touched;
+ingested messages themselves are not fanned out to activity feeds or chat
+WebSocket subscribers.
+"""
+import json
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.db import DatabaseError, connection, connections, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import room_events, sharding
+from .models import Message, ReadMarker, Room, User
+
+Membership = Room.participants.through
+
+
+class InvalidLine:
+    """Stands in for a JSONL line that could not be parsed, so it is reported with its index"""
+
+    def __init__(self, error):
+        self.error = error
+
+
+def read_jsonl(lines):
+    """Yield one item per non-blank line of a JSONL stream (bytes or str lines)"""
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as exc:
+            yield InvalidLine(str(exc))
+
+
+# Ids are 64-bit integer columns; larger ones cannot even be looked up
+MAX_ID = 2 ** 63 - 1
+
+
+def _as_id(value):
+    if isinstance(value, bool):
+        raise ValueError
+    value = int(value)
+    if not -MAX_ID <= value <= MAX_ID:
+        raise ValueError
+    return value
+
+
+class Item:
+    __slots__ = ('room_id', 'user_id', 'body', 'created')
+
+
+def _clean(item, default_user_id, trusted):
+    """(Item, None) or (None, errors) for one item, checking everything but existence"""
+    if isinstance(item, InvalidLine):
+        return None, {'non_field_errors': [f'Invalid JSON: {item.error}']}
+    if not isinstance(item, dict):
+        return None, {'non_field_errors': ['Expected an object.']}
+
+    errors = {}
+    message = Item()
+    try:
+        message.room_id = _as_id(item.get('room'))
+    except (TypeError, ValueError):
+        errors['room'] = ['A valid integer is required.']
+
+    body = item.get('body')
+    if not isinstance(body, str) or not body.strip():
+        errors['body'] = ['This field may not be blank.']
+    message.body = body
+
+    if 'user' in item and not trusted:
+        errors['user'] = ['Only staff can post as another user.']
+    user_id = item.get('user', default_user_id)
+    try:
+        message.user_id = _as_id(user_id)
+    except (TypeError, ValueError):
+        errors.setdefault('user', ['This field is required.' if user_id is None else 'A valid integer is required.'])
+
+    message.created = None
+    if item.get('created') is not None:
+        try:
+            created = parse_datetime(item['created']) if isinstance(item['created'], str) else None
+        except ValueError:
+            # Well formed but impossible, such as February 30
+            created = None
+        if not trusted:
+            errors['created'] = ['Only staff can set created.']
+        elif created is None:
+            errors['created'] = ['Expected an ISO 8601 datetime.']
+        else:
+            message.created = created if timezone.is_aware(created) else timezone.make_aware(created)
+    return (None, errors) if errors else (message, None)
+
+
+def _insert_sql(model, field_names):
+    quote = connection.ops.quote_name
+    columns = ', '.join(quote(model._meta.get_field(name).column) for name in field_names)
+    placeholders = ', '.join(['%s'] * len(field_names))
+    return f'INSERT INTO {quote(model._meta.db_table)} ({columns}) VALUES ({placeholders})'
+
+
+def _write(messages):
+    adapt = connection.ops.adapt_datetimefield_value
+    now = adapt(timezone.now())
+    fields = ('user', 'room', 'body', 'seq', 'created', 'updated')
+    if sharding.enabled():
+        # Shards cannot number rows themselves without colliding with each other
+        fields += ('id',)
+    counts = Counter(m.room_id for m in messages)
+    with transaction.atomic():
+        if sharding.enabled():
+            next_seq = sharding.reserve_seqs(counts)
+        else:
+            next_seq = {room_id: Room.allocate_seq(room_id, count) for room_id, count in counts.items()}
+        rows = defaultdict(list)
+        last_seq = {}
+        for message in messages:
+            alias = sharding.shard_for_room(message.room_id)
+            created = adapt(message.created) if message.created is not None else now
+            row = (message.user_id, message.room_id, message.body, next_seq[message.room_id], created, created)
+            rows[alias].append(row + (sharding.make_id(alias),) if sharding.enabled() else row)
+            last_seq[message.room_id, message.user_id] = next_seq[message.room_id]
+            next_seq[message.room_id] += 1
+        for alias, alias_rows in rows.items():
+            with transaction.atomic(using=alias, savepoint=False), connections[alias].cursor() as cursor:
+                cursor.executemany(_insert_sql(Message, fields), alias_rows)
+
+        pairs = {(m.room_id, m.user_id) for m in messages}
+        existing = set(
+            Membership.objects.filter(room_id__in={room_id for room_id, _ in pairs}, user_id__in={user_id for _, user_id in pairs})
+            .values_list('room_id', 'user_id')
+        )
+        joined = pairs - existing
+        Membership.objects.bulk_create(
+            [Membership(room_id=room_id, user_id=user_id) for room_id, user_id in joined],
+            ignore_conflicts=True,
+        )
+        # As for members who join by posting one message: read up to their own
+        ReadMarker.objects.bulk_create(
+            [ReadMarker(room_id=room_id, user_id=user_id, last_read_seq=last_seq[room_id, user_id])
+             for room_id, user_id in joined],
+            ignore_conflicts=True,
+        )
+
+
+def _ingest_chunk(chunk, result, default_user_id, trusted):
+    valid = []
+    for index, item in chunk:
+        message, errors = _clean(item, default_user_id, trusted)
+        if errors:
+            result['errors'].append({'index': index, 'errors': errors})
+        else:
+            valid.append((index, message))
+
+    rooms = Room.objects.only('id', 'topic_id').in_bulk({m.room_id for _, m in valid})
+    users = set(User.objects.filter(id__in={m.user_id for _, m in valid}).values_list('id', flat=True))
+    messages = []
+    for index, message in valid:
+        errors = {}
+        if message.room_id not in rooms:
+            errors['room'] = [f'Room {message.room_id} does not exist.']
+        if message.user_id not in users:
+            errors['user'] = [f'User {message.user_id} does not exist.']
+        if errors:
+            result['errors'].append({'index': index, 'errors': errors})
+        else:
+            messages.append((index, message))
+    if not messages:
+        return
+
+    try:
+        _write([message for _, message in messages])
+    except DatabaseError as exc:
+        result['errors'].extend(
+            {'index': index, 'errors': {'non_field_errors': [f'Database error: {exc}']}} for index, _ in messages
+        )
+        return
+    result['created'] += len(messages)
+    for room_id in {message.room_id for _, message in messages}:
+        room_events.counts_changed(rooms[room_id])
+
+
+def ingest(items, default_user_id=None, trusted=False, chunk_size=None, max_items=None):
+    """
+    Validate and insert `items` chunk by chunk. `trusted` callers may set each
+    message's user and created time; others post as `default_user_id`.
+    Returns {'created', 'failed', 'errors': [{'index', 'errors'}]}.
+    """
+    chunk_size = chunk_size or settings.INGEST_CHUNK_SIZE
+    result = {'created': 0, 'failed': 0, 'errors': []}
+    chunk = []
+    for index, item in enumerate(items):
+        if max_items is not None and index >= max_items:
+            result['errors'].append({
+                'index': index, 'errors': {'non_field_errors': [f'Too many items; at most {max_items} are accepted.']},
+            })
+            break
+        chunk.append((index, item))
+        if len(chunk) >= chunk_size:
+            _ingest_chunk(chunk, result, default_user_id, trusted)
+            chunk = []
+    if chunk:
+        _ingest_chunk(chunk, result, default_user_id, trusted)
+
+    result['errors'].sort(key=lambda error: error['index'])
+    result['failed'] = len(result['errors'])
+    return result
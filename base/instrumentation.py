@@ -0,0 +1,106 @@
+"""
+Per-request performance instrumentation.
+
+A RequestProfile is bound to a context variable for the lifetime of a request
+by RequestInstrumentationMiddleware. Code that wants to report timings calls
+span() or the serializer mixin below; when no profile is active (the
+middleware is disabled) both are a single context variable lookup.
+"""
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+_current_profile = ContextVar('request_profile', default=None)
+
+
+class RequestProfile:
+    __slots__ = ('started', 'query_count', 'db_time', 'spans', 'statements', 'serializer_depth')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.query_count = 0
+        self.db_time = 0.0
+        self.spans = {}
+        self.statements = Counter()
+        self.serializer_depth = 0
+
+    def add_span(self, name, duration):
+        self.spans[name] = self.spans.get(name, 0.0) + duration
+
+    def record_query(self, sql, duration):
+        self.query_count += 1
+        self.db_time += duration
+        self.statements[sql] += 1
+
+    def repeated_queries(self, threshold):
+        """Statements executed at least `threshold` times (likely N+1s)"""
+        return [(sql, count) for sql, count in self.statements.most_common() if count >= threshold]
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+
+def current_profile():
+    return _current_profile.get()
+
+
+def activate(profile):
+    return _current_profile.set(profile)
+
+
+def deactivate(token):
+    _current_profile.reset(token)
+
+
+@contextmanager
+def span(name):
+    """Add the time spent in the block to the current request's `name` span"""
+    profile = _current_profile.get()
+    if profile is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add_span(name, time.perf_counter() - start)
+
+
+class QueryRecorder:
+    """connection.execute_wrapper() hook feeding a RequestProfile"""
+
+    def __init__(self, profile):
+        self.profile = profile
+
+    def __call__(self, execute, sql, params, many, context):
+        if _current_profile.get() is not self.profile:
+            # A request handled inside this one (a batch item) records its own queries
+            return execute(sql, params, many, context)
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.profile.record_query(sql, time.perf_counter() - start)
+
+
+class InstrumentedSerializerMixin:
+    """
+    Times to_representation() of top-level serializer objects.
+
+    Nested serializers run inside their parent's span and are not counted
+    twice.
+    """
+
+    def to_representation(self, instance):
+        profile = _current_profile.get()
+        if profile is None or profile.serializer_depth:
+            return super().to_representation(instance)
+        profile.serializer_depth += 1
+        start = time.perf_counter()
+        try:
+            return super().to_representation(instance)
+        finally:
+            profile.serializer_depth -= 1
+            profile.add_span('serialize', time.perf_counter() - start)
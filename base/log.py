@@ -0,0 +1,220 @@
+"""
+Non-blocking logging.
+
+BackgroundHandler is a QueueHandler: the logging call formats the record
+(adding the current request/connection id) and puts the line on a bounded
+queue. A writer thread drains the queue in batches and writes each batch with
+a single write() to a size-rotated file or a stream.
+When the queue is full records are dropped and counted instead of blocking
+the caller.
+
+SamplingFilter rate-limits records below WARNING per logger, and JsonFormatter
+renders one JSON object per line including any `extra` fields.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+import uuid
+from contextvars import ContextVar
+from datetime import datetime, timezone
+
+from .metrics import REGISTRY
+
+request_id = ContextVar('request_id', default=None)
+connection_id = ContextVar('connection_id', default=None)
+
+LOG_RECORDS_DROPPED = REGISTRY.counter(
+    'studybud_log_records_dropped_total', 'Log records discarded before being written', ('reason',))
+
+_STOP = object()
+# Attributes every LogRecord has; anything else was passed through `extra`
+_STANDARD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', '_sampled'}
+
+
+def new_id():
+    return uuid.uuid4().hex
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record: ts, level, logger, msg, ids, extra fields and exc"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _STANDARD_ATTRS and value is not None:
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Lets through at most `rate` records per second (bursts up to `burst`) per
+    logger for levels below `min_level`. The next record that passes carries a
+    `sampled_out` count of what was dropped in between.
+    """
+
+    def __init__(self, rate=50, burst=200, min_level='WARNING'):
+        super().__init__()
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.min_level = logging.getLevelName(min_level) if isinstance(min_level, str) else min_level
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= self.min_level:
+            return True
+        # Handlers sharing this filter must agree on each record
+        decision = getattr(record, '_sampled', None)
+        if decision is not None:
+            return decision
+        record._sampled = self.sample(record)
+        return record._sampled
+
+    def sample(self, record):
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated, dropped = self.buckets.get(record.name, (self.burst, now, 0))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens < 1:
+                self.buckets[record.name] = (tokens, now, dropped + 1)
+                LOG_RECORDS_DROPPED.labels('sampled').inc()
+                return False
+            self.buckets[record.name] = (tokens - 1, now, 0)
+        if dropped:
+            record.sampled_out = dropped
+        return True
+
+
+class RotatingFile:
+    """An append-only file rotated to .1, .2, ... once it would exceed max_bytes"""
+
+    def __init__(self, filename, max_bytes, backup_count):
+        self.filename = os.path.abspath(filename)
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        self.stream = open(self.filename, 'ab')
+        self.size = self.stream.tell()
+
+    def write(self, data):
+        if self.max_bytes and self.size and self.size + len(data) > self.max_bytes:
+            self.rotate()
+        self.stream.write(data)
+        self.stream.flush()
+        self.size += len(data)
+
+    def rotate(self):
+        self.stream.close()
+        if self.backup_count:
+            for index in range(self.backup_count - 1, 0, -1):
+                source = f'{self.filename}.{index}'
+                if os.path.exists(source):
+                    os.replace(source, f'{self.filename}.{index + 1}')
+            os.replace(self.filename, f'{self.filename}.1')
+        else:
+            os.truncate(self.filename, 0)
+        self.stream = open(self.filename, 'ab')
+        self.size = 0
+
+    def close(self):
+        self.stream.close()
+
+
+class StreamSink:
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, data):
+        self.stream.write(data.decode('utf8'))
+        self.stream.flush()
+
+    def close(self):
+        pass
+
+
+class BackgroundHandler(logging.handlers.QueueHandler):
+    """
+    Writes to `filename` (rotated at `max_bytes`, keeping `backup_count` old
+    files) or to stderr from a background thread, `batch_size` records at a time.
+    """
+
+    def __init__(self, filename=None, max_bytes=0, backup_count=5, batch_size=256, queue_size=10000):
+        super().__init__(queue.Queue(queue_size))
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.batch_size = batch_size
+        self.sink = None
+        self.writer = threading.Thread(target=self.drain, name='log-writer', daemon=True)
+        self.writer.start()
+        atexit.register(self.close)
+
+    def prepare(self, record):
+        # Formatting happens on the caller's thread: the context ids and the
+        # traceback only exist there, and it keeps the writer from holding the
+        # GIL for long stretches while callers wait on it
+        if getattr(record, 'request_id', None) is None:
+            record.request_id = request_id.get()
+        if getattr(record, 'connection_id', None) is None:
+            record.connection_id = connection_id.get()
+        return self.format(record) + '\n'
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.labels('queue_full').inc()
+
+    def open_sink(self):
+        if self.filename:
+            return RotatingFile(self.filename, self.max_bytes, self.backup_count)
+        return StreamSink(sys.stderr)
+
+    def drain(self):
+        self.sink = self.open_sink()
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = _STOP in batch
+            lines = [line for line in batch if line is not _STOP]
+            if lines:
+                try:
+                    self.sink.write(''.join(lines).encode('utf8'))
+                except OSError:
+                    LOG_RECORDS_DROPPED.labels('write_error').inc(len(lines))
+            for _ in batch:
+                self.queue.task_done()
+            if stop:
+                self.sink.close()
+                return
+
+    def flush(self):
+        """Block until everything queued so far has been written"""
+        if self.writer.is_alive():
+            self.queue.join()
+
+    def close(self):
+        if self.writer.is_alive():
+            self.queue.put(_STOP)
+            self.writer.join(timeout=5)
+        super().close()
@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from base import archive
+from base.models import ArchiveSegment
+
+
+class Command(BaseCommand):
+    help = 'Move old messages into compressed archive segments, or move them back with --rehydrate'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, metavar='DAYS',
+                            help='Archive messages older than this (default: MESSAGE_ARCHIVE_AFTER_DAYS)')
+        parser.add_argument('--batch-size', type=int, help='Messages per segment (default: MESSAGE_ARCHIVE_SEGMENT_SIZE)')
+        parser.add_argument('--max-batches', type=int, help='Stop after this many segments; run again to continue')
+        parser.add_argument('--room', type=int, action='append', help='Only process this room (repeatable)')
+        parser.add_argument('--rehydrate', action='store_true', help='Restore archived messages, newest segments first')
+
+    def handle(self, *args, **options):
+        if options['rehydrate'] and options['older_than'] is not None:
+            raise CommandError('--older-than cannot be combined with --rehydrate')
+
+        if options['rehydrate']:
+            rooms = ArchiveSegment.objects.order_by().values_list('room_id', flat=True).distinct()
+            if options['room']:
+                rooms = rooms.filter(room_id__in=options['room'])
+            step = archive.rehydrate_batch
+            verb = 'Rehydrated'
+        else:
+            cutoff = archive.archive_cutoff(options['older_than'])
+            rooms = archive.rooms_with_archivable_messages(cutoff, options['room'])
+            step = lambda room_id: archive.archive_batch(room_id, cutoff, options['batch_size'])
+            verb = 'Archived'
+
+        batches = moved = 0
+        max_batches = options['max_batches']
+        # Each batch is its own transaction, so an interrupted run loses nothing
+        for room_id in list(rooms):
+            while max_batches is None or batches < max_batches:
+                count = step(room_id)
+                if not count:
+                    break
+                batches += 1
+                moved += count
+                if options['verbosity'] > 1:
+                    self.stdout.write(f'Room {room_id}: {count} messages')
+
+        self.stdout.write(self.style.SUCCESS(f'{verb} {moved} messages in {batches} batches'))
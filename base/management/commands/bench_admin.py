@@ -0,0 +1,79 @@
+import time
+
+from django.contrib import admin
+from django.contrib.admin import AdminSite, ModelAdmin
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import RequestFactory, override_settings
+
+from base import benchmarks
+from base.models import Message, Room
+
+User = get_user_model()
+
+MODELS = {'message': Message, 'room': Room, 'user': User}
+
+COLUMNS = ('queries', 'mean_ms', 'p50_ms', 'p95_ms', 'max_ms')
+
+
+class Command(BaseCommand):
+    help = (
+        'Time admin changelist renders of messages, rooms and users against the current database (see seed_data), '
+        'with default ModelAdmins and with the admin classes in base/admin.py'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model', action='append', choices=sorted(MODELS),
+                            help='Changelist to render (repeatable); defaults to all')
+        parser.add_argument('--iterations', type=int, default=10)
+        parser.add_argument('--depth', type=int, default=100, help='Page number of the deep page scenario')
+
+    def handle(self, *args, **options):
+        names = options['model'] or list(MODELS)
+        if not Message.objects.exists():
+            raise CommandError('No messages found; run seed_data first')
+
+        # Same name as the real site, so the templates' {% url 'admin:...' %} tags resolve
+        default_site = AdminSite()
+        for model in MODELS.values():
+            default_site.register(model, ModelAdmin)
+        username = f'bench-admin-{time.time_ns()}'
+        superuser = User.objects.create(username=username, email=f'{username}@example.com', is_staff=True, is_superuser=True)
+
+        results = {}
+        try:
+            with override_settings(DEBUG=False, REQUEST_INSTRUMENTATION_ENABLED=False):
+                for name in names:
+                    model = MODELS[name]
+                    per_page = admin.site._registry[model].list_per_page
+                    depth = min(options['depth'], max(1, model.objects.count() // per_page))
+                    # Where the tuned changelist's "Older" links arrive after depth - 1 clicks
+                    deep_id = model.objects.order_by('-id').values_list('id', flat=True)[(depth - 1) * per_page]
+                    scenarios = {
+                        f'{name} first page default': (default_site, {}),
+                        f'{name} first page tuned': (admin.site, {}),
+                        f'{name} page {depth} default': (default_site, {'p': depth}),
+                        f'{name} page {depth} tuned': (admin.site, {'id__lt': deep_id + 1}),
+                    }
+                    for label, (site, params) in scenarios.items():
+                        results[label] = self.run_scenario(site._registry[model], superuser, params, options['iterations'])
+        finally:
+            superuser.delete()
+
+        self.stdout.write(benchmarks.format_table(results, COLUMNS, label='changelist'))
+
+    def run_scenario(self, model_admin, user, params, iterations):
+        factory = RequestFactory()
+        durations = []
+        counter = benchmarks.QueryCounter()
+        for _ in range(iterations):
+            request = factory.get('/admin/', params)
+            request.user = user
+            counter.count = 0
+            started = time.perf_counter()
+            with connection.execute_wrapper(counter):
+                model_admin.changelist_view(request).render()
+            durations.append(time.perf_counter() - started)
+        summary = benchmarks.summarize(durations)
+        return {'queries': counter.count, **{key: summary[key] for key in COLUMNS[1:]}}
@@ -0,0 +1,112 @@
+import random
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test import Client, override_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from base import benchmarks
+from base.models import Room, Topic
+
+User = get_user_model()
+
+SCENARIOS = {
+    'room_list': lambda ctx: '/api/v1/rooms/',
+    'room_search': lambda ctx: f'/api/v1/rooms/?q={ctx.rng.choice(ctx.search_terms)}',
+    'room_detail': lambda ctx: f'/api/v1/rooms/{ctx.rng.choice(ctx.room_ids)}/',
+    'message_list': lambda ctx: f'/api/v1/messages/?room={ctx.rng.choice(ctx.room_ids)}',
+    'topic_list': lambda ctx: '/api/v1/topics/',
+    'profile': lambda ctx: '/api/v1/profile/',
+}
+
+COLUMNS = ('requests', 'throughput', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms', 'queries')
+
+
+class Context:
+    def __init__(self, rng, room_ids, search_terms):
+        self.rng = rng
+        self.room_ids = room_ids
+        self.search_terms = search_terms
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the REST API against the current database (see seed_data)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                            help='Scenario to run (repeatable); defaults to all')
+        parser.add_argument('--iterations', type=int, default=200)
+        parser.add_argument('--warmup', type=int, default=20)
+        parser.add_argument('--user', help='Email of the user to authenticate as')
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--baseline', help='Compare results against this JSON file')
+        parser.add_argument('--save-baseline', help='Write results to this JSON file')
+        parser.add_argument('--tolerance', type=float, default=0.25,
+                            help='Allowed latency growth over the baseline (fraction)')
+        parser.add_argument('--slack-ms', type=float, default=1.0,
+                            help='Latency growth always tolerated, in milliseconds')
+
+    def handle(self, *args, **options):
+        user = self.get_user(options['user'])
+        room_ids = list(Room.objects.values_list('id', flat=True)[:1000])
+        if not room_ids:
+            raise CommandError('No rooms found; run seed_data first')
+        search_terms = [name.split(':')[-1].split('-')[0] for name in Topic.objects.values_list('name', flat=True)[:100]]
+        ctx = Context(random.Random(options['seed']), room_ids, search_terms or ['study'])
+
+        client = Client(HTTP_HOST='localhost', HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(user).access_token}')
+        names = options['scenario'] or list(SCENARIOS)
+
+        # Throttling would cap the run at the hourly quota, and DEBUG query
+        # logging would skew every measurement
+        dummy_cache = {'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}}
+        with override_settings(DEBUG=False, CACHES=dummy_cache, REQUEST_INSTRUMENTATION_ENABLED=False):
+            results = {
+                name: self.run_scenario(client, SCENARIOS[name], ctx, options['iterations'], options['warmup'])
+                for name in names
+            }
+
+        self.stdout.write(benchmarks.format_table(results, COLUMNS))
+
+        if options['save_baseline']:
+            benchmarks.save_baseline(options['save_baseline'], results)
+            self.stdout.write(f"Baseline written to {options['save_baseline']}")
+
+        if options['baseline']:
+            regressions = benchmarks.compare(
+                results, benchmarks.load_baseline(options['baseline']),
+                options['tolerance'], exact_keys=('queries',), slack=options['slack_ms'],
+            )
+            if regressions:
+                raise CommandError('Performance regressions:\n  ' + '\n  '.join(regressions))
+            self.stdout.write(self.style.SUCCESS('No regressions against baseline'))
+
+    def get_user(self, email):
+        users = User.objects.all()
+        user = users.filter(email=email).first() if email else users.order_by('id').first()
+        if user is None:
+            raise CommandError('No user to authenticate as; run seed_data first')
+        return user
+
+    def run_scenario(self, client, build_path, ctx, iterations, warmup):
+        for _ in range(warmup):
+            client.get(build_path(ctx))
+
+        counter = benchmarks.QueryCounter()
+        durations = []
+        started = time.perf_counter()
+        with connections['default'].execute_wrapper(counter):
+            for _ in range(iterations):
+                path = build_path(ctx)
+                request_started = time.perf_counter()
+                response = client.get(path)
+                durations.append(time.perf_counter() - request_started)
+                if response.status_code != 200:
+                    raise CommandError(f'GET {path} returned {response.status_code}')
+        wall_time = time.perf_counter() - started
+
+        result = benchmarks.summarize(durations, wall_time)
+        result['queries'] = round(counter.count / iterations, 1)
+        return result
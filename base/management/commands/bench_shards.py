@@ -0,0 +1,95 @@
+import multiprocessing
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from base import benchmarks, sharding
+from base.models import Message, Room, User
+
+COLUMNS = ('messages', 'throughput', 'mean_ms', 'p99_ms', 'speedup')
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure message write throughput as concurrent writer processes spread over 1, 2, 4 ... of the configured '
+        'shards (run with MESSAGE_SHARDS=N and migrated shard databases)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=2000, help='Messages written per scenario')
+        parser.add_argument('--writers', type=int, default=8, help='Concurrent writer processes')
+
+    def handle(self, *args, **options):
+        if not sharding.enabled():
+            raise CommandError('Sharding is off; set MESSAGE_SHARDS to the number of shards to compare')
+        shards = settings.MESSAGE_SHARDS
+        counts = sorted({2 ** i for i in range(shards.bit_length()) if 2 ** i <= shards} | {shards})
+
+        user = User.objects.create(username=f'bench-shards-{time.time_ns()}')
+        # One room per writer on every shard, so each scenario only changes how many shards take the writes
+        rooms = {alias: [] for alias in sharding.aliases()}
+        while min(len(ids) for ids in rooms.values()) < options['writers']:
+            room = Room.objects.create(host=user, name='bench shards')
+            rooms[sharding.shard_for_room(room.id)].append(room.id)
+
+        results = {}
+        try:
+            for count in counts:
+                targets = [room_id for alias in sharding.aliases()[:count] for room_id in rooms[alias]]
+                results[f'{count}'] = self.run(user.id, targets, options['messages'], options['writers'])
+        finally:
+            sharding.seq_flusher.flush()
+            Room.objects.filter(host=user).delete()
+            user.delete()
+
+        base = results[str(counts[0])]['throughput']
+        for values in results.values():
+            values['speedup'] = f'{values["throughput"] / base:.2f}x' if base else ''
+        self.stdout.write(benchmarks.format_table(results, COLUMNS, label='shards'))
+
+    def run(self, user_id, room_ids, messages, writers):
+        per_writer = messages // writers
+        context = multiprocessing.get_context('fork')
+        barrier = context.Barrier(writers + 1)
+        results = context.Queue()
+        # Children must not share the parent's SQLite handles
+        connections.close_all()
+        processes = [
+            context.Process(target=write, args=(index, writers, user_id, room_ids, per_writer, barrier, results))
+            for index in range(writers)
+        ]
+        for process in processes:
+            process.start()
+        barrier.wait()
+        started = time.perf_counter()
+        outcomes = [results.get() for _ in processes]
+        wall_time = time.perf_counter() - started
+        for process in processes:
+            process.join()
+
+        errors = [outcome for outcome in outcomes if isinstance(outcome, str)]
+        if errors:
+            raise CommandError(f'{len(errors)} writers failed: {errors[0]}')
+        summary = benchmarks.summarize([d for durations in outcomes for d in durations], wall_time=wall_time)
+        return {'messages': summary['requests'], 'throughput': summary['throughput'],
+                'mean_ms': summary['mean_ms'], 'p99_ms': summary['p99_ms']}
+
+
+def write(index, writers, user_id, room_ids, count, barrier, results):
+    """One writer process: `count` messages, taking turns over the rooms so every shard sees every writer"""
+    try:
+        durations = []
+        barrier.wait()
+        for i in range(count):
+            room_id = room_ids[(index + i * writers) % len(room_ids)]
+            started = time.perf_counter()
+            Message.objects.create(user_id=user_id, room_id=room_id, body=f'bench {i}')
+            durations.append(time.perf_counter() - started)
+        sharding.seq_flusher.flush()
+        results.put(durations)
+    except Exception as exc:
+        results.put(repr(exc))
+    finally:
+        connections.close_all()
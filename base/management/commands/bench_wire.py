@@ -0,0 +1,52 @@
+import time
+from datetime import datetime, timezone
+
+from django.core.management.base import BaseCommand
+
+from base import benchmarks, wire
+
+COLUMNS = ('bytes', 'encode_us', 'decode_us', 'client_bytes', 'parse_us', 'bytes_saved')
+BODIES = {'short': 'ok, see you there', 'medium': 'x' * 180, 'long': 'y' * 1500}
+
+
+def per_call_us(function, argument, iterations):
+    started = time.perf_counter()
+    for _ in range(iterations):
+        function(argument)
+    return round((time.perf_counter() - started) / iterations * 1e6, 3)
+
+
+class Command(BaseCommand):
+    help = 'Compare size and encode/decode cost of chat events in the JSON and binary wire formats'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=50000)
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+        created = datetime(2026, 10, 19, 9, 30, 12, 345000, tzinfo=timezone.utc)
+        results = {}
+        for size, body in BODIES.items():
+            event = {
+                'type': 'chat_message', 'message': body, 'user_id': 48213, 'username': 'maria_k',
+                'created': created.isoformat(), 'created_ms': wire.epoch_ms(created),
+                'message_id': 1830457, 'seq': 91233,
+            }
+            payload = {'type': 'message', 'user_id': 48213, 'message': body}
+            json_bytes = None
+            for codec in (wire.JSON, wire.BINARY):
+                frame = codec.encode_message(event)
+                client_frame = codec.encode_client(payload)
+                length = len(frame.encode() if isinstance(frame, str) else frame)
+                json_bytes = json_bytes or length
+                results[f'{codec.subprotocol or "json"} {size}'] = {
+                    # Server: encode each delivered event; client: decode it
+                    'bytes': length,
+                    'encode_us': per_call_us(codec.encode_message, event, iterations),
+                    'decode_us': per_call_us(codec.decode_server, frame, iterations),
+                    # Client sends, server parses
+                    'client_bytes': len(client_frame),
+                    'parse_us': per_call_us(codec.decode, client_frame, iterations),
+                    'bytes_saved': f'{1 - length / json_bytes:.0%}',
+                }
+        self.stdout.write(benchmarks.format_table(results, COLUMNS, label='format'))
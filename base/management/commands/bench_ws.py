@@ -0,0 +1,253 @@
+import asyncio
+import base64
+import json
+import os
+import random
+import struct
+import time
+from urllib.parse import urlparse
+
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+
+from base import benchmarks, wire
+from base.models import Room
+from base.routing import websocket_urlpatterns
+
+User = get_user_model()
+
+COLUMNS = (
+    'clients', 'rooms', 'sent', 'delivered', 'delivery_ratio', 'throughput',
+    'p50_ms', 'p95_ms', 'p99_ms', 'max_ms', 'cpu_s', 'rss_mb', 'bytes_per_event',
+)
+
+
+class InProcessClient:
+    """A client driven through channels' WebsocketCommunicator"""
+
+    def __init__(self, application, room_id, on_message, codec=wire.JSON):
+        subprotocols = [codec.subprotocol] if codec.subprotocol else None
+        self.communicator = WebsocketCommunicator(application, f'/ws/chat/{room_id}/', subprotocols=subprotocols)
+        self.on_message = on_message
+        self.reader = None
+
+    async def connect(self):
+        connected, _ = await self.communicator.connect(timeout=10)
+        if not connected:
+            raise CommandError('Consumer rejected the connection')
+        self.reader = asyncio.ensure_future(self.read())
+
+    async def read(self):
+        while True:
+            self.on_message(await self.communicator.receive_from(timeout=3600))
+
+    async def send(self, frame):
+        if isinstance(frame, bytes):
+            await self.communicator.send_to(bytes_data=frame)
+        else:
+            await self.communicator.send_to(text_data=frame)
+
+    async def close(self):
+        self.reader.cancel()
+        await self.communicator.disconnect()
+
+
+class LoopbackClient:
+    """
+    A minimal RFC 6455 client talking to a running server over TCP.
+
+    daphne pins txaio to Twisted when it is an installed app, so autobahn's
+    asyncio client cannot be used here; data frames, pings and close are all
+    the harness needs.
+    """
+
+    def __init__(self, url, room_id, on_message, codec=wire.JSON):
+        parsed = urlparse(url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.path = f'/ws/chat/{room_id}/'
+        self.on_message = on_message
+        self.codec = codec
+        self.reader = self.writer = self.task = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        key = base64.b64encode(os.urandom(16)).decode()
+        protocol = f'Sec-WebSocket-Protocol: {self.codec.subprotocol}\r\n' if self.codec.subprotocol else ''
+        self.writer.write((
+            f'GET {self.path} HTTP/1.1\r\n'
+            f'Host: {self.host}:{self.port}\r\n'
+            f'Origin: http://{self.host}\r\n'
+            'Upgrade: websocket\r\nConnection: Upgrade\r\n'
+            f'Sec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n{protocol}\r\n'
+        ).encode())
+        status = await asyncio.wait_for(self.reader.readuntil(b'\r\n\r\n'), timeout=10)
+        if not status.startswith(b'HTTP/1.1 101'):
+            raise CommandError(f'Handshake failed: {status.splitlines()[0].decode()}')
+        self.task = asyncio.ensure_future(self.read())
+
+    def write_frame(self, opcode, payload):
+        header = bytearray([0x80 | opcode])
+        length = len(payload)
+        if length < 126:
+            header.append(0x80 | length)
+        elif length < 65536:
+            header.append(0x80 | 126)
+            header += struct.pack('!H', length)
+        else:
+            header.append(0x80 | 127)
+            header += struct.pack('!Q', length)
+        mask = os.urandom(4)
+        masked = bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload))
+        self.writer.write(bytes(header) + mask + masked)
+
+    async def read(self):
+        while True:
+            first, second = await self.reader.readexactly(2)
+            length = second & 0x7f
+            if length == 126:
+                length = struct.unpack('!H', await self.reader.readexactly(2))[0]
+            elif length == 127:
+                length = struct.unpack('!Q', await self.reader.readexactly(8))[0]
+            payload = await self.reader.readexactly(length)
+            opcode = first & 0x0f
+            if opcode == 0x1:
+                self.on_message(payload.decode('utf8'))
+            elif opcode == 0x2:
+                self.on_message(payload)
+            elif opcode == 0x9:
+                self.write_frame(0xA, payload)
+            elif opcode == 0x8:
+                return
+
+    async def send(self, frame):
+        if isinstance(frame, bytes):
+            self.write_frame(0x2, frame)
+        else:
+            self.write_frame(0x1, frame.encode('utf8'))
+        await self.writer.drain()
+
+    async def close(self):
+        self.write_frame(0x8, struct.pack('!H', 1000))
+        self.task.cancel()
+        self.writer.close()
+
+
+class Command(BaseCommand):
+    help = 'Benchmark ChatConsumer fan-out with many simulated WebSocket clients'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=1000)
+        parser.add_argument('--rooms', type=int, default=10)
+        parser.add_argument('--rate', type=float, default=50, help='Messages sent per second (all rooms)')
+        parser.add_argument('--duration', type=float, default=10, help='Seconds to send for')
+        parser.add_argument('--drain', type=float, default=2, help='Seconds to wait for late deliveries')
+        parser.add_argument('--connect-batch', type=int, default=200)
+        parser.add_argument('--layer', help='Channel layer backend to use, e.g. channels_redis.core.RedisChannelLayer')
+        parser.add_argument('--layer-config', default='{}', help='JSON CONFIG for --layer')
+        parser.add_argument('--url', help='Drive a running server, e.g. ws://127.0.0.1:8000, instead of in-process')
+        parser.add_argument('--server-pid', type=int, help='Sample CPU/RSS of this process (with --url)')
+        parser.add_argument('--binary', action='store_true', help=f'Negotiate the {wire.BINARY_SUBPROTOCOL} wire format')
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--label', default='chat', help='Row name in the results table and baseline')
+        parser.add_argument('--baseline', help='Compare results against this JSON file')
+        parser.add_argument('--save-baseline', help='Write results to this JSON file')
+        parser.add_argument('--tolerance', type=float, default=0.25)
+
+    def handle(self, *args, **options):
+        room_ids = list(Room.objects.order_by('id').values_list('id', flat=True)[:options['rooms']])
+        user_ids = list(User.objects.order_by('id').values_list('id', flat=True)[:1000])
+        if len(room_ids) < options['rooms'] or not user_ids:
+            raise CommandError('Not enough rooms or users; run seed_data first')
+
+        overrides = {}
+        if options['layer']:
+            overrides['CHANNEL_LAYERS'] = {
+                'default': {'BACKEND': options['layer'], 'CONFIG': json.loads(options['layer_config'])},
+            }
+        with override_settings(**overrides):
+            result = asyncio.run(self.run(room_ids, user_ids, options))
+
+        results = {options['label']: result}
+        self.stdout.write(benchmarks.format_table(results, COLUMNS))
+
+        if options['save_baseline']:
+            benchmarks.save_baseline(options['save_baseline'], results)
+        if options['baseline']:
+            regressions = benchmarks.compare(
+                results, benchmarks.load_baseline(options['baseline']), options['tolerance'],
+            )
+            if regressions:
+                raise CommandError('Performance regressions:\n  ' + '\n  '.join(regressions))
+            self.stdout.write(self.style.SUCCESS('No regressions against baseline'))
+
+    async def run(self, room_ids, user_ids, options):
+        rng = random.Random(options['seed'])
+        latencies = []
+        delivered = received_bytes = 0
+        codec = wire.BINARY if options['binary'] else wire.JSON
+
+        def on_message(frame):
+            nonlocal delivered, received_bytes
+            body = codec.decode_server(frame).get('message', '')
+            if body.startswith('bench:'):
+                delivered += 1
+                received_bytes += len(frame)
+                latencies.append(time.perf_counter() - float(body.split(':')[1]))
+
+        if options['url']:
+            make_client = lambda room_id: LoopbackClient(options['url'], room_id, on_message, codec)
+        else:
+            application = URLRouter(websocket_urlpatterns)
+            make_client = lambda room_id: InProcessClient(application, room_id, on_message, codec)
+
+        # Clients are spread evenly; sends go to a random client of a random room
+        members = {room_id: [] for room_id in room_ids}
+        clients = []
+        for index in range(options['clients']):
+            room_id = room_ids[index % len(room_ids)]
+            client = make_client(room_id)
+            members[room_id].append(client)
+            clients.append(client)
+        for start in range(0, len(clients), options['connect_batch']):
+            await asyncio.gather(*(c.connect() for c in clients[start:start + options['connect_batch']]))
+
+        cpu_before, _ = benchmarks.process_usage(options['server_pid'])
+        sent = expected = 0
+        interval = 1 / options['rate']
+        started = time.perf_counter()
+        next_send = started
+        while time.perf_counter() - started < options['duration']:
+            room_id = rng.choice(room_ids)
+            sender = rng.choice(members[room_id])
+            await sender.send(codec.encode_client({
+                'type': 'message',
+                'message': f'bench:{time.perf_counter()}',
+                'user_id': rng.choice(user_ids),
+            }))
+            sent += 1
+            expected += len(members[room_id])
+            next_send += interval
+            await asyncio.sleep(max(0, next_send - time.perf_counter()))
+
+        await asyncio.sleep(options['drain'])
+        elapsed = time.perf_counter() - started
+        cpu_after, rss = benchmarks.process_usage(options['server_pid'])
+
+        await asyncio.gather(*(c.close() for c in clients), return_exceptions=True)
+
+        result = benchmarks.summarize(latencies, elapsed)
+        result.update({
+            'clients': len(clients),
+            'rooms': len(room_ids),
+            'sent': sent,
+            'delivered': delivered,
+            'delivery_ratio': round(delivered / expected, 4) if expected else 0.0,
+            'cpu_s': round(cpu_after - cpu_before, 2),
+            'rss_mb': round(rss / 1048576, 1),
+            'bytes_per_event': round(received_bytes / delivered) if delivered else 0,
+        })
+        return result
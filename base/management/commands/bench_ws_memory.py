@@ -0,0 +1,78 @@
+import asyncio
+
+from channels.generic.websocket import AsyncWebsocketConsumer
+from channels.routing import URLRouter
+from django.core.management.base import BaseCommand, CommandError
+from django.urls import re_path
+
+from base import benchmarks, sockets
+from base.routing import websocket_urlpatterns
+
+from .bench_ws import LoopbackClient
+
+COLUMNS = ('connections', 'rooms', 'bytes_per_conn', 'over_bare')
+
+
+class BareConsumer(AsyncWebsocketConsumer):
+    """Accepts and does nothing else: the floor every consumer pays"""
+    channel_layer_alias = None
+
+    async def connect(self):
+        await self.accept()
+
+
+class LayerConsumer(AsyncWebsocketConsumer):
+    """An idle chat socket registered with the channel layer itself, as ChatConsumer was before room hubs"""
+
+    async def connect(self):
+        await self.channel_layer.group_add(sockets.group_name(self.scope['url_route']['kwargs']['room_id']), self.channel_name)
+        await self.accept()
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure memory per idle chat WebSocket: in-process with tracemalloc against bare and '
+        'self-registering consumers, or as RSS growth of a running server (--url with --server-pid)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--connections', type=int, default=2000)
+        parser.add_argument('--rooms', type=int, default=100)
+        parser.add_argument('--url', help='Open idle sockets to a running server, e.g. ws://127.0.0.1:8000')
+        parser.add_argument('--server-pid', type=int, help='Process whose RSS growth is measured (with --url)')
+        parser.add_argument('--connect-batch', type=int, default=200)
+
+    def handle(self, *args, **options):
+        if options['url'] and not options['server_pid']:
+            raise CommandError('--url needs --server-pid to measure the server')
+        connections, rooms = options['connections'], options['rooms']
+        paths = [f'/ws/chat/{index % rooms}/' for index in range(connections)]
+
+        if options['url']:
+            results = {'server': asyncio.run(self.measure_server(paths, options))}
+        else:
+            applications = {
+                'bare': URLRouter([re_path(r'ws/chat/(?P<room_id>\w+)/$', BareConsumer.as_asgi())]),
+                'layer per socket': URLRouter([re_path(r'ws/chat/(?P<room_id>\w+)/$', LayerConsumer.as_asgi())]),
+                'chat': URLRouter(websocket_urlpatterns),
+            }
+            results = {
+                name: {'bytes_per_conn': round(asyncio.run(benchmarks.idle_connection_bytes(application, paths)))}
+                for name, application in applications.items()
+            }
+            for values in results.values():
+                values['over_bare'] = values['bytes_per_conn'] - results['bare']['bytes_per_conn']
+        for values in results.values():
+            values.update(connections=connections, rooms=rooms)
+        self.stdout.write(benchmarks.format_table(results, COLUMNS))
+
+    async def measure_server(self, paths, options):
+        _, before = benchmarks.process_usage(options['server_pid'])
+        clients = [LoopbackClient(options['url'], path.split('/')[3], lambda frame: None) for path in paths]
+        for start in range(0, len(clients), options['connect_batch']):
+            await asyncio.gather(*(client.connect() for client in clients[start:start + options['connect_batch']]))
+        # Give the server a moment to finish connect handlers before sampling
+        await asyncio.sleep(1)
+        _, after = benchmarks.process_usage(options['server_pid'])
+        await asyncio.gather(*(client.close() for client in clients), return_exceptions=True)
+        return {'bytes_per_conn': round((after - before) / len(clients))}
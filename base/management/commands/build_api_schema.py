@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from drf_spectacular.renderers import OpenApiJsonRenderer, OpenApiYamlRenderer
+
+from base.api import schema
+
+
+class Command(BaseCommand):
+    help = 'Pre-generate the OpenAPI schema served at /api/v1/schema/ for the current code version'
+
+    def handle(self, *args, **options):
+        for renderer_class in (OpenApiYamlRenderer, OpenApiJsonRenderer):
+            content = schema.build(renderer_class())
+            self.stdout.write(f'{renderer_class.format}: {len(content):,} bytes')
+        removed = schema.prune()
+        self.stdout.write(self.style.SUCCESS(
+            f'Schema cached for version {schema.code_version()} ({removed} stale files removed)'
+        ))
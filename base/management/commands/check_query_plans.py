@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+
+from base import benchmarks, query_plans
+
+
+class Command(BaseCommand):
+    help = (
+        'EXPLAIN every query of the hot API endpoints and chat consumers and fail on full table scans and '
+        'temporary B-tree sorts not listed in base/query_plans.ALLOWED'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenario', action='append', choices=query_plans.scenario_names(),
+                            help='Scenario to check (repeatable); defaults to all')
+        parser.add_argument('--sql', action='store_true', help='Print the SQL of every finding')
+
+    def handle(self, *args, **options):
+        # Throttling and response caches would hide queries
+        dummy_cache = {'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}}
+        with override_settings(DEBUG=False, CACHES=dummy_cache, REQUEST_INSTRUMENTATION_ENABLED=False):
+            findings = query_plans.check(options['scenario'])
+
+        results = {
+            f'{finding.scenario} #{i}': {
+                'kind': finding.kind, 'target': finding.target,
+                'status': 'allowed' if finding.reason else 'FAIL', 'reason': finding.reason,
+            }
+            for i, finding in enumerate(findings, 1)
+        }
+        if results:
+            self.stdout.write(benchmarks.format_table(results, ('kind', 'target', 'status', 'reason')))
+        if options['sql']:
+            for finding in findings:
+                self.stdout.write(f'\n{finding.scenario}: {finding.detail}\n  {finding.sql}')
+
+        failures = [finding for finding in findings if not finding.reason]
+        if failures:
+            raise CommandError(
+                f'{len(failures)} query plans scan a whole table or sort in a temporary B-tree:\n  '
+                + '\n  '.join(f'{f.scenario}: {f.detail}' for f in failures)
+            )
+        self.stdout.write(self.style.SUCCESS(f'No unexpected scans or sorts ({len(findings)} allowed)'))
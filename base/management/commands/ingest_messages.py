@@ -0,0 +1,73 @@
+import json
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from base import ingest
+from base.models import User
+
+
+class Command(BaseCommand):
+    help = 'Bulk-load messages from a JSON array or JSONL file ({"room", "body", "user", "created"} per item)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="File to read, or - for stdin")
+        parser.add_argument('--format', choices=('auto', 'json', 'jsonl'), default='auto',
+                            help='auto picks json when the input starts with [')
+        parser.add_argument('--user', type=int, help='Author of items without a "user"')
+        parser.add_argument('--chunk-size', type=int, help='Messages per transaction (default: INGEST_CHUNK_SIZE)')
+        parser.add_argument('--show-errors', type=int, default=20, help='Item errors to print')
+
+    def handle(self, *args, **options):
+        if options['user'] is not None and not User.objects.filter(id=options['user']).exists():
+            raise CommandError(f'User {options["user"]} does not exist')
+        try:
+            stream = sys.stdin if options['path'] == '-' else open(options['path'], encoding='utf8')
+        except OSError as exc:
+            raise CommandError(exc)
+
+        with stream:
+            fmt = options['format']
+            if fmt == 'auto':
+                first = stream.read(1)
+                while first.isspace():
+                    first = stream.read(1)
+                fmt = 'json' if first == '[' else 'jsonl'
+                items = self.read(first, stream, fmt)
+            else:
+                items = self.read('', stream, fmt)
+
+            started = time.perf_counter()
+            result = ingest.ingest(items, default_user_id=options['user'], trusted=True, chunk_size=options['chunk_size'])
+            elapsed = time.perf_counter() - started
+
+        for error in result['errors'][:options['show_errors']]:
+            self.stderr.write(f'item {error["index"]}: {json.dumps(error["errors"])}')
+        if result['failed'] > options['show_errors']:
+            self.stderr.write(f'... and {result["failed"] - options["show_errors"]} more')
+        rate = result['created'] / elapsed if elapsed else 0
+        style = self.style.SUCCESS if not result['failed'] else self.style.WARNING
+        self.stdout.write(style(
+            f'Created {result["created"]} messages, {result["failed"]} failed, in {elapsed:.2f}s ({rate:,.0f} messages/s)'
+        ))
+
+    def read(self, head, stream, fmt):
+        if fmt == 'json':
+            try:
+                items = json.loads(head + stream.read())
+            except ValueError as exc:
+                raise CommandError(f'Invalid JSON: {exc}')
+            if not isinstance(items, list):
+                raise CommandError('Expected a JSON array of messages')
+            return items
+        lines = iter(stream)
+        if head:
+            # Put back what format detection consumed
+            lines = self.prepend(head, lines)
+        return ingest.read_jsonl(lines)
+
+    @staticmethod
+    def prepend(head, lines):
+        yield head + next(lines, '')
+        yield from lines
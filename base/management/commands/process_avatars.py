@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from django.contrib.auth import get_user_model
+
+from base.avatars import DEFAULT_AVATAR, process_avatar
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = 'Generate avatar variants for users that do not have them yet'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Reprocess every uploaded avatar')
+
+    def handle(self, *args, **options):
+        users = User.objects.exclude(avatar='').exclude(avatar=DEFAULT_AVATAR).exclude(avatar__isnull=True)
+        if not options['all']:
+            users = users.filter(avatar_hash='')
+
+        processed = failed = 0
+        for user_id in users.values_list('id', flat=True).iterator():
+            try:
+                if process_avatar(user_id):
+                    processed += 1
+            except Exception as exc:
+                failed += 1
+                self.stderr.write(f'User {user_id}: {exc}')
+
+        self.stdout.write(self.style.SUCCESS(f'Processed {processed} avatars ({failed} failed)'))
@@ -0,0 +1,43 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from base import sharding
+from base.models import Message
+
+
+class Command(BaseCommand):
+    help = (
+        "Move messages to their room's shard after MESSAGE_SHARDS changes, when turning sharding on over an "
+        "existing database, or back into `default` when turning it off"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Messages copied per transaction')
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would move')
+
+    def handle(self, *args, **options):
+        sources = [DEFAULT_DB_ALIAS] + sharding.configured_aliases()
+        if len(sources) == 1:
+            raise CommandError('No message shards are configured (set MESSAGE_SHARDS or MESSAGE_SHARD_DATABASES)')
+
+        total = 0
+        for source in sources:
+            misplaced = [
+                room_id
+                for room_id in Message.objects.using(source).order_by().values_list('room_id', flat=True).distinct()
+                if sharding.shard_for_room(room_id) != source
+            ]
+            for room_id in misplaced:
+                target = sharding.shard_for_room(room_id)
+                if options['dry_run']:
+                    count = Message.objects.using(source).filter(room_id=room_id).count()
+                else:
+                    count = sharding.move_room(room_id, source, target, batch_size=options['batch_size'])
+                total += count
+                self.stdout.write(f'room {room_id}: {count} messages {source} -> {target}')
+
+        verb = 'would move' if options['dry_run'] else 'moved'
+        self.stdout.write(self.style.SUCCESS(
+            f'{verb} {total} messages; {settings.MESSAGE_SHARDS or "no"} shards in use'
+        ))
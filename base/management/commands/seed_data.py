@@ -0,0 +1,155 @@
+import random
+import time
+from collections import defaultdict
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from base import sharding
+from base.models import Room, Topic, Message
+
+User = get_user_model()
+
+WORDS = (
+    'algebra calculus physics chemistry biology history python django react '
+    'statistics economics philosophy literature spanish french german music '
+    'geometry databases networks security compilers graphics robotics design'
+).split()
+
+
+def zipf_weights(count, exponent):
+    """Popularity weights where the item at rank r gets 1 / r^exponent"""
+    return [1 / (rank ** exponent) for rank in range(1, count + 1)]
+
+
+class Command(BaseCommand):
+    help = 'Generate a synthetic dataset of users, topics, rooms, memberships and messages'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--topics', type=int, default=50)
+        parser.add_argument('--rooms', type=int, default=500)
+        parser.add_argument('--messages', type=int, default=50000)
+        parser.add_argument('--max-participants', type=int, default=200,
+                            help='Members of the most popular room')
+        parser.add_argument('--skew', type=float, default=1.1,
+                            help='Zipf exponent for room and user popularity')
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--prefix', default='seed', help='Username prefix for generated users')
+        parser.add_argument('--password', default='benchmark-password')
+        parser.add_argument('--batch-size', type=int, default=2000)
+        parser.add_argument('--flush', action='store_true',
+                            help='Delete previously generated data with the same prefix first')
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        prefix = options['prefix']
+        batch_size = options['batch_size']
+
+        if options['flush']:
+            self.flush(prefix)
+        elif User.objects.filter(username__startswith=f'{prefix}_').exists():
+            raise CommandError(f'Users prefixed "{prefix}_" already exist; use --flush or another --prefix')
+
+        started = time.perf_counter()
+        with transaction.atomic():
+            users = self.create_users(options['users'], prefix, options['password'], batch_size)
+            topics = self.create_topics(options['topics'], prefix, rng, batch_size)
+            rooms = self.create_rooms(options['rooms'], prefix, users, topics, rng, options['skew'], batch_size)
+            members = self.create_memberships(rooms, users, rng, options['skew'], options['max_participants'], batch_size)
+            messages = self.create_messages(options['messages'], rooms, members, rng, options['skew'], batch_size)
+        elapsed = time.perf_counter() - started
+
+        rows = len(users) + len(topics) + len(rooms) + sum(len(m) for m in members) + messages
+        self.stdout.write(self.style.SUCCESS(
+            f'Created {len(users)} users, {len(topics)} topics, {len(rooms)} rooms, '
+            f'{sum(len(m) for m in members)} memberships and {messages} messages '
+            f'in {elapsed:.2f}s ({rows / elapsed:,.0f} rows/s)'
+        ))
+
+    def flush(self, prefix):
+        Room.objects.filter(name__startswith=f'{prefix}:').delete()
+        Topic.objects.filter(name__startswith=f'{prefix}:').delete()
+        User.objects.filter(username__startswith=f'{prefix}_').delete()
+
+    def create_users(self, count, prefix, password, batch_size):
+        # Hash once; every generated user shares the same password
+        hashed = make_password(password)
+        users = [
+            User(username=f'{prefix}_{i}', email=f'{prefix}_{i}@example.com', name=f'User {i}', password=hashed)
+            for i in range(count)
+        ]
+        return User.objects.bulk_create(users, batch_size=batch_size)
+
+    def create_topics(self, count, prefix, rng, batch_size):
+        topics = [
+            Topic(name=f'{prefix}:{rng.choice(WORDS)}-{i}')
+            for i in range(count)
+        ]
+        return Topic.objects.bulk_create(topics, batch_size=batch_size)
+
+    def create_rooms(self, count, prefix, users, topics, rng, skew, batch_size):
+        hosts = rng.choices(users, weights=zipf_weights(len(users), skew), k=count)
+        room_topics = rng.choices(topics, weights=zipf_weights(len(topics), skew), k=count)
+        rooms = [
+            Room(
+                name=f'{prefix}: {rng.choice(WORDS)} {rng.choice(WORDS)} study group {i}',
+                description=' '.join(rng.choices(WORDS, k=12)),
+                host=host,
+                topic=topic,
+            )
+            for i, (host, topic) in enumerate(zip(hosts, room_topics))
+        ]
+        return Room.objects.bulk_create(rooms, batch_size=batch_size)
+
+    def create_memberships(self, rooms, users, rng, skew, max_participants, batch_size):
+        """Room sizes follow the popularity curve; the host is always a member"""
+        Membership = Room.participants.through
+        user_weights = zipf_weights(len(users), skew)
+        members = []
+        rows = []
+        for rank, room in enumerate(rooms, start=1):
+            size = max(1, min(len(users), int(max_participants / (rank ** skew))))
+            room_members = {room.host_id}
+            room_members.update(user.id for user in rng.choices(users, weights=user_weights, k=size))
+            members.append(list(room_members))
+            rows.extend(Membership(room_id=room.id, user_id=user_id) for user_id in room_members)
+        Membership.objects.bulk_create(rows, batch_size=batch_size, ignore_conflicts=True)
+        return members
+
+    def create_messages(self, count, rooms, members, rng, skew, batch_size):
+        room_indexes = rng.choices(range(len(rooms)), weights=zipf_weights(len(rooms), skew), k=count)
+        created = 0
+        batch = []
+        for index in room_indexes:
+            room = rooms[index]
+            room.last_seq += 1
+            batch.append(Message(
+                room_id=room.id,
+                user_id=rng.choice(members[index]),
+                body=' '.join(rng.choices(WORDS, k=rng.randint(3, 30))),
+                seq=room.last_seq,
+            ))
+            if len(batch) >= batch_size:
+                self.save_messages(batch)
+                created += len(batch)
+                batch = []
+        if batch:
+            self.save_messages(batch)
+            created += len(batch)
+        Room.objects.bulk_update(rooms, ['last_seq'], batch_size=batch_size)
+        return created
+
+    def save_messages(self, batch):
+        """Write each message to its room's shard (`default` without shards)"""
+        by_alias = defaultdict(list)
+        for message in batch:
+            alias = sharding.shard_for_room(message.room_id)
+            if sharding.enabled():
+                # Shards cannot number rows themselves without colliding with each other
+                message.id = sharding.make_id(alias)
+            by_alias[alias].append(message)
+        for alias, messages in by_alias.items():
+            Message.objects.using(alias).bulk_create(messages)
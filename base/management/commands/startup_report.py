@@ -0,0 +1,83 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from base import benchmarks
+from base.startup import by_package, parse_importtime
+
+APP_COLUMNS = ('import_ms', 'models_ms', 'ready_ms')
+TIMING_COLUMNS = ('setup_ms', 'asgi_import_ms', 'warmup_ms', 'first_request_ms', 'second_request_ms',
+                  'ready_to_first_response_ms')
+
+
+class Command(BaseCommand):
+    help = 'Break down worker cold-start time by import, app and first request, with and without warm-up'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default='/api/v1/rooms/', help='Request to time after startup')
+        parser.add_argument('--runs', type=int, default=3, help='Fresh interpreters per mode; medians are reported')
+        parser.add_argument('--top', type=int, default=15, help='Rows in the import tables')
+        parser.add_argument('--json', action='store_true', help='Print the raw measurements as JSON')
+
+    def run_child(self, warm, path):
+        asgi_module = settings.ASGI_APPLICATION.rsplit('.', 1)[0]
+        code = f'from base.startup import measure; measure({asgi_module!r}, {path!r}, {warm!r})'
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=settings.SETTINGS_MODULE, WARMUP_ON_STARTUP='False')
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', code],
+            cwd=settings.BASE_DIR, env=env, capture_output=True, text=True,
+        )
+        lines = [line for line in result.stdout.splitlines() if line.startswith('{')]
+        if result.returncode or not lines:
+            raise CommandError(f'Startup measurement failed:\n{result.stderr[-2000:]}')
+        measurement = json.loads(lines[-1])
+        measurement['imports'] = parse_importtime(result.stderr)
+        return measurement
+
+    def handle(self, *args, **options):
+        runs = {
+            mode: [self.run_child(mode == 'warm', options['path']) for _ in range(options['runs'])]
+            for mode in ('cold', 'warm')
+        }
+        if options['json']:
+            self.stdout.write(json.dumps(runs, indent=2))
+            return
+
+        cold, warm = runs['cold'], runs['warm']
+        imports = cold[0]['imports']
+        top = options['top']
+
+        self.stdout.write(self.style.MIGRATE_HEADING('Imports by package (self time)'))
+        rows = {package: {'ms': ms} for package, ms in by_package(imports)[:top]}
+        self.stdout.write(benchmarks.format_table(rows, ('ms',), label='package'))
+
+        self.stdout.write(self.style.MIGRATE_HEADING('\nSlowest modules (cumulative)'))
+        slowest = sorted(imports, key=lambda row: -row[2])[:top]
+        rows = {name: {'self_ms': round(s / 1000, 2), 'cumulative_ms': round(c / 1000, 2)} for name, s, c in slowest}
+        self.stdout.write(benchmarks.format_table(rows, ('self_ms', 'cumulative_ms'), label='module'))
+
+        self.stdout.write(self.style.MIGRATE_HEADING('\ndjango.setup() per app'))
+        rows = {
+            label: {column: statistics.median(run['apps'][label].get(column, 0) for run in cold) for column in APP_COLUMNS}
+            for label in cold[0]['apps']
+        }
+        self.stdout.write(benchmarks.format_table(rows, APP_COLUMNS, label='app'))
+
+        self.stdout.write(self.style.MIGRATE_HEADING(f'\nCold start, median of {options["runs"]} runs ({options["path"]})'))
+        rows = {
+            mode: {column: statistics.median(run['timings'].get(column, 0) for run in mode_runs) for column in TIMING_COLUMNS}
+            for mode, mode_runs in runs.items()
+        }
+        self.stdout.write(benchmarks.format_table(rows, TIMING_COLUMNS, label='mode'))
+
+        steps = warm[0]['timings']['warmup']
+        self.stdout.write('Warm-up steps: ' + ', '.join(
+            f'{name} {statistics.median(run["timings"]["warmup"][name] for run in warm)} ms' for name in steps
+        ))
+        gain = rows['cold']['first_request_ms'] - rows['warm']['first_request_ms']
+        self.stdout.write(self.style.SUCCESS(f'First request is {gain:.1f} ms faster after warm-up'))
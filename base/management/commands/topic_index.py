@@ -0,0 +1,42 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from base import benchmarks, topic_index
+
+COLUMNS = ('requests', 'mean_ms', 'p50_ms', 'p99_ms', 'max_ms')
+
+
+class Command(BaseCommand):
+    help = 'Build the topic autocomplete index and report its size and lookup latency'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--queries', type=int, default=10000, help='Lookups to time per prefix length')
+        parser.add_argument('--limit', type=int, default=10)
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        index = topic_index.index
+        started = time.perf_counter()
+        index.build()
+        build_ms = (time.perf_counter() - started) * 1000
+        usage = index.memory_usage()
+        self.stdout.write(
+            f'{usage["topics"]} topics, {usage["keys"]} keys, ~{usage["bytes"] / 1024:.1f} KiB; built in {build_ms:.1f} ms'
+        )
+        if not usage['keys']:
+            return
+
+        # Prefixes of real keys, as typed one character at a time
+        rng = random.Random(options['seed'])
+        results = {}
+        for length in (1, 2, 3, 5):
+            prefixes = [key[:length] for key, _ in rng.choices(index.keys, k=options['queries'])]
+            durations = []
+            for prefix in prefixes:
+                step = time.perf_counter()
+                index.search(prefix, options['limit'])
+                durations.append(time.perf_counter() - step)
+            results[f'{length} chars'] = benchmarks.summarize(durations)
+        self.stdout.write(benchmarks.format_table(results, COLUMNS, label='prefix'))
@@ -0,0 +1,276 @@
+"""
+In-process metrics registry.
+
+Counters, gauges and log-linear (HDR-style) histograms that are cheap enough to
+update on every WebSocket frame, rendered in the Prometheus text exposition
+format by the admin-only metrics endpoint. Values are per process.
+"""
+import threading
+
+_SUB_BUCKET_BITS = 5
+_SUB_BUCKETS = 1 << _SUB_BUCKET_BITS
+_HALF_BUCKETS = _SUB_BUCKETS >> 1
+_QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{value}"' for name, value in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._children[()] = self._new_child()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def remove(self, *values):
+        with self._lock:
+            self._children.pop(tuple(str(value) for value in values), None)
+
+    def samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.kind}',
+        ]
+        for suffix, labels, value in self.samples():
+            lines.append(f'{self.name}{suffix}{labels} {_format_value(value)}')
+        return lines
+
+
+class _Value:
+    __slots__ = ('value', '_lock')
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self._children[()].inc(amount)
+
+    def samples(self):
+        for key, child in list(self._children.items()):
+            yield '', _format_labels(self.labelnames, key), child.value
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        self.callback = callback
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self._children[()].inc(amount)
+
+    def dec(self, amount=1):
+        self._children[()].dec(amount)
+
+    def set(self, value):
+        self._children[()].set(value)
+
+    def samples(self):
+        if self.callback is not None:
+            self._children[()].set(self.callback())
+        for key, child in list(self._children.items()):
+            yield '', _format_labels(self.labelnames, key), child.value
+
+
+class HistogramValue:
+    """
+    Log-linear histogram of microsecond values.
+
+    Each power of two is split into 16 linear sub-buckets, so every recorded
+    value is reproduced within ~6% while the bucket array stays a few hundred
+    entries long for anything from 1us to hours.
+    """
+    __slots__ = ('counts', 'count', 'total', 'max', '_lock')
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _index(micros):
+        if micros < _SUB_BUCKETS:
+            return micros
+        shift = micros.bit_length() - _SUB_BUCKET_BITS
+        return shift * _HALF_BUCKETS + (micros >> shift)
+
+    @staticmethod
+    def _upper_bound(index):
+        if index < _SUB_BUCKETS:
+            return index + 1
+        shift = index // _HALF_BUCKETS - 1
+        return (index - shift * _HALF_BUCKETS + 1) << shift
+
+    def observe(self, seconds):
+        index = self._index(max(int(seconds * 1_000_000), 0))
+        with self._lock:
+            self.counts[index] = self.counts.get(index, 0) + 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def percentile(self, quantile):
+        """Value in seconds below which `quantile` of observations fall"""
+        with self._lock:
+            items = sorted(self.counts.items())
+            count = self.count
+        if not count:
+            return 0.0
+        rank = quantile * count
+        seen = 0
+        for index, bucket_count in items:
+            seen += bucket_count
+            if seen >= rank:
+                return min(self._upper_bound(index) / 1_000_000, self.max)
+        return self.max
+
+
+class Histogram(_Metric):
+    """Exposed to Prometheus as a summary with fixed quantiles"""
+    kind = 'summary'
+
+    def _new_child(self):
+        return HistogramValue()
+
+    def observe(self, seconds):
+        self._children[()].observe(seconds)
+
+    def samples(self):
+        for key, child in list(self._children.items()):
+            for quantile in _QUANTILES:
+                labels = _format_labels(self.labelnames, key, [('quantile', quantile)])
+                yield '', labels, child.percentile(quantile)
+            labels = _format_labels(self.labelnames, key)
+            yield '_sum', labels, child.total
+            yield '_count', labels, child.count
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, cls, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=(), callback=None):
+        return self._register(Gauge, name, documentation, labelnames, callback=callback)
+
+    def histogram(self, name, documentation, labelnames=()):
+        return self._register(Histogram, name, documentation, labelnames)
+
+    def render(self):
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+# ==================== WEBSOCKET ====================
+
+# Not labelled by room: one series per room ever opened would grow without bound
+WS_CONNECTIONS = REGISTRY.gauge(
+    'studybud_ws_connections', 'Open single-room chat WebSocket connections')
+WS_MULTIPLEX_CONNECTIONS = REGISTRY.gauge(
+    'studybud_ws_multiplex_connections', 'Open multiplexed chat WebSocket connections')
+WS_SUBSCRIPTIONS = REGISTRY.gauge(
+    'studybud_ws_subscriptions', 'Room subscriptions held by multiplexed connections')
+WS_CONNECTS = REGISTRY.counter(
+    'studybud_ws_connects_total', 'Chat WebSocket connections accepted')
+WS_MESSAGES_RECEIVED = REGISTRY.counter(
+    'studybud_ws_messages_received_total', 'Chat messages received from clients')
+WS_MESSAGES_SENT = REGISTRY.counter(
+    'studybud_ws_messages_sent_total', 'Chat messages delivered to client sockets')
+WS_FRAMES_REJECTED = REGISTRY.counter(
+    'studybud_ws_frames_rejected_total', 'Inbound chat frames rejected by size or rate limits', ['reason'])
+WS_LIMIT_CLOSES = REGISTRY.counter(
+    'studybud_ws_limit_closes_total', 'Chat WebSocket connections closed for exceeding limits')
+WS_RECEIVE_TO_BROADCAST = REGISTRY.histogram(
+    'studybud_ws_receive_to_broadcast_seconds', 'Time from receive() to group_send() completion')
+WS_SAVE_QUEUE_WAIT = REGISTRY.histogram(
+    'studybud_ws_save_message_queue_wait_seconds', 'Time save_message waits for a database thread')
+WS_SAVE_DURATION = REGISTRY.histogram(
+    'studybud_ws_save_message_seconds', 'Time spent persisting a chat message')
+WS_FANOUT_LATENCY = REGISTRY.histogram(
+    'studybud_ws_fanout_latency_seconds', 'Time from group_send() to delivery by the room hub')
+WS_ROOM_HUBS = REGISTRY.gauge(
+    'studybud_ws_room_hubs', 'Rooms with local chat connections, each holding one channel layer registration')
+WS_IDLE_CLOSES = REGISTRY.counter(
+    'studybud_ws_idle_closes_total', 'Chat WebSocket connections closed after WS_IDLE_TIMEOUT without traffic')
+
+# ==================== ROOM LIST ====================
+
+ROOM_LIST_CONNECTIONS = REGISTRY.gauge(
+    'studybud_room_list_connections', 'Open room list WebSocket connections')
+ROOM_LIST_EVENTS = REGISTRY.counter(
+    'studybud_room_list_events_total', 'Room list deltas received by subscriber connections')
+ROOM_LIST_FRAMES = REGISTRY.counter(
+    'studybud_room_list_frames_total', 'Coalesced room list frames sent to clients')
@@ -0,0 +1,147 @@
+import logging
+import re
+import time
+from contextlib import ExitStack
+from urllib.parse import parse_qs
+
+from channels.db import database_sync_to_async
+from channels.middleware import BaseMiddleware
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+
+from . import instrumentation, log
+
+logger = logging.getLogger(__name__)
+
+_REQUEST_ID = re.compile(r'[\w.-]{1,64}')
+
+
+class RequestIdMiddleware:
+    """
+    Gives every request an id, taken from a well-formed X-Request-ID header or
+    generated, and attaches it to the log records emitted while handling it
+    and to the response.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        incoming = request.headers.get('X-Request-ID', '')
+        request.id = incoming if _REQUEST_ID.fullmatch(incoming) else log.new_id()
+        token = log.request_id.set(request.id)
+        try:
+            response = self.get_response(request)
+        finally:
+            log.request_id.reset(token)
+        response['X-Request-ID'] = request.id
+        return response
+
+
+
+class RequestInstrumentationMiddleware:
+    """
+    Records query count, DB time, serializer time and render time per request.
+
+    Results are sent back as a Server-Timing header and logged with structured
+    fields. Statements run REQUEST_INSTRUMENTATION_N_PLUS_ONE_THRESHOLD or more
+    times within one request are logged as suspected N+1 queries. When
+    REQUEST_INSTRUMENTATION_ENABLED is off the middleware removes itself from
+    the stack at startup.
+    """
+
+    def __init__(self, get_response):
+        if not settings.REQUEST_INSTRUMENTATION_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.threshold = settings.REQUEST_INSTRUMENTATION_N_PLUS_ONE_THRESHOLD
+
+    def __call__(self, request):
+        profile = instrumentation.RequestProfile()
+        token = instrumentation.activate(profile)
+        recorder = instrumentation.QueryRecorder(profile)
+        try:
+            with ExitStack() as stack:
+                for alias in connections:
+                    stack.enter_context(connections[alias].execute_wrapper(recorder))
+                response = self.get_response(request)
+        finally:
+            instrumentation.deactivate(token)
+
+        self.report(request, response, profile)
+        return response
+
+    def process_template_response(self, request, response):
+        # DRF responses are rendered right after this hook returns
+        profile = instrumentation.current_profile()
+        if profile is not None:
+            start = time.perf_counter()
+            response.add_post_render_callback(
+                lambda rendered: profile.add_span('render', time.perf_counter() - start)
+            )
+        return response
+
+    def report(self, request, response, profile):
+        total = profile.elapsed
+        match = getattr(request, 'resolver_match', None)
+        view_name = match.view_name if match else request.path
+        suspects = profile.repeated_queries(self.threshold)
+
+        timings = [
+            f'db;dur={profile.db_time * 1000:.2f};desc="{profile.query_count} queries"',
+        ]
+        for name, duration in profile.spans.items():
+            timings.append(f'{name};dur={duration * 1000:.2f}')
+        timings.append(f'total;dur={total * 1000:.2f}')
+        if suspects:
+            timings.append(f'nplusone;desc="{len(suspects)} suspected"')
+        response['Server-Timing'] = ', '.join(timings)
+
+        fields = {
+            'method': request.method,
+            'path': request.path,
+            'view': view_name,
+            'status': response.status_code,
+            'queries': profile.query_count,
+            'db_ms': round(profile.db_time * 1000, 2),
+            'serialize_ms': round(profile.spans.get('serialize', 0.0) * 1000, 2),
+            'render_ms': round(profile.spans.get('render', 0.0) * 1000, 2),
+            'total_ms': round(total * 1000, 2),
+        }
+        logger.info(
+            ' '.join(f'{key}={value}' for key, value in fields.items()),
+            extra={'request_metrics': fields},
+        )
+        for sql, count in suspects:
+            logger.warning(
+                'Suspected N+1 in %s: %d executions of %s', view_name, count, sql,
+                extra={'view': view_name, 'repeat_count': count, 'sql': sql},
+            )
+
+
+@database_sync_to_async
+def _jwt_user(raw_token):
+    authentication = JWTAuthentication()
+    try:
+        return authentication.get_user(authentication.get_validated_token(raw_token))
+    except (InvalidToken, AuthenticationFailed):
+        return AnonymousUser()
+
+
+class JWTAuthMiddleware(BaseMiddleware):
+    """
+    Authenticates WebSocket connections with the JWT access token in their
+    `token` query parameter, since browsers cannot set headers on WebSocket
+    requests. Connections without one keep the session user.
+    """
+
+    async def __call__(self, scope, receive, send):
+        token = parse_qs(scope.get('query_string', b'').decode()).get('token')
+        if token:
+            scope = dict(scope, user=await _jwt_user(token[0]))
+        return await super().__call__(scope, receive, send)
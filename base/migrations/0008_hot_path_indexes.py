@@ -0,0 +1,29 @@
+# Generated by Django 5.2.7 on 2026-10-19 10:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0007_archivesegment'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['-updated', '-created'], name='base_messag_updated_6efc2b_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['room', '-updated', '-created'], name='base_messag_room_id_75a9fd_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['user', '-updated', '-created'], name='base_messag_user_id_05d8cb_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='room',
+            index=models.Index(fields=['-updated', '-created'], name='base_room_updated_3415ed_idx'),
+        ),
+    ]
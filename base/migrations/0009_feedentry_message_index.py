@@ -0,0 +1,17 @@
+# Generated by Django 5.2.7 on 2026-10-19 10:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0008_hot_path_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='feedentry',
+            index=models.Index(fields=['message_id'], name='base_feeden_message_36b665_idx'),
+        ),
+    ]
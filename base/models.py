@@ -1,5 +1,10 @@
-from django.db import models
+from collections import defaultdict
+
+from django.db import models, transaction
+from django.db.models import F, Window
+from django.db.models.functions import RowNumber
 from django.contrib.auth.models import AbstractUser
+from django.utils import timezone
 
 
 
@@ -8,6 +13,7 @@ class User(AbstractUser):
     email = models.EmailField(unique=True, null=True)
     bio = models.TextField(null=True) 
     avatar = models.ImageField(null=True, default="avatar.svg")
+    avatar_hash = models.CharField(max_length=32, blank=True, default='')
     USERNAME_FIELD ='email'
     REQUIRED_FIELDS = []
 
@@ -30,15 +36,42 @@ class Room(models.Model):
     description = models.TextField(null=True , blank=True)
 
     participants = models.ManyToManyField(User, related_name='participants', blank=True)
+    last_seq = models.PositiveBigIntegerField(default=0, editable=False)
     updated = models.DateTimeField(auto_now=True)
     created = models.DateTimeField(auto_now_add=True)
 
     class Meta:
         ordering = ['-updated', '-created']
+        # Room lists read this index in order instead of sorting every room
+        indexes = [models.Index(fields=['-updated', '-created'])]
 
     def __str__ (self):
         return self.name
 
+    @staticmethod
+    def allocate_seq(room_id, count=1):
+        """Reserve `count` consecutive message sequence numbers and return the first"""
+        # The row lock taken by the UPDATE serializes concurrent writers to the room
+        with transaction.atomic(savepoint=False):
+            Room.objects.filter(pk=room_id).update(last_seq=F('last_seq') + count)
+            last_seq = Room.objects.filter(pk=room_id).values_list('last_seq', flat=True).get()
+        return last_seq - count + 1
+
+    @staticmethod
+    def participant_previews(room_ids, size):
+        """{room_id: [first `size` members by join time]} for many rooms in one windowed query"""
+        memberships = (
+            Room.participants.through.objects.filter(room_id__in=room_ids)
+            .annotate(position=Window(RowNumber(), partition_by=F('room_id'), order_by=F('id').asc()))
+            .filter(position__lte=size)
+            .select_related('user')
+            .order_by('room_id', 'position')
+        )
+        previews = defaultdict(list)
+        for membership in memberships:
+            previews[membership.room_id].append(membership.user)
+        return previews
+
 
 
 
@@ -47,11 +80,105 @@ class Message(models.Model):
     user = models.ForeignKey(User , on_delete=models.CASCADE)
     room = models.ForeignKey(Room , on_delete=models.CASCADE)
     body = models.TextField()
+    # Position within the room, assigned on insert: 1, 2, 3, ...
+    seq = models.PositiveBigIntegerField(null=True, editable=False)
     updated = models.DateTimeField(auto_now=True)
     created = models.DateTimeField(auto_now_add=True)
 
     class Meta:
         ordering = ['-updated', '-created']
+        # Message lists (all, ?room=, ?user=) and a room's prefetched messages
+        # read one of these in order instead of sorting the matching rows
+        indexes = [
+            models.Index(fields=['-updated', '-created']),
+            models.Index(fields=['room', '-updated', '-created']),
+            models.Index(fields=['user', '-updated', '-created']),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['room', 'seq'], name='unique_message_seq_per_room'),
+        ]
+
+    def __str__(self):
+        return self.body[0:50]
+
+    def save(self, *args, **kwargs):
+        if self._state.adding and self.seq is None:
+            from . import sharding
+            if sharding.enabled():
+                # Always goes to the room's shard, whatever `using` says
+                return sharding.insert_message(self)
+            # Allocate and insert together so a failed insert leaves no gap
+            with transaction.atomic(savepoint=False):
+                self.seq = Room.allocate_seq(self.room_id)
+                return super().save(*args, **kwargs)
+        return super().save(*args, **kwargs)
+
+
+
+
+class ReadMarker(models.Model):
+    """How far a user has read in a room; unread = room.last_seq - last_read_seq"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='read_markers')
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='read_markers')
+    last_read_seq = models.PositiveBigIntegerField(default=0)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'room'], name='unique_read_marker'),
+        ]
+
+    @staticmethod
+    def advance(user_id, room_id, seq):
+        """Move the user's marker in the room up to `seq`, creating it if there is none; never moves it back"""
+        moved = ReadMarker.objects.filter(user_id=user_id, room_id=room_id, last_read_seq__lt=seq).update(
+            last_read_seq=seq, updated=timezone.now(),
+        )
+        if not moved:
+            # No marker yet, or one already at or past seq (which the conflict leaves alone)
+            ReadMarker.objects.bulk_create(
+                [ReadMarker(user_id=user_id, room_id=room_id, last_read_seq=seq)], ignore_conflicts=True,
+            )
+
+
+
+class FeedEntry(models.Model):
+    """A message as it appears in one member's activity feed (fan-out-on-write)"""
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name='feed_entries')
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='+')
+    author = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    message_id = models.BigIntegerField()
+    preview = models.CharField(max_length=140)
+    created = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['owner', '-message_id']),
+            # Edits and deletes of a message find its entries in every feed
+            models.Index(fields=['message_id']),
+        ]
+
+    def __str__(self):
+        return self.preview[0:50]
+
+
+
+class ArchiveSegment(models.Model):
+    """A compressed run of a room's oldest messages, moved out of Message (see base/archive.py)"""
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='archive_segments')
+    first_seq = models.PositiveBigIntegerField()
+    last_seq = models.PositiveBigIntegerField()
+    message_count = models.PositiveIntegerField()
+    first_created = models.DateTimeField()
+    last_created = models.DateTimeField()
+    # zlib-compressed JSON lines, one message per line in seq order
+    data = models.BinaryField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['room', 'first_seq'], name='unique_archive_segment_start'),
+        ]
 
     def __str__(self):
-        return self.body[0:50]
\ No newline at end of file
+        return f'{self.room_id}: {self.first_seq}-{self.last_seq}'
@@ -0,0 +1,213 @@
+"""
+Query plans of the hot API endpoints and chat consumer queries.
+
+check() runs each scenario for real, inside a transaction that is rolled back,
+records every SELECT it issues and asks the database to EXPLAIN it. Two kinds
+of plan are reported:
+
+  - `scan`: a table read from end to end without an index
+  - `sort`: rows sorted in a temporary B-tree after they were read (ORDER BY,
+    GROUP BY or DISTINCT that no index delivers in order)
+
+Both grow with the table, so they are the plans that quietly turn a fast
+endpoint slow once there is real data. Findings that are expected and
+accepted are listed in ALLOWED with the reason; anything else fails
+`check_query_plans`. SQLite (EXPLAIN QUERY PLAN) and PostgreSQL (EXPLAIN)
+are understood.
+"""
+import inspect
+import re
+from contextlib import ExitStack
+from dataclasses import dataclass
+
+from django.db import connections, transaction
+from rest_framework.test import APIClient
+
+from .consumers import ChatConsumer, MultiplexConsumer
+from .models import Message, Room, Topic, User
+from .sockets import ConnectionState
+
+# (name, path) of API requests; {room}, {topic}, {message} and {user} are filled in
+API_SCENARIOS = [
+    ('room list', '/api/v1/rooms/'),
+    ('room search', '/api/v1/rooms/?q=plan'),
+    ('room topic filter', '/api/v1/rooms/?topic=plan'),
+    ('room detail', '/api/v1/rooms/{room}/'),
+    ('room participants', '/api/v1/rooms/{room}/participants/'),
+    ('room history', '/api/v1/rooms/{room}/history/'),
+    ('unread counts', '/api/v1/rooms/unread/'),
+    ('message list', '/api/v1/messages/'),
+    ('message list by room', '/api/v1/messages/?room={room}'),
+    ('message list by user', '/api/v1/messages/?user={user}'),
+    ('message detail', '/api/v1/messages/{message}/'),
+    ('topic list', '/api/v1/topics/'),
+    ('topic search', '/api/v1/topics/?q=plan'),
+    ('topic detail', '/api/v1/topics/{topic}/'),
+    ('feed', '/api/v1/feed/'),
+]
+
+# (kind, table or sort, regex the SQL matches, why the plan is acceptable)
+ALLOWED = [
+    ('scan', 'base_room', r'"base_room"\."name" LIKE',
+     'room search (?q=) matches substrings of names and descriptions, which no B-tree index serves'),
+    ('scan', 'base_topic', r'"base_topic"\."name" LIKE',
+     'topic name filters match substrings; topics are few'),
+    ('scan', 'base_topic', r'^SELECT .* FROM "base_topic" LEFT OUTER JOIN "base_room"',
+     'the topic list pages through every topic with its room count; topics are few'),
+    ('sort', 'ORDER BY', r'\) "qualify" WHERE "position" <=',
+     'participant previews sort only the few members kept per listed room'),
+    ('sort', 'RIGHT PART OF ORDER BY', r'"base_message"\."created" DESC, "base_message"\."id" DESC',
+     'sharded message lists break ties on id; the index delivers the timestamps, so only rows sharing one are sorted'),
+]
+
+
+@dataclass
+class Finding:
+    scenario: str
+    kind: str
+    target: str
+    detail: str
+    sql: str
+    reason: str = ''
+
+
+def _sync(consumer_class, name):
+    # The function under @database_sync_to_async, to run on this thread's connection
+    return inspect.getattr_static(consumer_class, name).func
+
+
+def chat_save_message(fixture):
+    _sync(ChatConsumer, 'save_message')(ChatConsumer(), fixture.user.id, fixture.room.id, 'plan check')
+
+
+def chat_is_member(fixture):
+    consumer = MultiplexConsumer()
+    consumer.state = ConnectionState(fixture.user.id, None)
+    _sync(MultiplexConsumer, 'is_member')(consumer, fixture.room.id)
+
+
+# (name, function of the fixture) calling what the consumers run in their database threads
+CONSUMER_SCENARIOS = [
+    ('chat save message', chat_save_message),
+    ('chat membership check', chat_is_member),
+]
+
+
+class Fixture:
+    """A user, topic, room and message for the scenarios to point at"""
+
+    def __init__(self):
+        self.user = User.objects.create(username='plan-check', email='plan-check@example.com')
+        self.topic = Topic.objects.create(name='plan check')
+        self.room = Room.objects.create(host=self.user, topic=self.topic, name='plan check')
+        self.room.participants.add(self.user)
+        self.message = Message.objects.create(user=self.user, room=self.room, body='plan check')
+
+    def format(self, path):
+        return path.format(room=self.room.id, topic=self.topic.id, message=self.message.id, user=self.user.id)
+
+
+class Recorder:
+    """execute_wrapper that keeps the SELECTs run on one connection"""
+
+    def __init__(self, alias):
+        self.alias = alias
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        if not many and sql.lstrip().upper().startswith('SELECT'):
+            self.queries.append((sql, params))
+        return execute(sql, params, many, context)
+
+
+def record(run):
+    """[(alias, sql, params)] of the SELECTs issued by run() on every database"""
+    recorders = [Recorder(alias) for alias in connections]
+    with ExitStack() as stack:
+        for recorder in recorders:
+            stack.enter_context(connections[recorder.alias].execute_wrapper(recorder))
+        run()
+    return [(recorder.alias, sql, params) for recorder in recorders for sql, params in recorder.queries]
+
+
+_SQLITE_SCAN = re.compile(r'^SCAN (\w+)(?: AS \w+)?$')
+_SQLITE_SORT = re.compile(r'^USE TEMP B-TREE FOR (.+)$')
+_POSTGRES_SCAN = re.compile(r'Seq Scan on (\w+)')
+_POSTGRES_SORT = re.compile(r'(?:->\s*)?(?:Incremental )?Sort\b')
+
+
+def explain(alias, sql, params):
+    """The plan of one query as [(kind, target, plan line)] for its scans and sorts"""
+    connection = connections[alias]
+    tables = set(connection.introspection.table_names())
+    issues = []
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+            for row in cursor.fetchall():
+                detail = row[-1]
+                scan = _SQLITE_SCAN.match(detail)
+                sort = _SQLITE_SORT.match(detail)
+                # Scans of subqueries and CTEs are of rows already narrowed down
+                if scan and scan.group(1) in tables:
+                    issues.append(('scan', scan.group(1), detail))
+                elif sort:
+                    issues.append(('sort', sort.group(1), detail))
+        elif connection.vendor == 'postgresql':
+            cursor.execute(f'EXPLAIN {sql}', params)
+            for (detail,) in cursor.fetchall():
+                scan = _POSTGRES_SCAN.search(detail)
+                if scan and scan.group(1) in tables:
+                    issues.append(('scan', scan.group(1), detail.strip()))
+                elif _POSTGRES_SORT.match(detail.strip()):
+                    issues.append(('sort', 'ORDER BY', detail.strip()))
+        else:
+            raise NotImplementedError(f'No plan reader for {connection.vendor}')
+    return issues
+
+
+def allowed(kind, target, sql):
+    """Why this scan or sort is accepted, or '' when it is not"""
+    for allowed_kind, allowed_target, pattern, reason in ALLOWED:
+        if (kind, target) == (allowed_kind, allowed_target) and re.search(pattern, sql):
+            return reason
+    return ''
+
+
+def check(scenarios=None):
+    """Findings of every scenario (or those named), with `reason` set on the allowed ones"""
+    findings = []
+    with ExitStack() as stack:
+        for alias in connections:
+            stack.enter_context(transaction.atomic(using=alias))
+        fixture = Fixture()
+        client = APIClient(HTTP_HOST='localhost')
+        client.force_authenticate(fixture.user)
+        runs = [
+            (name, lambda path=path: _get(client, fixture.format(path))) for name, path in API_SCENARIOS
+        ] + [
+            (name, lambda run=run: run(fixture)) for name, run in CONSUMER_SCENARIOS
+        ]
+        for name, run in runs:
+            if scenarios and name not in scenarios:
+                continue
+            seen = set()
+            for alias, sql, params in record(run):
+                for kind, target, detail in explain(alias, sql, params):
+                    if (kind, target, sql) in seen:
+                        continue
+                    seen.add((kind, target, sql))
+                    findings.append(Finding(name, kind, target, detail, sql, allowed(kind, target, sql)))
+        for alias in connections:
+            transaction.set_rollback(True, using=alias)
+    return findings
+
+
+def _get(client, path):
+    response = client.get(path)
+    if response.status_code != 200:
+        raise RuntimeError(f'GET {path} returned {response.status_code}')
+
+
+def scenario_names():
+    return [name for name, _ in API_SCENARIOS] + [name for name, _ in CONSUMER_SCENARIOS]
@@ -0,0 +1,60 @@
+"""
+Token buckets for inbound WebSocket limits.
+
+A bucket holds up to `capacity` tokens and refills at `rate` tokens per
+second; take() spends one. Refill is computed lazily from the monotonic clock,
+so a check is a few float operations and no timers or locks are needed on the
+event loop. BucketMap keeps one bucket per key (e.g. per user), evicting the
+least recently used key once it holds `max_size` of them.
+"""
+import time
+from collections import OrderedDict
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def take(self, now=None):
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def retry_after(self):
+        """Seconds until the next token is available"""
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate if self.rate else float('inf')
+
+
+class BucketMap:
+    def __init__(self, rate, capacity, max_size=10000):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_size = max_size
+        self.buckets = OrderedDict()
+
+    def get(self, key):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(self.rate, self.capacity)
+            if len(self.buckets) > self.max_size:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+        return bucket
+
+    def take(self, key, now=None):
+        return self.get(key).take(now)
+
+    def clear(self):
+        self.buckets.clear()
@@ -0,0 +1,174 @@
+"""
+Room list deltas for `ws/rooms/` subscribers.
+
+The room views report what they changed with room_created(), room_updated(),
+room_deleted() and counts_changed(), which joins, leaves and every new
+message (REST, chat socket or bulk ingest) call. Once the transaction commits, each
+change is sent as one small event to the `rooms` group and to the group of
+the room's topic, so filtered subscribers never hear about other topics. A
+room that moves between topics is deleted for the old topic's subscribers
+and created for the new one's.
+
+counts_changed() runs no queries: its event only says when the counts
+changed. RoomListConsumer merges the events that arrive within
+ROOM_LIST_WINDOW seconds with merge(), fills in the current counts with
+fill_counts() and sends them as one frame, so a burst of messages to a busy
+room is counted once per window and reaches each client as a single update.
+
+Events are dicts with an `op` and the room `id`:
+  - created/updated: `name`, `topic` ({id, name} or null), `host` (user id)
+    and, for created, the counts
+  - counts: `participant_count` and `message_count`, filled in by
+    fill_counts() from the `changed` time the event is published with
+  - deleted: nothing else
+"""
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, Sum
+
+from . import sharding
+from .models import ArchiveSegment, Room
+
+ALL_GROUP = 'rooms'
+
+# Cached counts are reused while no change is newer than the read; the timeout only bounds memory
+COUNTS_CACHE_TIMEOUT = 60
+
+# Later ops win when two are merged: a room created in the window stays
+# created however often it changes before the frame goes out
+_RANK = {'counts': 0, 'updated': 1, 'created': 2}
+
+
+def topic_group(topic_id):
+    return f'rooms_topic_{topic_id}'
+
+
+def snapshot(room):
+    topic = room.topic
+    return {
+        'id': room.id,
+        'name': room.name,
+        'topic': {'id': topic.id, 'name': topic.name} if topic is not None else None,
+        'host': room.host_id,
+    }
+
+
+def _groups(topic_id):
+    return [ALL_GROUP] if topic_id is None else [ALL_GROUP, topic_group(topic_id)]
+
+
+def _publish(event, groups):
+    """Send `event` (or what calling it returns) to `groups` once the transaction commits"""
+    def send():
+        layer = get_channel_layer()
+        if layer is None:
+            return
+        message = {'type': 'room.event', 'event': event() if callable(event) else event}
+        for group in groups:
+            async_to_sync(layer.group_send)(group, message)
+
+    transaction.on_commit(send)
+
+
+def room_created(room, participant_count):
+    event = {'op': 'created', **snapshot(room), 'participant_count': participant_count, 'message_count': 0}
+    _publish(event, _groups(room.topic_id))
+
+
+def room_updated(room, previous_topic_id):
+    event = {'op': 'updated', **snapshot(room)}
+    if previous_topic_id == room.topic_id:
+        _publish(event, _groups(room.topic_id))
+        return
+    # Subscribers of the old topic drop the room; those of the new one add it
+    _publish(event, [ALL_GROUP])
+    if previous_topic_id is not None:
+        _publish({'op': 'deleted', 'id': room.id}, [topic_group(previous_topic_id)])
+    if room.topic_id is not None:
+        _publish({**event, 'op': 'created'}, [topic_group(room.topic_id)])
+
+
+def room_deleted(room_id, topic_id):
+    _publish({'op': 'deleted', 'id': room_id}, _groups(topic_id))
+
+
+def counts_changed(room):
+    # Timed after commit, so counts read later include this change
+    _publish(lambda: {'op': 'counts', 'id': room.id, 'changed': time.time()}, _groups(room.topic_id))
+
+
+def room_counts(room_ids):
+    """{room_id: {participant_count, message_count}} with one grouped query per table (and shard)"""
+    participants = dict(
+        Room.participants.through.objects.filter(room_id__in=room_ids)
+        .order_by().values('room_id').annotate(total=Count('id')).values_list('room_id', 'total')
+    )
+    archived = dict(
+        ArchiveSegment.objects.filter(room_id__in=room_ids)
+        .order_by().values('room_id').annotate(total=Sum('message_count')).values_list('room_id', 'total')
+    )
+    hot = sharding.hot_message_counts(room_ids)
+    return {
+        room_id: {
+            'participant_count': participants.get(room_id, 0),
+            'message_count': archived.get(room_id, 0) + hot.get(room_id, 0),
+        }
+        for room_id in room_ids
+    }
+
+
+def _counts_key(room_id):
+    return f'room_counts:{room_id}'
+
+
+def fill_counts(events):
+    """
+    Copies of `events` with the current counts on those that carry a `changed`
+    time. Counts read since that time by any subscriber sharing the cache are
+    reused, so each room is counted about once per window however many
+    clients listen.
+    """
+    changed = {event['id']: event['changed'] for event in events if 'changed' in event}
+    if not changed:
+        return events
+    cached = cache.get_many([_counts_key(room_id) for room_id in changed])
+    counts = {}
+    for room_id, changed_at in changed.items():
+        entry = cached.get(_counts_key(room_id))
+        if entry is not None and entry[0] >= changed_at:
+            counts[room_id] = entry[1]
+    stale = [room_id for room_id in changed if room_id not in counts]
+    if stale:
+        # Taken before reading, so a change committed during the read is not mistaken for included
+        read_at = time.time()
+        fresh = room_counts(stale)
+        cache.set_many({_counts_key(room_id): (read_at, fresh[room_id]) for room_id in stale}, COUNTS_CACHE_TIMEOUT)
+        counts.update(fresh)
+    filled = []
+    for event in events:
+        if 'changed' in event:
+            event = {key: value for key, value in event.items() if key != 'changed'}
+            event.update(counts[event['id']])
+        filled.append(event)
+    return filled
+
+
+def merge(pending, event):
+    """Fold `event` into `pending` ({room_id: event}, in first-seen order)"""
+    room_id = event['id']
+    previous = pending.get(room_id)
+    if previous is None or event['op'] == 'deleted':
+        # A room created and deleted in one window still goes out as deleted:
+        # a topic subscriber may have had it before it moved away and back
+        pending[room_id] = event
+    elif previous['op'] == 'deleted':
+        # Counts for a deleted room are stale; a new snapshot brings it back
+        if event['op'] != 'counts':
+            pending[room_id] = event
+    else:
+        op = max(previous['op'], event['op'], key=_RANK.__getitem__)
+        pending[room_id] = {**previous, **event, 'op': op}
@@ -0,0 +1,387 @@
+"""
+Optional sharding of the Message table across SQLite databases.
+
+SQLite lets one writer at a time into a database file, so with every message
+in one file all chat traffic queues on one lock. With MESSAGE_SHARDS = N > 0
+the settings add the aliases messages_0 .. messages_{N-1} and
+MessageShardRouter: a room's messages live in shard room_id % N and
+everything else stays in `default`, so rooms on different shards are written
+in parallel.
+
+In sharded mode:
+  - Message ids come from make_id(): time-ordered, unique across shards and
+    tagged with the shard that created them, so the feed can keep ordering
+    by id and a detail lookup usually needs one query.
+  - The INSERT itself picks the next seq from the shard's highest seq for
+    the room, and Room.last_seq catches up in batches at most
+    MESSAGE_SHARD_SEQ_FLUSH_INTERVAL seconds later, so writing a message
+    does not write `default`.
+  - Shards hold no users or rooms: messages load them with prefetch_related()
+    instead of select_related(), SQLite does not enforce their foreign keys,
+    and deleting a room or user deletes its messages through signals.
+  - Queries that are not limited to one room run on every shard and are
+    merged (ShardedQuery).
+
+After changing N (or turning sharding on over an existing database), move
+rows to their new home with `python manage.py rebalance_message_shards`.
+"""
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+from collections import defaultdict
+from operator import attrgetter
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, close_old_connections, connections, transaction
+from django.db.backends.signals import connection_created
+from django.db.models import Count, Max, prefetch_related_objects
+from django.db.models.signals import post_delete, post_migrate, post_save, pre_save
+from django.dispatch import receiver
+from django.http import Http404
+from django.utils import timezone
+
+from .models import Message, Room, User
+
+logger = logging.getLogger(__name__)
+
+SHARD_PREFIX = 'messages_'
+
+# make_id(): milliseconds since EPOCH_MS, then the shard, then a counter, in
+# 53 bits so ids stay exact as JavaScript numbers
+EPOCH_MS = 1704067200000  # 2024-01-01
+SHARD_BITS = 4
+COUNTER_BITS = 8
+MAX_SHARDS = 1 << SHARD_BITS
+INSERT_ATTEMPTS = 5
+
+_last_ids = {}
+_id_lock = threading.Lock()
+_write_locks = {}
+
+
+def enabled():
+    return settings.MESSAGE_SHARDS > 0
+
+
+def aliases():
+    """Aliases that rooms are placed in"""
+    return [f'{SHARD_PREFIX}{index}' for index in range(settings.MESSAGE_SHARDS)]
+
+
+def configured_aliases():
+    """Every shard alias in DATABASES, including retired ones still being drained"""
+    return sorted((alias for alias in settings.DATABASES if alias.startswith(SHARD_PREFIX)), key=shard_index)
+
+
+def shard_index(alias):
+    return int(alias[len(SHARD_PREFIX):])
+
+
+def shard_for_room(room_id):
+    """The alias holding a room's messages (`default` when sharding is off)"""
+    if not enabled():
+        return DEFAULT_DB_ALIAS
+    return f'{SHARD_PREFIX}{int(room_id) % settings.MESSAGE_SHARDS}'
+
+
+def room_messages(room_id):
+    return Message.objects.using(shard_for_room(room_id)).filter(room_id=room_id)
+
+
+def with_users(queryset):
+    """Load message authors with the query, or with a second one when they live in another database"""
+    return queryset.prefetch_related('user') if enabled() else queryset.select_related('user')
+
+
+def make_id(alias):
+    shard = shard_index(alias)
+    now = (int(time.time() * 1000) - EPOCH_MS) << COUNTER_BITS
+    with _id_lock:
+        # Strictly increasing per shard within a process: a burst of more than
+        # 2**COUNTER_BITS ids in one millisecond borrows from the next one. The
+        # random start makes collisions between processes unlikely; inserts
+        # retry on the ones that happen.
+        value = _last_ids[shard] = max(_last_ids.get(shard, 0) + 1, now | random.randrange(1 << (COUNTER_BITS - 1)))
+    counter = value & ((1 << COUNTER_BITS) - 1)
+    return ((value >> COUNTER_BITS) << (SHARD_BITS + COUNTER_BITS)) | (shard << COUNTER_BITS) | counter
+
+
+def shard_of_id(message_id):
+    return f'{SHARD_PREFIX}{(int(message_id) >> COUNTER_BITS) % MAX_SHARDS}'
+
+
+class MessageShardRouter:
+    """Sends Message to its room's shard and every other model to `default`"""
+
+    def __init__(self):
+        if settings.MESSAGE_SHARDS > MAX_SHARDS:
+            raise ImproperlyConfigured(f'MESSAGE_SHARDS can be at most {MAX_SHARDS}')
+
+    def _route(self, model, instance=None, **hints):
+        if model is not Message:
+            return DEFAULT_DB_ALIAS
+        if isinstance(instance, Message) and instance.room_id is not None:
+            return shard_for_room(instance.room_id)
+        if isinstance(instance, Room) and instance.pk is not None:
+            return shard_for_room(instance.pk)
+        return None
+
+    db_for_read = _route
+    db_for_write = _route
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if isinstance(obj1, Message) or isinstance(obj2, Message):
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db.startswith(SHARD_PREFIX):
+            return app_label == Message._meta.app_label and model_name == Message._meta.model_name
+        return None
+
+
+@receiver(connection_created, dispatch_uid='message_shard_connection')
+def relax_shard_foreign_keys(sender, connection, **kwargs):
+    # The users and rooms that shard rows point at live in `default`
+    if connection.alias.startswith(SHARD_PREFIX):
+        connection.disable_constraint_checking()
+
+
+@receiver(post_migrate, dispatch_uid='message_shard_migrated')
+def relax_after_migrate(sender, using, **kwargs):
+    # Migrating turns foreign key checks back on for the connection it used
+    relax_shard_foreign_keys(sender, connections[using])
+
+
+# ==================== WRITES ====================
+
+class SeqFlusher:
+    """Raises Room.last_seq to the seqs handed out by shard inserts, in batches"""
+
+    def __init__(self):
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.timer = None
+
+    def add(self, room_id, seq):
+        with self.lock:
+            if seq > self.pending.get(room_id, 0):
+                self.pending[room_id] = seq
+            if self.timer is None:
+                self.timer = threading.Timer(settings.MESSAGE_SHARD_SEQ_FLUSH_INTERVAL, self._flush_in_background)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        if not pending:
+            return 0
+        with transaction.atomic():
+            for room_id, seq in pending.items():
+                Room.objects.filter(pk=room_id, last_seq__lt=seq).update(last_seq=seq)
+        return len(pending)
+
+    def _flush_in_background(self):
+        try:
+            self.flush()
+        except Exception:
+            logger.exception('Flushing room sequence numbers failed')
+        finally:
+            close_old_connections()
+
+
+seq_flusher = SeqFlusher()
+
+
+def _insert_sql(alias):
+    connection = connections[alias]
+    quote = connection.ops.quote_name
+    columns = [Message._meta.get_field(name).column for name in ('id', 'user', 'room', 'body', 'seq', 'created', 'updated')]
+    table = quote(Message._meta.db_table)
+    return (
+        f'INSERT INTO {table} ({", ".join(quote(column) for column in columns)}) '
+        f'SELECT %s, %s, %s, %s, MAX(COALESCE(MAX({quote("seq")}), 0), %s) + 1, %s, %s '
+        f'FROM {table} WHERE {quote("room_id")} = %s RETURNING {quote("seq")}'
+    )
+
+
+def insert_message(message):
+    """
+    Insert a new message into its room's shard, assigning its id, seq and
+    timestamps. The seq comes from the same statement as the insert, so
+    writers to one shard cannot hand out the same seq.
+    """
+    alias = shard_for_room(message.room_id)
+    connection = connections[alias]
+    message.created = message.updated = timezone.now()
+    created = connection.ops.adapt_datetimefield_value(message.created)
+    pre_save.send(sender=Message, instance=message, raw=False, using=alias, update_fields=None)
+    for attempt in range(INSERT_ATTEMPTS):
+        # Room.last_seq may be ahead of the shard's rows (archived or bulk-loaded
+        # messages); reading it also stands in for the unenforced foreign key
+        floor = Room.objects.filter(pk=message.room_id).values_list('last_seq', flat=True).first()
+        if floor is None:
+            raise Room.DoesNotExist(f'Room {message.room_id} does not exist')
+        message.id = make_id(alias)
+        try:
+            # Writers in this process queue here rather than in SQLite's busy
+            # handler, which polls with sleeps of up to 100 ms
+            with _write_locks.setdefault(alias, threading.Lock()), transaction.atomic(using=alias), connection.cursor() as cursor:
+                cursor.execute(_insert_sql(alias), [
+                    message.id, message.user_id, message.room_id, message.body, floor, created, created, message.room_id,
+                ])
+                message.seq = cursor.fetchone()[0]
+            break
+        except IntegrityError:
+            # Another process took the same id in the same millisecond, or a bulk
+            # load reserved this seq; try again with fresh values
+            if attempt == INSERT_ATTEMPTS - 1:
+                raise
+    message._state.adding = False
+    message._state.db = alias
+    seq_flusher.add(message.room_id, message.seq)
+    post_save.send(sender=Message, instance=message, created=True, raw=False, using=alias, update_fields=None)
+
+
+def reserve_seqs(counts):
+    """
+    {room_id: first seq} for {room_id: count} new messages, reserved on
+    Room.last_seq as Room.allocate_seq() does, after raising it past seqs that
+    shard inserts have handed out but not flushed yet
+    """
+    seq_flusher.flush()
+    highest = _per_room(counts, Max('seq'))
+    with transaction.atomic():
+        for room_id, seq in highest.items():
+            Room.objects.filter(pk=room_id, last_seq__lt=seq).update(last_seq=seq)
+        return {room_id: Room.allocate_seq(room_id, count) for room_id, count in counts.items()}
+
+
+def move_room(room_id, source, target, batch_size=1000):
+    """Copy a room's messages from `source` to `target` and delete them from `source`; returns the count"""
+    fields = ('id', 'user_id', 'room_id', 'body', 'seq', 'created', 'updated')
+    connection = connections[target]
+    quote = connection.ops.quote_name
+    sql = (
+        f'INSERT OR IGNORE INTO {quote(Message._meta.db_table)} ({", ".join(quote(field) for field in fields)}) '
+        f'VALUES ({", ".join(["%s"] * len(fields))})'
+    )
+    adapt = connection.ops.adapt_datetimefield_value
+    moved = 0
+    while True:
+        rows = list(Message.objects.using(source).filter(room_id=room_id).order_by('id').values_list(*fields)[:batch_size])
+        if not rows:
+            return moved
+        # Copy before deleting: a failure in between leaves duplicates that the
+        # next run skips, never lost messages
+        with transaction.atomic(using=target), connection.cursor() as cursor:
+            cursor.executemany(sql, [(*row[:5], adapt(row[5]), adapt(row[6])) for row in rows])
+        with transaction.atomic(using=source):
+            Message.objects.using(source).filter(id__in=[row[0] for row in rows]).delete()
+        moved += len(rows)
+
+
+@receiver(post_delete, sender=Room, dispatch_uid='message_shard_room_deleted')
+def room_deleted(sender, instance, **kwargs):
+    if enabled():
+        room_messages(instance.pk).delete()
+
+
+@receiver(post_delete, sender=User, dispatch_uid='message_shard_user_deleted')
+def user_deleted(sender, instance, **kwargs):
+    if enabled():
+        for alias in aliases():
+            Message.objects.using(alias).filter(user_id=instance.pk).delete()
+
+
+# ==================== READS ====================
+
+def get_message(message_id):
+    """A message by id from whichever shard holds it; raises Http404"""
+    try:
+        message_id = int(message_id)
+    except (TypeError, ValueError):
+        raise Http404
+    # The shard in the id is where the message was created; rebalancing may
+    # have moved it since
+    home = shard_of_id(message_id)
+    candidates = [home] if home in aliases() else []
+    for alias in candidates + [alias for alias in aliases() if alias != home]:
+        message = Message.objects.using(alias).filter(id=message_id).first()
+        if message is not None:
+            return message
+    raise Http404
+
+
+def _per_room(room_ids, aggregate):
+    """{room_id: aggregate over the room's messages} with one query per shard involved"""
+    by_shard = defaultdict(list)
+    for room_id in room_ids:
+        by_shard[shard_for_room(room_id)].append(room_id)
+    values = {}
+    for alias, ids in by_shard.items():
+        values.update(
+            Message.objects.using(alias).filter(room_id__in=ids)
+            .order_by().values('room_id').annotate(value=aggregate).values_list('room_id', 'value')
+        )
+    return values
+
+
+def hot_message_counts(room_ids):
+    return _per_room(room_ids, Count('id'))
+
+
+class ShardedQuery:
+    """
+    A Message queryset run on every shard and merged in `ordering` (all
+    fields descending or all ascending). Supports count(), iteration and
+    slicing, which is what pagination needs: a slice ending at `stop` reads
+    at most `stop` rows from each shard. Relations in `prefetch` are loaded
+    once for the merged rows.
+    """
+    ordered = True
+
+    def __init__(self, queryset, ordering=('-updated', '-created', '-id'), prefetch=()):
+        descending = {field.startswith('-') for field in ordering}
+        if len(descending) != 1:
+            raise ValueError('ordering fields must all sort the same way')
+        self.reverse = descending.pop()
+        self.key = attrgetter(*(field.lstrip('-') for field in ordering))
+        self.queryset = queryset.order_by(*ordering)
+        self.model = queryset.model
+        self.prefetch = prefetch
+
+    def count(self):
+        return sum(self.queryset.using(alias).count() for alias in aliases())
+
+    def __len__(self):
+        return self.count()
+
+    def __iter__(self):
+        return iter(self._merge(0, None))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop = index.start or 0, index.stop
+            if start < 0 or (stop is not None and stop < 0) or index.step not in (None, 1):
+                raise ValueError('ShardedQuery supports non-negative slices only')
+            return self._merge(start, stop)
+        return self._merge(index, index + 1)[0]
+
+    def _merge(self, start, stop):
+        parts = [
+            self.queryset.using(alias) if stop is None else self.queryset.using(alias)[:stop]
+            for alias in aliases()
+        ]
+        rows = list(itertools.islice(heapq.merge(*parts, key=self.key, reverse=self.reverse), start, stop))
+        if self.prefetch:
+            prefetch_related_objects(rows, *self.prefetch)
+        return rows
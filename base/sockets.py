@@ -0,0 +1,177 @@
+"""
+Per-process state for chat sockets, kept small so a worker can hold tens of
+thousands of mostly idle connections.
+
+Chat consumers do not register with the channel layer themselves. The first
+local connection to a room creates its RoomHub, which owns the room's only
+layer channel and group membership in this process and delivers each chat
+event to the local connections, encoding it once per codec. The hub goes away
+with the room's last local connection. An idle connection therefore costs an
+entry in its hubs' sets and a slotted ConnectionState, instead of a layer
+queue, a receive task and a group registration of its own.
+
+With WS_IDLE_TIMEOUT set, one sweeper task per process closes connections
+that have neither sent nor received a frame for that long. Liveness of quiet
+but healthy peers is left to the server's WebSocket pings (see the README).
+"""
+import asyncio
+import logging
+import sys
+import time
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from . import log, metrics
+
+logger = logging.getLogger(__name__)
+
+# Pause before a hub asks the channel layer again after a failed receive
+RECEIVE_RETRY_DELAY = 1.0
+
+
+class ConnectionState:
+    """What a chat consumer keeps per connection; the rate limit bucket is only created by the first frame"""
+    __slots__ = ('connection_id', 'user_key', 'rate_key', 'codec', 'bucket', 'last_warning', 'last_active')
+
+    def __init__(self, user_key, codec, rate_key=None):
+        self.connection_id = log.new_id()
+        self.user_key = user_key
+        # Key of the bucket shared with the user's (or address's) other connections
+        self.rate_key = user_key if user_key is not None else rate_key
+        self.codec = codec
+        self.bucket = None
+        self.last_warning = 0.0
+        self.last_active = time.monotonic()
+
+
+class RoomHub:
+    __slots__ = ('room_id', 'group', 'connections', 'channel', 'task', 'loop', 'stopped')
+
+    def __init__(self, room_id):
+        self.room_id = room_id
+        self.group = group_name(room_id)
+        self.connections = set()
+        self.channel = None
+        self.task = None
+        self.loop = asyncio.get_running_loop()
+        self.stopped = False
+
+    async def start(self):
+        layer = get_channel_layer()
+        channel = await layer.new_channel()
+        await layer.group_add(self.group, channel)
+        if self.stopped:
+            # The last connection left while the channel was being set up
+            await layer.group_discard(self.group, channel)
+            return
+        self.channel = channel
+        self.task = asyncio.ensure_future(self.run(layer))
+
+    async def stop(self):
+        self.stopped = True
+        if self.task is not None:
+            self.task.cancel()
+        if self.channel is not None:
+            await get_channel_layer().group_discard(self.group, self.channel)
+
+    async def run(self, layer):
+        while True:
+            try:
+                event = await layer.receive(self.channel)
+            except Exception:
+                # A layer outage must not end delivery to the room for good
+                logger.exception('Receiving chat events for room %s failed', self.room_id)
+                await asyncio.sleep(RECEIVE_RETRY_DELAY)
+                continue
+            try:
+                await self.deliver(event)
+            except Exception:
+                logger.exception('Delivering a chat event to room %s failed', self.room_id)
+
+    async def deliver(self, event):
+        if 'sent_at' in event:
+            metrics.WS_FANOUT_LATENCY.observe(time.time() - event['sent_at'])
+        frames = {}
+        for consumer in list(self.connections):
+            codec = consumer.state.codec
+            frame = frames.get(codec)
+            if frame is None:
+                frame = frames[codec] = codec.encode_message(event)
+            try:
+                await consumer.send_frame(frame)
+            except Exception:
+                # One broken socket must not keep the event from the others
+                logger.exception('Sending a chat event to %s failed', consumer.state.connection_id)
+                continue
+            metrics.WS_MESSAGES_SENT.inc()
+
+
+_hubs = {}
+_connections = set()
+_sweeper = None
+
+
+def group_name(room_id):
+    # Interned so the hub, the metrics child and every broadcast share one string per room
+    return sys.intern(f'chat_{room_id}')
+
+
+async def join(room_id, consumer):
+    """Deliver the chat events of `room_id` to `consumer` until leave()"""
+    room_id = str(room_id)
+    hub = _hubs.get(room_id)
+    if hub is not None and hub.loop is not asyncio.get_running_loop():
+        # Left over from an event loop that has since closed (tests run one per case)
+        hub = None
+    if hub is None:
+        hub = _hubs[room_id] = RoomHub(room_id)
+        metrics.WS_ROOM_HUBS.inc()
+        hub.connections.add(consumer)
+        await hub.start()
+    else:
+        hub.connections.add(consumer)
+
+
+async def leave(room_id, consumer):
+    room_id = str(room_id)
+    hub = _hubs.get(room_id)
+    if hub is None or consumer not in hub.connections:
+        return
+    hub.connections.discard(consumer)
+    if not hub.connections:
+        del _hubs[room_id]
+        metrics.WS_ROOM_HUBS.dec()
+        await hub.stop()
+
+
+async def publish(room_id, event):
+    """Send a chat event to every process with connections in `room_id`"""
+    await get_channel_layer().group_send(group_name(room_id), event)
+
+
+def register(consumer):
+    """Track `consumer` for the idle sweeper"""
+    global _sweeper
+    _connections.add(consumer)
+    if settings.WS_IDLE_TIMEOUT and (_sweeper is None or _sweeper.done() or _sweeper.get_loop() is not asyncio.get_running_loop()):
+        _sweeper = asyncio.ensure_future(_sweep())
+
+
+def unregister(consumer):
+    _connections.discard(consumer)
+
+
+async def _sweep():
+    timeout = settings.WS_IDLE_TIMEOUT
+    while _connections:
+        await asyncio.sleep(min(timeout / 4, 30))
+        cutoff = time.monotonic() - timeout
+        for consumer in [consumer for consumer in _connections if consumer.state.last_active < cutoff]:
+            metrics.WS_IDLE_CLOSES.inc()
+            logger.info('Closing WebSocket %s after %ss idle', consumer.scope['path'], timeout)
+            await consumer.release()
+            try:
+                await consumer.close(code=settings.WS_IDLE_CLOSE_CODE)
+            except Exception:
+                logger.exception('Closing idle WebSocket %s failed', consumer.state.connection_id)
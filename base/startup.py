@@ -0,0 +1,117 @@
+"""
+Cold-start measurement for the `startup_report` command.
+
+measure() runs in a fresh interpreter started with `-X importtime`: it times
+django.setup() per app (module import, models import, ready()), the ASGI
+application import, the optional warm-up, and the first and second request.
+The requests go through the ASGI application itself, as a server would send
+them, so each runs its view on a fresh thread the way production does. It only
+imports Django itself, so nothing is loaded before the clock starts.
+"""
+import asyncio
+import importlib
+import json
+import time
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+
+def _ms(started):
+    return round((time.perf_counter() - started) * 1000, 2)
+
+
+def measure(asgi_module, path, warm):
+    started = time.perf_counter()
+    import django
+    from django.apps.config import AppConfig
+
+    app_timings = {}
+    create = AppConfig.create.__func__
+    import_models = AppConfig.import_models
+
+    def timed_create(cls, entry):
+        step = time.perf_counter()
+        config = create(cls, entry)
+        app_timings[config.label] = {'import_ms': _ms(step)}
+        ready = config.ready
+
+        def timed_ready():
+            step = time.perf_counter()
+            ready()
+            app_timings[config.label]['ready_ms'] = _ms(step)
+        config.ready = timed_ready
+        return config
+
+    def timed_import_models(self):
+        step = time.perf_counter()
+        import_models(self)
+        app_timings[self.label]['models_ms'] = _ms(step)
+
+    AppConfig.create = classmethod(timed_create)
+    AppConfig.import_models = timed_import_models
+    django.setup()
+    AppConfig.create = classmethod(create)
+    AppConfig.import_models = import_models
+    timings = {'setup_ms': _ms(started)}
+
+    step = time.perf_counter()
+    application = importlib.import_module(asgi_module).application
+    timings['asgi_import_ms'] = _ms(step)
+
+    if warm:
+        from base.warmup import warm_up
+        step = time.perf_counter()
+        timings['warmup'] = warm_up()
+        timings['warmup_ms'] = _ms(step)
+
+    async def requests():
+        for label in ('first_request_ms', 'second_request_ms'):
+            step = time.perf_counter()
+            await asgi_get(application, path)
+            timings[label] = _ms(step)
+    asyncio.run(requests())
+    timings['ready_to_first_response_ms'] = _ms(started)
+
+    print(json.dumps({'timings': timings, 'apps': app_timings}))
+
+
+async def asgi_get(application, path, timeout=30):
+    """Send GET `path` to an ASGI application; returns (status, body)"""
+    from asgiref.testing import ApplicationCommunicator
+
+    url = urlsplit(path)
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+        'path': url.path, 'raw_path': url.path.encode(), 'query_string': url.query.encode(), 'root_path': '',
+        'headers': [(b'host', b'localhost')], 'client': ('127.0.0.1', 0), 'server': ('localhost', 80),
+    }
+    communicator = ApplicationCommunicator(application, scope)
+    await communicator.send_input({'type': 'http.request', 'body': b'', 'more_body': False})
+    start = await communicator.receive_output(timeout)
+    body = b''
+    while True:
+        message = await communicator.receive_output(timeout)
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            break
+    await communicator.wait(timeout)
+    return start['status'], body
+
+
+def parse_importtime(stderr):
+    """[(module, self_us, cumulative_us)] from `python -X importtime` output"""
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        modules.append((name.strip(), int(self_us), int(cumulative_us)))
+    return modules
+
+
+def by_package(modules):
+    """Total self import time per top-level package, in ms, slowest first"""
+    totals = defaultdict(int)
+    for name, self_us, _ in modules:
+        totals[name.split('.')[0]] += self_us
+    return sorted(((package, round(us / 1000, 2)) for package, us in totals.items()), key=lambda row: -row[1])
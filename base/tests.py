@@ -1,3 +1,1688 @@
-from django.test import TestCase
+import asyncio
+import difflib
+import io
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from contextlib import ExitStack
+from datetime import timedelta
+from io import StringIO
+from unittest import skipIf, skipUnless
 
-# Create your tests here.
+from django.db import connection, connections, transaction
+from unittest import mock
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import CommandError, call_command
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.pagination import PageNumberPagination
+from rest_framework.test import APIClient
+from rest_framework.throttling import UserRateThrottle
+from rest_framework_simplejwt.tokens import RefreshToken
+from drf_spectacular.generators import SchemaGenerator
+from PIL import Image
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+
+from . import admin, archive, avatars, benchmarks, consumers, feed, instrumentation, log, metrics, query_plans, room_events, sharding, sockets, startup, topic_index, users, warmup, wire
+from .middleware import JWTAuthMiddleware
+from .routing import websocket_urlpatterns
+from .api import schema
+from .api.serializers import UserSerializer
+from .models import ArchiveSegment, FeedEntry, ReadMarker, Room, Topic, Message, User
+
+
+# Room.last_seq catches up with shard inserts when a test flushes, not from the timer's thread mid-test
+@override_settings(MESSAGE_SHARD_SEQ_FLUSH_INTERVAL=60)
+class ShardedTestCase(TestCase):
+    """TestCase on every database, so message paths run against the shards when MESSAGE_SHARDS is set"""
+    databases = '__all__'
+
+    def tearDown(self):
+        sharding.seq_flusher.flush()
+        super().tearDown()
+
+    def _should_check_constraints(self, connection):
+        # A shard's messages point at rooms and users in `default`; those foreign keys are not enforced there
+        return not connection.alias.startswith(sharding.SHARD_PREFIX) and super()._should_check_constraints(connection)
+
+
+class ShardedTransactionTestCase(TransactionTestCase):
+    """TransactionTestCase on every database, for message paths that need committed data"""
+    databases = '__all__'
+
+    def tearDown(self):
+        # Otherwise the flusher's timer fires in a later test, which may not allow database access
+        sharding.seq_flusher.flush()
+        super().tearDown()
+
+
+# ==================== QUERY BUDGETS ====================
+
+SMALL = {'rooms': 2, 'participants': 2, 'messages': 2}
+# More rooms than one page, and several times the participants/messages per room
+LARGE = {'rooms': 25, 'participants': 12, 'messages': 15}
+
+# (name, method, url, payload, max queries)
+QUERY_BUDGETS = [
+    ('room list', 'get', '/api/v1/rooms/', None, 4),
+    ('room search', 'get', '/api/v1/rooms/?q=algebra', None, 4),
+    ('room detail', 'get', '/api/v1/rooms/{room}/', None, 6),
+    ('room create', 'post', '/api/v1/rooms/', {'name': 'New room', 'topic_id': '{topic}'}, 7),
+    ('room update', 'patch', '/api/v1/rooms/{room}/', {'name': 'Renamed'}, 8),
+    ('room join', 'post', '/api/v1/rooms/{room}/join/', None, 3),
+    ('room leave', 'post', '/api/v1/rooms/{room}/leave/', None, 2),
+    ('room participants', 'get', '/api/v1/rooms/{room}/participants/', None, 3),
+    ('room history', 'get', '/api/v1/rooms/{room}/history/?before=2', None, 3),
+    ('message list', 'get', '/api/v1/messages/?room={room}', None, 3),
+    ('message create', 'post', '/api/v1/messages/', {'room': '{room}', 'body': 'Hello'}, 9),
+    ('message detail', 'get', '/api/v1/messages/{message}/', None, 2),
+    ('topic list', 'get', '/api/v1/topics/', None, 2),
+    ('topic detail', 'get', '/api/v1/topics/{topic}/', None, 1),
+    ('feed', 'get', '/api/v1/feed/', None, 2),
+    ('unread counts', 'get', '/api/v1/rooms/unread/', None, 1),
+    ('mark read', 'post', '/api/v1/rooms/read/', {'rooms': ['{room}']}, 2),
+    ('profile', 'get', '/api/v1/profile/', None, 0),
+    ('user detail', 'get', '/api/v1/users/{user}/', None, 1),
+    ('user lookup', 'get', '/api/v1/users/?ids={user},{room}', None, 1),
+]
+
+_LITERALS = re.compile(r"'[^']*'|\b\d+\b")
+_IN_LISTS = re.compile(r'IN \(\?(, \?)*\)')
+
+
+def build_dataset(rooms, participants, messages):
+    """Rooms with a shared host and topic, each with its own members and messages"""
+    host, *members = User.objects.bulk_create([
+        User(username=f'user{i}', email=f'user{i}@example.com') for i in range(participants + 1)
+    ])
+    topic = Topic.objects.create(name='algebra')
+    room_objects = Room.objects.bulk_create([
+        Room(host=host, topic=topic, name=f'algebra room {i}', last_seq=messages) for i in range(rooms)
+    ])
+    Membership = Room.participants.through
+    Membership.objects.bulk_create([
+        Membership(room_id=room.id, user_id=user.id) for room in room_objects for user in [host] + members
+    ])
+    for room in room_objects:
+        Message.objects.using(sharding.shard_for_room(room.id)).bulk_create([
+            Message(room=room, user=members[i % len(members)], body=f'message {i}', seq=i + 1) for i in range(messages)
+        ])
+    return {
+        'host': host,
+        'user': members[0].id,
+        'room': room_objects[0].id,
+        'topic': topic.id,
+        'message': sharding.room_messages(room_objects[0].id).values_list('id', flat=True).first(),
+    }
+
+
+def fill(value, ids):
+    if isinstance(value, list):
+        return [fill(item, ids) for item in value]
+    return str(value).format(**ids)
+
+
+def normalize(sql):
+    return _IN_LISTS.sub('IN (...)', _LITERALS.sub('?', sql))
+
+
+class QueryBudgetTests(ShardedTestCase):
+    """
+    Every endpoint must run within a fixed number of queries, and that number
+    must not change when page size, participants or messages per room grow.
+    """
+
+    def capture(self, dataset_size, method, url, payload):
+        # Measure cold: ids are reused once the dataset is rolled back
+        cache.clear()
+        with ExitStack() as stack:
+            for alias in self.databases:
+                stack.enter_context(transaction.atomic(using=alias))
+            ids = build_dataset(**dataset_size)
+            client = APIClient(HTTP_HOST='localhost')
+            client.force_authenticate(ids['host'])
+            url = url.format(**ids)
+            if payload is not None:
+                payload = {key: fill(value, ids) for key, value in payload.items()}
+
+            # Feeds are trimmed after one message in FEED_TRIM_INTERVAL, picked by id, and shard ids are
+            # not predictable; the amortized trim is left out so both datasets count the same queries
+            with mock.patch.object(feed, 'trim_feeds'), CaptureQueriesContext(connection) as queries:
+                response = getattr(client, method)(url, payload, format='json')
+            for alias in self.databases:
+                transaction.set_rollback(True, using=alias)
+
+        self.assertLess(response.status_code, 400, f'{method.upper()} {url}: {response.content[:200]}')
+        return [normalize(query['sql']) for query in queries.captured_queries]
+
+    def assertQueryBudget(self, name, method, url, payload, budget):
+        small = self.capture(SMALL, method, url, payload)
+        large = self.capture(LARGE, method, url, payload)
+        diff = '\n'.join(difflib.unified_diff(small, large, 'small dataset', 'large dataset', lineterm=''))
+
+        self.assertEqual(
+            len(small), len(large),
+            f'{name}: query count grows with data ({len(small)} -> {len(large)})\n{diff}',
+        )
+        self.assertLessEqual(
+            len(large), budget,
+            f'{name}: {len(large)} queries exceeds budget of {budget}\n' + '\n'.join(large),
+        )
+
+    def test_query_budgets(self):
+        for name, method, url, payload, budget in QUERY_BUDGETS:
+            with self.subTest(name):
+                self.assertQueryBudget(name, method, url, payload, budget)
+
+
+# ==================== PARTICIPANTS ====================
+
+@override_settings(ROOM_PARTICIPANT_PREVIEW_SIZE=3)
+class ParticipantPreviewTests(ShardedTestCase):
+
+    def setUp(self):
+        self.users = User.objects.bulk_create([
+            User(username=f'member{i}', email=f'member{i}@example.com') for i in range(5)
+        ])
+        self.big = Room.objects.create(host=self.users[0], name='big')
+        self.small = Room.objects.create(host=self.users[0], name='small')
+        # Join order differs from user id order
+        for user in reversed(self.users):
+            self.big.participants.add(user)
+        self.small.participants.add(self.users[2])
+        self.client = APIClient(HTTP_HOST='localhost')
+
+    def test_list_embeds_capped_preview_in_join_order(self):
+        rooms = {room['name']: room for room in self.client.get('/api/v1/rooms/').json()['results']}
+        big, small = rooms['big'], rooms['small']
+        self.assertEqual([user['username'] for user in big['participant_preview']], ['member4', 'member3', 'member2'])
+        self.assertEqual(big['participant_count'], 5)
+        self.assertEqual([user['username'] for user in small['participant_preview']], ['member2'])
+        self.assertEqual(small['participant_count'], 1)
+
+    def test_participants_endpoint_pages_all_members(self):
+        with mock.patch.object(PageNumberPagination, 'page_size', 2):
+            first = self.client.get(f'/api/v1/rooms/{self.big.id}/participants/').json()
+            second = self.client.get(first['next']).json()
+        self.assertEqual(first['count'], 5)
+        self.assertEqual(
+            [user['username'] for user in first['results'] + second['results']],
+            ['member4', 'member3', 'member2', 'member1'],
+        )
+        self.assertEqual(self.client.get('/api/v1/rooms/0/participants/').status_code, 404)
+
+
+# ==================== USER LOOKUP ====================
+
+class UserLookupTests(ShardedTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.users = User.objects.bulk_create([
+            User(username=f'user{i}', email=f'user{i}@example.com') for i in range(3)
+        ])
+        self.client = APIClient(HTTP_HOST='localhost')
+        self.client.force_authenticate(self.users[0])
+
+    def lookup(self, ids):
+        return self.client.get(f'/api/v1/users/?ids={ids}')
+
+    def test_resolves_many_ids_with_one_query_then_from_cache(self):
+        ids = ','.join(str(user.id) for user in self.users)
+        with self.assertNumQueries(1):
+            response = self.lookup(f'{ids},0,{self.users[0].id}')
+        body = response.json()
+        self.assertEqual(
+            {key: user['username'] for key, user in body['users'].items()},
+            {str(user.id): user.username for user in self.users},
+        )
+        self.assertEqual(body['missing'], [0])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.lookup(ids).json()['users'], body['users'])
+
+    def test_saving_a_user_drops_the_cached_record(self):
+        user = self.users[1]
+        self.lookup(user.id)
+        user.name = 'Renamed'
+        user.save()
+        self.assertEqual(self.lookup(user.id).json()['users'][str(user.id)]['name'], 'Renamed')
+        self.assertEqual(self.client.get(f'/api/v1/users/{user.id}/').json()['name'], 'Renamed')
+
+    @override_settings(USER_LOOKUP_MAX_IDS=2)
+    def test_rejects_bad_and_oversized_id_lists(self):
+        for ids in ('', 'a,b', '1,2,3'):
+            with self.subTest(ids=ids):
+                self.assertEqual(self.lookup(ids).status_code, 400)
+
+    def test_room_detail_merges_host_and_author_lookups(self):
+        host, author, _ = self.users
+        room = Room.objects.create(host=host, name='algebra')
+        for user in (host, author, host):
+            Message.objects.create(user=user, room=room, body='hello')
+        cache.clear()
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(f'/api/v1/rooms/{room.id}/')
+        user_queries = [query['sql'] for query in queries.captured_queries if 'FROM "base_user"' in query['sql']]
+        self.assertEqual(len(user_queries), 1)
+        body = response.json()
+        self.assertEqual(body['host']['username'], host.username)
+        self.assertEqual([message['user']['username'] for message in body['messages']], ['user0', 'user1', 'user0'])
+
+    def test_records_render_absolute_urls_like_the_serializer(self):
+        host = self.users[0]
+        room = Room.objects.create(host=host, name='algebra')
+        self.client.get(f'/api/v1/rooms/{room.id}/')
+        # Cached without a request, so one record serves every host name
+        self.assertEqual(cache.get(users.record_key(host.id))['avatar'], '/media/avatar.svg')
+
+        detail = self.client.get(f'/api/v1/rooms/{room.id}/').json()['host']
+        listed = self.client.get('/api/v1/rooms/').json()['results'][0]['host']
+        looked_up = self.lookup(host.id).json()['users'][str(host.id)]
+        self.assertEqual((detail['avatar'], detail['avatar_small']),
+                         ('http://localhost/media/avatar.svg', 'http://localhost/media/avatar.svg'))
+        self.assertEqual((detail['avatar'], detail['avatar_small']), (listed['avatar'], listed['avatar_small']))
+        profile = APIClient(HTTP_HOST='localhost')
+        profile.force_authenticate(host)
+        self.assertEqual(profile.get('/api/v1/profile/').json()['avatar_small'], 'http://localhost/media/avatar.svg')
+        self.assertEqual(looked_up, detail)
+
+
+# ==================== BULK INGESTION ====================
+
+class BulkIngestTests(ShardedTestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='bot', email='bot@example.com', is_staff=True)
+        self.other = User.objects.create(username='other', email='other@example.com')
+        self.room = Room.objects.create(host=self.other, name='algebra')
+        Message.objects.create(user=self.other, room=self.room, body='existing')
+        self.client = APIClient(HTTP_HOST='localhost')
+        self.client.force_authenticate(self.user)
+
+    def test_json_array_reports_item_errors(self):
+        response = self.client.post('/api/v1/messages/bulk/', [
+            {'room': self.room.id, 'body': 'one'},
+            {'room': self.room.id, 'body': ''},
+            {'room': 0, 'body': 'nowhere'},
+            {'room': self.room.id, 'body': 'as someone else', 'user': self.other.id},
+            {'room': self.room.id, 'body': 'two', 'created': 'yesterday'},
+            {'room': self.room.id, 'body': 'three'},
+        ], format='json')
+
+        self.assertEqual(response.status_code, 200)
+        result = response.json()
+        self.assertEqual((result['created'], result['failed']), (3, 3))
+        self.assertEqual([error['index'] for error in result['errors']], [1, 2, 4])
+        self.assertIn('room', result['errors'][1]['errors'])
+        self.assertIn('created', result['errors'][2]['errors'])
+        self.assertEqual(
+            list(sharding.room_messages(self.room.id).order_by('seq').values_list('body', 'seq', 'user_id')),
+            [('existing', 1, self.other.id), ('one', 2, self.user.id), ('as someone else', 3, self.other.id),
+             ('three', 4, self.user.id)],
+        )
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.last_seq, 4)
+        self.assertTrue(self.room.participants.filter(id=self.user.id).exists())
+
+    def test_impossible_dates_and_out_of_range_ids_are_item_errors(self):
+        response = self.client.post('/api/v1/messages/bulk/', [
+            {'room': self.room.id, 'body': 'leap', 'created': '2024-02-30T10:00:00'},
+            {'room': 10 ** 30, 'body': 'far away'},
+            {'room': self.room.id, 'body': 'as nobody', 'user': 10 ** 30},
+            {'room': self.room.id, 'body': 'fine'},
+        ], format='json')
+
+        self.assertEqual(response.status_code, 200)
+        result = response.json()
+        self.assertEqual((result['created'], result['failed']), (1, 3))
+        self.assertEqual([list(error['errors']) for error in result['errors']], [['created'], ['room'], ['user']])
+
+    def test_only_staff_can_ingest(self):
+        self.client.force_authenticate(self.other)
+        response = self.client.post('/api/v1/messages/bulk/', [{'room': self.room.id, 'body': 'one'}], format='json')
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(sharding.room_messages(self.room.id).count(), 1)
+
+    @override_settings(INGEST_CHUNK_SIZE=3)
+    def test_new_members_get_read_markers_and_counts_are_published(self):
+        second = Room.objects.create(host=self.other, name='geometry')
+        items = [{'room': self.room.id, 'body': f'algebra {i}'} for i in range(3)]
+        items += [{'room': second.id, 'body': 'geometry'}, {'room': self.room.id, 'body': 'algebra 3'}]
+        with mock.patch.object(room_events, 'counts_changed') as counts_changed:
+            self.client.post('/api/v1/messages/bulk/', items, format='json')
+        # One event per room per chunk
+        self.assertEqual(sorted(call.args[0].id for call in counts_changed.call_args_list),
+                         [self.room.id, self.room.id, second.id])
+        markers = ReadMarker.objects.filter(user=self.user).order_by('room_id').values_list('room_id', 'last_read_seq')
+        # Joined algebra in the first chunk at their last message there; the second chunk leaves it alone
+        self.assertEqual(list(markers), [(self.room.id, 4), (second.id, 1)])
+
+    @override_settings(INGEST_CHUNK_SIZE=2)
+    def test_jsonl_stream_with_imported_timestamps(self):
+        lines = [
+            json.dumps({'room': self.room.id, 'body': f'old {i}', 'user': self.other.id, 'created': '2024-01-01T10:00:00Z'})
+            for i in range(5)
+        ]
+        lines.insert(2, '{not json')
+        response = self.client.generic(
+            'POST', '/api/v1/messages/bulk/', '\n'.join(lines), content_type='application/x-ndjson',
+        )
+
+        result = response.json()
+        self.assertEqual((result['created'], result['failed']), (5, 1))
+        self.assertIn('Invalid JSON', result['errors'][0]['errors']['non_field_errors'][0])
+        imported = sharding.room_messages(self.room.id).filter(body__startswith='old').order_by('seq')
+        self.assertEqual([m.seq for m in imported], [2, 3, 4, 5, 6])
+        self.assertEqual({m.created.year for m in imported}, {2024})
+
+
+# ==================== READ MARKERS ====================
+
+class ReadMarkerTests(ShardedTestCase):
+
+    def setUp(self):
+        self.host, self.member = User.objects.bulk_create([
+            User(username='host', email='host@example.com'),
+            User(username='member', email='member@example.com'),
+        ])
+        self.room = Room.objects.create(host=self.host, name='algebra')
+        self.room.participants.add(self.host, self.member)
+        self.client = APIClient(HTTP_HOST='localhost')
+        self.client.force_authenticate(self.member)
+
+    def send(self, count):
+        messages = [Message.objects.create(room=self.room, user=self.host, body=f'message {i}') for i in range(count)]
+        sharding.seq_flusher.flush()
+        return messages
+
+    def unread(self):
+        sharding.seq_flusher.flush()
+        response = self.client.get('/api/v1/rooms/unread/')
+        return {row['room']: row['unread'] for row in response.json()['rooms']}
+
+    def test_messages_get_consecutive_sequence_numbers(self):
+        messages = self.send(3)
+        self.assertEqual([m.seq for m in messages], [1, 2, 3])
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.last_seq, 3)
+
+    def test_unread_counts_follow_read_marker(self):
+        messages = self.send(5)
+        self.assertEqual(self.unread(), {self.room.id: 5})
+
+        self.client.post('/api/v1/rooms/read/', {'rooms': {str(self.room.id): messages[1].seq}}, format='json')
+        self.assertEqual(self.unread(), {self.room.id: 3})
+
+        self.client.post('/api/v1/rooms/read/', {'rooms': [self.room.id]}, format='json')
+        self.assertEqual(self.unread(), {self.room.id: 0})
+
+    def test_read_marker_is_clamped_to_latest_message(self):
+        self.send(2)
+        response = self.client.post('/api/v1/rooms/read/', {'rooms': {str(self.room.id): 99}}, format='json')
+        self.assertEqual(response.json(), {'rooms': {str(self.room.id): 2}})
+
+    def test_explicit_seq_does_not_move_marker_back(self):
+        self.send(4)
+        self.client.post('/api/v1/rooms/read/', {'rooms': [self.room.id]}, format='json')
+        response = self.client.post('/api/v1/rooms/read/', {'rooms': {str(self.room.id): 1}}, format='json')
+        self.assertEqual(response.json(), {'rooms': {str(self.room.id): 4}})
+        self.assertEqual(self.unread(), {self.room.id: 0})
+
+    def test_own_messages_are_read(self):
+        self.send(3)
+        self.client.post('/api/v1/messages/', {'room': self.room.id, 'body': 'mine'}, format='json')
+        self.assertEqual(self.unread(), {self.room.id: 0})
+
+    def test_posting_to_a_room_joins_it_with_history_read(self):
+        newcomer = User.objects.create(username='newcomer', email='newcomer@example.com')
+        self.send(3)
+        self.client.force_authenticate(newcomer)
+        self.client.post('/api/v1/messages/', {'room': self.room.id, 'body': 'hello'}, format='json')
+        self.assertEqual(self.unread(), {self.room.id: 0})
+        self.send(1)
+        self.assertEqual(self.unread(), {self.room.id: 1})
+
+    def test_chat_messages_advance_the_senders_marker(self):
+        self.send(2)
+        save = query_plans._sync(consumers.ChatConsumer, 'save_message')
+        save(consumers.ChatConsumer(), self.member.id, self.room.id, 'from the socket')
+        self.assertEqual(self.unread(), {self.room.id: 0})
+
+
+# ==================== ARCHIVE ====================
+
+class ArchiveTests(ShardedTestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='host', email='host@example.com')
+        self.room = Room.objects.create(host=self.user, name='algebra')
+        for i in range(10):
+            Message.objects.create(room=self.room, user=self.user, body=f'message {i}')
+        # The first seven are old enough to archive
+        sharding.room_messages(self.room.id).filter(seq__lte=7).update(created=timezone.now() - timedelta(days=30))
+        self.cutoff = archive.archive_cutoff(days=7)
+
+    def archive_all(self):
+        while archive.archive_batch(self.room.id, self.cutoff, batch_size=3):
+            pass
+
+    def test_archive_moves_only_old_messages_into_segments(self):
+        self.archive_all()
+        self.assertEqual(list(sharding.room_messages(self.room.id).order_by('seq').values_list('seq', flat=True)), [8, 9, 10])
+        segments = ArchiveSegment.objects.order_by('first_seq').values_list('first_seq', 'last_seq')
+        self.assertEqual(list(segments), [(1, 3), (4, 6), (7, 7)])
+
+    def test_history_reads_through_to_archive(self):
+        self.archive_all()
+        history = archive.get_history(self.room.id, limit=5)
+        self.assertEqual([m.seq for m in history], [10, 9, 8, 7, 6])
+        self.assertEqual(history[-1].body, 'message 5')
+        self.assertEqual(history[-1].user, self.user)
+
+        response = APIClient(HTTP_HOST='localhost').get(f'/api/v1/rooms/{self.room.id}/history/?before=6&limit=10')
+        self.assertEqual([m['seq'] for m in response.json()['results']], [5, 4, 3, 2, 1])
+        self.assertIsNone(response.json()['next'])
+
+    def test_room_message_list_pages_into_archive(self):
+        self.archive_all()
+        client = APIClient(HTTP_HOST='localhost')
+        pages = []
+        with mock.patch.object(PageNumberPagination, 'page_size', 4):
+            for page in (1, 2, 3):
+                body = client.get(f'/api/v1/messages/?room={self.room.id}&page={page}').json()
+                self.assertEqual(body['count'], 10)
+                pages.append([m['seq'] for m in body['results']])
+        self.assertEqual(pages, [[10, 9, 8, 7], [6, 5, 4, 3], [2, 1]])
+
+    def test_room_detail_includes_archived_messages(self):
+        self.archive_all()
+        response = APIClient(HTTP_HOST='localhost').get(f'/api/v1/rooms/{self.room.id}/')
+        messages = response.json()['messages']
+        self.assertEqual([m['seq'] for m in messages], list(range(10, 0, -1)))
+        self.assertEqual(messages[-1]['user']['id'], self.user.id)
+        self.assertEqual(response.json()['message_count'], 10)
+
+    def test_command_archives_only_the_given_rooms(self):
+        other = Room.objects.create(host=self.user, name='geometry')
+        Message.objects.create(room=other, user=self.user, body='old')
+        sharding.room_messages(other.id).update(created=timezone.now() - timedelta(days=30))
+
+        out = StringIO()
+        call_command('archive_messages', '--room', str(other.id), '--older-than', '7', stdout=out)
+        self.assertIn('Archived 1 messages in 1 batches', out.getvalue())
+        self.assertEqual(list(ArchiveSegment.objects.values_list('room_id', flat=True)), [other.id])
+
+        call_command('archive_messages', '--rehydrate', '--room', str(self.room.id), stdout=out)
+        self.assertTrue(ArchiveSegment.objects.exists())
+
+    def test_rehydrate_restores_messages(self):
+        originals = list(sharding.room_messages(self.room.id).order_by('seq').values_list('id', 'seq', 'body', 'created'))
+        self.archive_all()
+        while archive.rehydrate_batch(self.room.id):
+            pass
+        self.assertFalse(ArchiveSegment.objects.exists())
+        self.assertEqual(list(sharding.room_messages(self.room.id).order_by('seq').values_list('id', 'seq', 'body', 'created')), originals)
+
+
+# ==================== BATCH ====================
+
+class BatchTests(ShardedTransactionTestCase):
+    # Concurrent GETs run on other threads, which only see committed data
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='host', email='host@example.com')
+        self.room = Room.objects.create(host=self.user, name='algebra')
+        self.client = APIClient(HTTP_HOST='localhost')
+
+    def login(self, user):
+        # Items authenticate from the batch's own headers
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(user).access_token}')
+
+    def batch(self, *requests):
+        response = self.client.post('/api/v1/batch/', {'requests': list(requests)}, format='json')
+        self.assertEqual(response.status_code, 200)
+        return response.json()['responses']
+
+    def test_responses_keep_request_order(self):
+        self.login(self.user)
+        rooms, topics, profile, missing = self.batch(
+            {'path': '/api/v1/rooms/'},
+            {'path': '/api/v1/topics/'},
+            {'path': '/api/v1/profile/'},
+            {'path': '/api/v1/nothing-here/'},
+        )
+        self.assertEqual(rooms['body']['results'][0]['id'], self.room.id)
+        self.assertEqual(topics['status'], 200)
+        self.assertEqual(profile['body']['email'], 'host@example.com')
+        self.assertEqual(missing['status'], 404)
+
+    def test_writes_run_in_order_between_reads(self):
+        self.login(self.user)
+        before, created, after = self.batch(
+            {'path': f'/api/v1/rooms/{self.room.id}/history/'},
+            {'method': 'POST', 'path': '/api/v1/messages/', 'body': {'room': self.room.id, 'body': 'Hello'}},
+            {'path': f'/api/v1/rooms/{self.room.id}/history/'},
+        )
+        self.assertEqual(before['body']['results'], [])
+        self.assertEqual(created['status'], 201)
+        self.assertEqual([m['body'] for m in after['body']['results']], ['Hello'])
+
+    def test_items_are_permission_checked(self):
+        rooms, created = self.batch(
+            {'path': '/api/v1/rooms/'},
+            {'method': 'POST', 'path': '/api/v1/messages/', 'body': {'room': self.room.id, 'body': 'Hello'}},
+        )
+        self.assertEqual(rooms['status'], 200)
+        self.assertEqual(created['status'], 401)
+        self.assertFalse(Message.objects.exists())
+
+    def test_items_authenticate_like_standalone_requests(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer not-a-token')
+        response = self.client.post('/api/v1/batch/', {'requests': [{'path': '/api/v1/rooms/'}]}, format='json')
+        # The batch itself authenticates the same way, and so refuses a bad token first
+        self.assertEqual(response.status_code, 401)
+
+        self.client.credentials()
+        with mock.patch('rest_framework_simplejwt.authentication.JWTAuthentication.authenticate', return_value=None) as authenticate:
+            self.batch({'path': '/api/v1/rooms/'}, {'path': '/api/v1/topics/'})
+        # Once for the batch and once per item
+        self.assertEqual(authenticate.call_count, 3)
+
+    def test_items_run_through_the_middleware(self):
+        self.login(self.user)
+        with self.settings(REQUEST_INSTRUMENTATION_ENABLED=True):
+            client = APIClient(HTTP_HOST='localhost', HTTP_X_REQUEST_ID='batch-1')
+            client.credentials(HTTP_AUTHORIZATION=self.client._credentials['HTTP_AUTHORIZATION'])
+            with self.assertLogs('base.middleware', 'INFO') as logs:
+                client.post('/api/v1/batch/', {'requests': [
+                    {'path': '/api/v1/topics/'},
+                    {'method': 'POST', 'path': '/api/v1/rooms/read/', 'body': {'rooms': []}},
+                ]}, format='json')
+        paths = sorted(record.request_metrics['path'] for record in logs.records)
+        self.assertEqual(paths, ['/api/v1/batch/', '/api/v1/rooms/read/', '/api/v1/topics/'])
+
+    def test_batch_and_each_item_count_against_throttle(self):
+        self.login(self.user)
+        with mock.patch.object(UserRateThrottle, 'THROTTLE_RATES', {'user': '3/hour'}):
+            # Writes run one at a time, so the throttle sees them in order
+            responses = self.batch(*[{'method': 'POST', 'path': '/api/v1/rooms/read/', 'body': {'rooms': []}}] * 4)
+            self.assertEqual([r['status'] for r in responses], [200, 200, 429, 429])
+            self.assertEqual(self.client.post('/api/v1/batch/', {'requests': [{'path': '/api/v1/topics/'}]},
+                                              format='json').status_code, 429)
+
+
+# ==================== SCHEMA ====================
+
+class SchemaCacheTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings_override = override_settings(API_SCHEMA_CACHE_DIR=directory.name, API_SCHEMA_VERSION='v1')
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        schema.clear()
+        self.addCleanup(schema.clear)
+
+        patcher = mock.patch.object(SchemaGenerator, 'get_schema', return_value={'openapi': '3.0.3', 'paths': {}})
+        self.get_schema = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = APIClient(HTTP_HOST='localhost')
+
+    def test_schema_is_generated_once_per_version(self):
+        first = self.client.get('/api/v1/schema/')
+        second = self.client.get('/api/v1/schema/')
+        self.assertEqual(self.get_schema.call_count, 1)
+        self.assertEqual(first.content, second.content)
+        self.assertIn('max-age', first['Cache-Control'])
+
+        # A restarted process reads the file written by the first one
+        schema.clear()
+        self.client.get('/api/v1/schema/')
+        self.assertEqual(self.get_schema.call_count, 1)
+
+        with override_settings(API_SCHEMA_VERSION='v2'):
+            schema.clear()
+            self.client.get('/api/v1/schema/')
+        self.assertEqual(self.get_schema.call_count, 2)
+
+    def test_etag_revalidation(self):
+        etag = self.client.get('/api/v1/schema/')['ETag']
+        response = self.client.get('/api/v1/schema/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+
+# ==================== LOGGING ====================
+
+class LoggingPipelineTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.filename = os.path.join(directory.name, 'app.log')
+
+    def make_logger(self, handler, name):
+        logger = logging.getLogger(f'base.tests.{name}')
+        logger.propagate = False
+        logger.setLevel(logging.DEBUG)
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+        self.addCleanup(handler.close)
+        return logger
+
+    def read_lines(self, filename=None):
+        with open(filename or self.filename) as f:
+            return [json.loads(line) for line in f]
+
+    def test_records_are_written_as_json_with_context(self):
+        handler = log.BackgroundHandler(filename=self.filename)
+        handler.setFormatter(log.JsonFormatter())
+        logger = self.make_logger(handler, 'json')
+
+        token = log.request_id.set('req-1')
+        try:
+            logger.info('Saved %s rows', 3, extra={'room': 7})
+            try:
+                1 / 0
+            except ZeroDivisionError:
+                logger.exception('Failed')
+        finally:
+            log.request_id.reset(token)
+        handler.flush()
+
+        saved, failed = self.read_lines()
+        self.assertEqual((saved['msg'], saved['room'], saved['request_id']), ('Saved 3 rows', 7, 'req-1'))
+        self.assertEqual(failed['level'], 'ERROR')
+        self.assertIn('ZeroDivisionError', failed['exc'])
+
+    def test_file_is_rotated_by_size(self):
+        handler = log.BackgroundHandler(filename=self.filename, max_bytes=2000, backup_count=2)
+        handler.setFormatter(log.JsonFormatter())
+        logger = self.make_logger(handler, 'rotate')
+        for i in range(100):
+            logger.info('record %d', i)
+            handler.flush()
+
+        self.assertTrue(os.path.exists(self.filename + '.2'))
+        self.assertFalse(os.path.exists(self.filename + '.3'))
+        self.assertLessEqual(os.path.getsize(self.filename), 2000)
+        self.assertEqual(self.read_lines()[-1]['msg'], 'record 99')
+
+    def test_sampling_keeps_warnings(self):
+        handler = log.BackgroundHandler(filename=self.filename)
+        handler.setFormatter(log.JsonFormatter())
+        handler.addFilter(log.SamplingFilter(rate=0, burst=2))
+        logger = self.make_logger(handler, 'sampling')
+        for i in range(5):
+            logger.info('noise %d', i)
+        logger.warning('important')
+        handler.flush()
+
+        self.assertEqual([line['msg'] for line in self.read_lines()], ['noise 0', 'noise 1', 'important'])
+
+    def test_request_id_header(self):
+        client = APIClient(HTTP_HOST='localhost')
+        generated = client.get('/api/v1/topics/')['X-Request-ID']
+        self.assertRegex(generated, r'^[0-9a-f]{32}$')
+        self.assertEqual(client.get('/api/v1/topics/', HTTP_X_REQUEST_ID='abc-123')['X-Request-ID'], 'abc-123')
+        self.assertNotEqual(client.get('/api/v1/topics/', HTTP_X_REQUEST_ID='bad id!')['X-Request-ID'], 'bad id!')
+
+
+# ==================== TOPIC AUTOCOMPLETE ====================
+
+class TopicAutocompleteTests(ShardedTestCase):
+
+    def setUp(self):
+        topic_index.index.clear()
+        self.addCleanup(topic_index.index.clear)
+        self.host = User.objects.create(username='host', email='host@example.com')
+        self.algebra = Topic.objects.create(name='Linear Algebra')
+        self.algorithms = Topic.objects.create(name='Algorithms')
+        self.art = Topic.objects.create(name='Art History')
+        for topic, rooms in ((self.algebra, 1), (self.algorithms, 3), (self.art, 2)):
+            for i in range(rooms):
+                Room.objects.create(host=self.host, topic=topic, name=f'{topic.name} {i}')
+
+    def names(self, prefix, limit=10):
+        return [topic['name'] for topic in topic_index.get_index().search(prefix, limit)]
+
+    def test_word_prefixes_ranked_by_room_count(self):
+        self.assertEqual(self.names('al'), ['Algorithms', 'Linear Algebra'])
+        self.assertEqual(self.names('A'), ['Algorithms', 'Art History', 'Linear Algebra'])
+        self.assertEqual(self.names('HIST'), ['Art History'])
+        self.assertEqual(self.names('lin alg'), [])
+        self.assertEqual(self.names('', limit=1), ['Algorithms'])
+
+    def test_signals_keep_index_current(self):
+        topic_index.get_index()
+        with self.captureOnCommitCallbacks(execute=True):
+            for i in range(3):
+                Room.objects.create(host=self.host, topic=self.algebra, name=f'extra {i}')
+            Topic.objects.create(name='Abstract Algebra')
+            self.art.name = 'Modern Art'
+            self.art.save()
+        self.assertEqual(self.names('alg'), ['Linear Algebra', 'Algorithms', 'Abstract Algebra'])
+        self.assertEqual(self.names('hist'), [])
+
+        room = Room.objects.filter(topic=self.algebra).first()
+        with self.captureOnCommitCallbacks(execute=True):
+            room.topic = self.art
+            room.save()
+            Room.objects.filter(topic=self.algebra).first().delete()
+            self.algorithms.delete()
+        self.assertEqual(topic_index.get_index().search('a'), [
+            {'id': self.art.id, 'name': 'Modern Art', 'room_count': 3},
+            {'id': self.algebra.id, 'name': 'Linear Algebra', 'room_count': 2},
+            {'id': Topic.objects.get(name='Abstract Algebra').id, 'name': 'Abstract Algebra', 'room_count': 0},
+        ])
+
+    def test_writers_replace_what_readers_hold(self):
+        index = topic_index.get_index()
+        held = (index.keys, index.names, index.room_counts)
+        snapshot = (list(index.keys), dict(index.names), dict(index.room_counts))
+        index.add_rooms(self.algebra.id, 1)
+        index.set_topic(self.algebra.id + 1000, 'Number Theory')
+        index.remove_topic(self.art.id)
+        self.assertEqual(held, snapshot)
+        self.assertEqual(index.room_counts[self.algebra.id], 2)
+        self.assertNotIn(self.art.id, index.room_counts)
+
+    def test_endpoint_does_not_query_once_built(self):
+        client = APIClient(HTTP_HOST='localhost')
+        client.get('/api/v1/topics/autocomplete/?q=x')
+        with self.assertNumQueries(0):
+            response = client.get('/api/v1/topics/autocomplete/?q=alg&limit=1')
+        self.assertEqual(response.json(), {'results': [{'id': self.algorithms.id, 'name': 'Algorithms', 'room_count': 3}]})
+        self.assertIn('studybud_topic_index_keys 5', metrics.REGISTRY.render())
+
+
+# ==================== WEBSOCKET LIMITS ====================
+
+@override_settings(WS_CONNECTION_RATE=0, WS_CONNECTION_BURST=3, WS_USER_RATE=0, WS_USER_BURST=100,
+                   WS_MAX_FRAME_BYTES=256, WS_LIMIT_ACTION='warn')
+class WebsocketLimitTests(SimpleTestCase):
+    def setUp(self):
+        consumers.user_buckets().clear()
+
+    async def connect(self, **scope):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/chat/1/')
+        communicator.scope.update(scope)
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    def rejected(self, reason):
+        return metrics.WS_FRAMES_REJECTED.labels(reason).value
+
+    async def test_oversized_frame_is_rejected_before_parsing(self):
+        communicator = await self.connect()
+        before = self.rejected('frame_too_large')
+        with mock.patch.object(wire.JsonCodec, 'decode') as loads:
+            await communicator.send_to(text_data='é' * 200)
+        error = await communicator.receive_json_from()
+        self.assertEqual(error, {'type': 'error', 'code': 'frame_too_large', 'retry_after': None})
+        loads.assert_not_called()
+        self.assertEqual(self.rejected('frame_too_large'), before + 1)
+        await communicator.disconnect()
+
+    async def test_connection_rate_limit_drops_and_warns_once(self):
+        communicator = await self.connect()
+        for _ in range(3):
+            await communicator.send_json_to({'type': 'typing', 'user_id': 1})
+        before = self.rejected('connection_rate')
+        for _ in range(5):
+            await communicator.send_json_to({'type': 'typing', 'user_id': 1})
+        self.assertEqual((await communicator.receive_json_from())['code'], 'connection_rate')
+        self.assertTrue(await communicator.receive_nothing())
+        self.assertEqual(self.rejected('connection_rate'), before + 5)
+        await communicator.disconnect()
+
+    @override_settings(WS_CONNECTION_BURST=100, WS_USER_BURST=2)
+    async def test_user_limit_is_shared_across_connections(self):
+        user = mock.Mock(pk=1, is_authenticated=True)
+        first, second = await self.connect(user=user), await self.connect(user=user)
+        other = await self.connect(user=mock.Mock(pk=2, is_authenticated=True))
+        await first.send_json_to({'type': 'typing'})
+        await second.send_json_to({'type': 'typing'})
+        await other.send_json_to({'type': 'typing'})
+        self.assertTrue(await other.receive_nothing())
+        # A user id in the frame does not move it to another user's bucket
+        await second.send_json_to({'type': 'typing', 'user_id': 3})
+        self.assertEqual((await second.receive_json_from())['code'], 'user_rate')
+        for communicator in (first, second, other):
+            await communicator.disconnect()
+
+    @override_settings(WS_CONNECTION_BURST=100, WS_USER_BURST=2)
+    async def test_anonymous_connections_share_a_limit_per_address(self):
+        first, second = await self.connect(client=('10.0.0.1', 5000)), await self.connect(client=('10.0.0.1', 5001))
+        elsewhere = await self.connect(client=('10.0.0.2', 5000))
+        await first.send_json_to({'type': 'typing', 'user_id': 1})
+        await second.send_json_to({'type': 'typing', 'user_id': 2})
+        await elsewhere.send_json_to({'type': 'typing', 'user_id': 1})
+        self.assertTrue(await elsewhere.receive_nothing())
+        await second.send_json_to({'type': 'typing', 'user_id': 3})
+        self.assertEqual((await second.receive_json_from())['code'], 'user_rate')
+        for communicator in (first, second, elsewhere):
+            await communicator.disconnect()
+
+    @override_settings(WS_LIMIT_ACTION='close', WS_LIMIT_CLOSE_CODE=4008)
+    async def test_close_action(self):
+        communicator = await self.connect()
+        await communicator.send_to(text_data='{not json')
+        self.assertEqual(await communicator.receive_output(), {'type': 'websocket.close', 'code': 4008})
+
+
+# ==================== ROOM LIST EVENTS ====================
+
+class RoomListEventTests(ShardedTestCase):
+
+    def setUp(self):
+        self.host = User.objects.create(username='host')
+        self.math = Topic.objects.create(name='Math')
+        self.physics = Topic.objects.create(name='Physics')
+        self.client = APIClient(HTTP_HOST='localhost')
+        self.client.force_authenticate(self.host)
+
+    def published(self, method, url, payload=None):
+        """[(group, event)] sent once `method url` commits"""
+        sent = []
+        with mock.patch.object(room_events, 'get_channel_layer') as layer:
+            layer.return_value.group_send = mock.AsyncMock(side_effect=lambda group, message: sent.append((group, message['event'])))
+            with self.captureOnCommitCallbacks(execute=True):
+                response = getattr(self.client, method)(url, payload, format='json')
+        self.assertLess(response.status_code, 400, response.content[:200])
+        return sent
+
+    def test_room_views_publish_deltas(self):
+        sent = self.published('post', '/api/v1/rooms/', {'name': 'Calculus', 'topic_id': self.math.id})
+        room = Room.objects.get(name='Calculus')
+        created = {'op': 'created', 'id': room.id, 'name': 'Calculus', 'topic': {'id': self.math.id, 'name': 'Math'},
+                   'host': self.host.id, 'participant_count': 1, 'message_count': 0}
+        self.assertEqual(sent, [('rooms', created), (f'rooms_topic_{self.math.id}', created)])
+
+        member = User.objects.create(username='member')
+        self.client.force_authenticate(member)
+        counts = {'op': 'counts', 'id': room.id, 'changed': mock.ANY}
+        self.assertEqual(self.published('post', f'/api/v1/rooms/{room.id}/join/'),
+                         [('rooms', counts), (f'rooms_topic_{self.math.id}', counts)])
+
+        self.client.force_authenticate(self.host)
+        sent = dict(self.published('patch', f'/api/v1/rooms/{room.id}/', {'topic_id': self.physics.id}))
+        self.assertEqual(sent['rooms']['op'], 'updated')
+        self.assertEqual(sent[f'rooms_topic_{self.math.id}'], {'op': 'deleted', 'id': room.id})
+        self.assertEqual(sent[f'rooms_topic_{self.physics.id}']['op'], 'created')
+
+        self.assertEqual(self.published('delete', f'/api/v1/rooms/{room.id}/'), [
+            ('rooms', {'op': 'deleted', 'id': room.id}),
+            (f'rooms_topic_{self.physics.id}', {'op': 'deleted', 'id': room.id}),
+        ])
+
+    def test_messages_publish_counts(self):
+        room = Room.objects.create(host=self.host, topic=self.math, name='Calculus')
+        member = User.objects.create(username='member')
+        self.client.force_authenticate(member)
+        sent = self.published('post', '/api/v1/messages/', {'room': room.id, 'body': 'hello'})
+        self.assertEqual(sent, [('rooms', {'op': 'counts', 'id': room.id, 'changed': mock.ANY}),
+                                (f'rooms_topic_{self.math.id}', {'op': 'counts', 'id': room.id, 'changed': mock.ANY})])
+
+        # Subscribers count when they send their frame, and reuse counts read since the change
+        cache.clear()
+        counts = {'op': 'counts', 'id': room.id, 'participant_count': 1, 'message_count': 1}
+        self.assertEqual(room_events.fill_counts([sent[0][1]]), [counts])
+        with self.assertNumQueries(0):
+            self.assertEqual(room_events.fill_counts([sent[1][1]]), [counts])
+        newer = self.published('post', '/api/v1/messages/', {'room': room.id, 'body': 'again'})[0][1]
+        self.assertEqual(room_events.fill_counts([newer]), [{**counts, 'message_count': 2}])
+
+        # Chat messages too
+        save = query_plans._sync(consumers.ChatConsumer, 'save_message')
+        with mock.patch.object(room_events, 'counts_changed') as counts_changed:
+            save(consumers.ChatConsumer(), member.id, room.id, 'again')
+        self.assertEqual([call.args[0].id for call in counts_changed.call_args_list], [room.id])
+
+    def test_nothing_is_published_for_rolled_back_changes(self):
+        with mock.patch.object(room_events, 'get_channel_layer') as layer:
+            with transaction.atomic():
+                room_events.room_deleted(1, None)
+                transaction.set_rollback(True)
+        layer.assert_not_called()
+
+
+@override_settings(ROOM_LIST_WINDOW=0.05)
+class RoomListConsumerTests(SimpleTestCase):
+    async def connect(self, path='/ws/rooms/'):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), path)
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def send(self, group, event):
+        await get_channel_layer().group_send(group, {'type': 'room.event', 'event': event})
+
+    async def test_events_in_one_window_are_merged_into_one_frame(self):
+        communicator = await self.connect()
+        frames = metrics.ROOM_LIST_FRAMES.labels().value
+        await self.send('rooms', {'op': 'created', 'id': 1, 'name': 'a', 'topic': None, 'host': 1,
+                                  'participant_count': 1, 'message_count': 0})
+        await self.send('rooms', {'op': 'updated', 'id': 1, 'name': 'b', 'topic': None, 'host': 1})
+        await self.send('rooms', {'op': 'counts', 'id': 1, 'participant_count': 3})
+        await self.send('rooms', {'op': 'counts', 'id': 2, 'participant_count': 4})
+        await self.send('rooms', {'op': 'updated', 'id': 3, 'name': 'c', 'topic': None, 'host': 1})
+        await self.send('rooms', {'op': 'deleted', 'id': 3})
+        await self.send('rooms', {'op': 'counts', 'id': 3, 'participant_count': 0})
+
+        self.assertEqual(await communicator.receive_json_from(), {'type': 'rooms', 'events': [
+            {'op': 'created', 'id': 1, 'name': 'b', 'topic': None, 'host': 1, 'participant_count': 3, 'message_count': 0},
+            {'op': 'counts', 'id': 2, 'participant_count': 4},
+            {'op': 'deleted', 'id': 3},
+        ]})
+        self.assertTrue(await communicator.receive_nothing())
+        self.assertEqual(metrics.ROOM_LIST_FRAMES.labels().value, frames + 1)
+
+        await self.send('rooms', {'op': 'counts', 'id': 2, 'participant_count': 5})
+        self.assertEqual((await communicator.receive_json_from())['events'], [{'op': 'counts', 'id': 2, 'participant_count': 5}])
+        await communicator.disconnect()
+
+    async def test_topic_subscribers_only_hear_their_topic(self):
+        communicator = await self.connect('/ws/rooms/?topic=7')
+        await self.send('rooms', {'op': 'deleted', 'id': 1})
+        await self.send(room_events.topic_group(8), {'op': 'deleted', 'id': 2})
+        self.assertTrue(await communicator.receive_nothing())
+        await self.send(room_events.topic_group(7), {'op': 'deleted', 'id': 3})
+        self.assertEqual((await communicator.receive_json_from())['events'], [{'op': 'deleted', 'id': 3}])
+        await communicator.disconnect()
+
+    async def test_invalid_topic_is_refused(self):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/rooms/?topic=math')
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+
+
+# ==================== IDLE CONNECTIONS ====================
+
+# Python heap bytes an idle chat socket may hold beyond a bare accepted
+# socket, measured in-process by `bench_ws_memory` (see the README)
+IDLE_CONNECTION_BUDGET = 1024
+
+
+class IdleConnectionTests(SimpleTestCase):
+    async def test_idle_connection_memory_budget(self):
+        from .management.commands.bench_ws_memory import BareConsumer
+        from django.urls import re_path
+
+        paths = [f'/ws/chat/{index % 10}/' for index in range(500)]
+        bare = URLRouter([re_path(r'ws/chat/(?P<room_id>\w+)/$', BareConsumer.as_asgi())])
+        overhead = (await benchmarks.idle_connection_bytes(URLRouter(websocket_urlpatterns), paths)
+                    - await benchmarks.idle_connection_bytes(bare, paths))
+        self.assertLess(overhead, IDLE_CONNECTION_BUDGET)
+
+    async def test_connections_in_a_room_share_one_hub(self):
+        first = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/chat/41/')
+        second = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/chat/41/')
+        await first.connect()
+        await second.connect()
+        hub = sockets._hubs['41']
+        self.assertEqual(len(hub.connections), 2)
+        self.assertEqual(len(get_channel_layer().groups[hub.group]), 1)
+
+        await sockets.publish(41, {'type': 'chat_message', 'room': 41, 'message': 'hi', 'user_id': 1, 'username': 'a',
+                                   'created': '2026-10-19T09:30:00+00:00', 'message_id': 1, 'seq': 1})
+        self.assertEqual((await first.receive_json_from())['message'], 'hi')
+        self.assertEqual((await second.receive_json_from())['message'], 'hi')
+
+        await first.disconnect()
+        await second.disconnect()
+        self.assertNotIn('41', sockets._hubs)
+        self.assertNotIn(hub.group, get_channel_layer().groups)
+
+    async def test_hub_left_while_starting_undoes_its_setup(self):
+        layer = get_channel_layer()
+        group_add, adding, release = layer.group_add, asyncio.Event(), asyncio.Event()
+
+        async def slow_group_add(group, channel):
+            adding.set()
+            await release.wait()
+            await group_add(group, channel)
+
+        consumer = mock.Mock()
+        with mock.patch.object(layer, 'group_add', slow_group_add):
+            joining = asyncio.ensure_future(sockets.join(44, consumer))
+            await adding.wait()
+            hub = sockets._hubs['44']
+            await sockets.leave(44, consumer)
+            release.set()
+            await joining
+        self.assertNotIn('44', sockets._hubs)
+        self.assertNotIn(hub.group, layer.groups)
+        self.assertIsNone(hub.task)
+
+    async def test_hub_keeps_receiving_after_a_layer_error(self):
+        layer = mock.Mock()
+        event = {'type': 'chat_message', 'message': 'hi'}
+        layer.receive = mock.AsyncMock(side_effect=[RuntimeError('layer down'), event, asyncio.CancelledError()])
+        consumer = mock.Mock()
+        consumer.send_frame = mock.AsyncMock()
+        hub = sockets.RoomHub('45')
+        hub.connections.add(consumer)
+        with mock.patch.object(sockets, 'RECEIVE_RETRY_DELAY', 0), self.assertLogs('base.sockets', 'ERROR'):
+            with self.assertRaises(asyncio.CancelledError):
+                await hub.run(layer)
+        consumer.send_frame.assert_awaited_once_with(consumer.state.codec.encode_message.return_value)
+
+    @override_settings(WS_IDLE_TIMEOUT=0.5, WS_IDLE_CLOSE_CODE=4009)
+    async def test_idle_connections_are_closed(self):
+        idle = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/chat/42/')
+        active = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/chat/43/')
+        await idle.connect()
+        await active.connect()
+        for _ in range(8):
+            await asyncio.sleep(0.1)
+            await active.send_json_to({'type': 'typing'})
+        self.assertEqual(await idle.receive_output(2), {'type': 'websocket.close', 'code': 4009})
+        self.assertTrue(await active.receive_nothing())
+        self.assertNotIn('42', sockets._hubs)
+        await active.disconnect()
+
+
+# ==================== WIRE FORMAT ====================
+
+class WireFormatTests(ShardedTransactionTestCase):
+    # save_message runs on a database thread, which only sees committed data
+
+    def setUp(self):
+        self.user = User.objects.create(username='élise', email='elise@example.com')
+        self.room = Room.objects.create(host=self.user, name='algebra')
+        self.application = URLRouter(websocket_urlpatterns)
+
+    async def connect(self, subprotocols=None):
+        communicator = WebsocketCommunicator(self.application, f'/ws/chat/{self.room.id}/', subprotocols=subprotocols)
+        connected, subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator, subprotocol
+
+    async def test_binary_and_json_clients_share_a_room(self):
+        binary, subprotocol = await self.connect([wire.BINARY_SUBPROTOCOL])
+        text, default = await self.connect()
+        self.assertEqual((subprotocol, default), (wire.BINARY_SUBPROTOCOL, None))
+
+        await binary.send_to(bytes_data=wire.BINARY.encode_client({'user_id': self.user.id, 'message': 'ça va?'}))
+        frame = await binary.receive_from()
+        as_json = await text.receive_json_from()
+
+        self.assertIsInstance(frame, bytes)
+        self.assertLess(len(frame), len(json.dumps(as_json)) / 2)
+        decoded = wire.BINARY.decode_server(frame)
+        for key in ('message', 'user_id', 'username', 'message_id', 'seq'):
+            self.assertEqual(decoded[key], as_json[key])
+        self.assertEqual(decoded['created_ms'], wire.epoch_ms(as_json['created']))
+        await binary.disconnect()
+        await text.disconnect()
+
+    async def test_malformed_binary_frame_is_rejected(self):
+        binary, _ = await self.connect([wire.BINARY_SUBPROTOCOL])
+        await binary.send_to(bytes_data=bytes([wire.MESSAGE, 1]))
+        error = wire.BINARY.decode_server(await binary.receive_from())
+        self.assertEqual(error, {'type': 'error', 'code': 'malformed', 'retry_after': None})
+        await binary.disconnect()
+
+
+# ==================== MULTIPLEXED CHAT ====================
+
+class MultiplexTests(ShardedTransactionTestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='reader')
+        self.rooms = [Room.objects.create(host=self.user, name=f'room {i}') for i in range(3)]
+        for room in self.rooms[:2]:
+            room.participants.add(self.user)
+        self.application = JWTAuthMiddleware(URLRouter(websocket_urlpatterns))
+        self.token = str(RefreshToken.for_user(self.user).access_token)
+
+    async def connect(self):
+        communicator = WebsocketCommunicator(self.application, f'/ws/chat/?token={self.token}')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def test_anonymous_connections_are_refused(self):
+        for path in ('/ws/chat/', '/ws/chat/?token=not-a-jwt'):
+            connected, _ = await WebsocketCommunicator(self.application, path).connect()
+            self.assertFalse(connected)
+
+    async def test_one_connection_carries_many_rooms(self):
+        first, second, other = self.rooms
+        communicator = await self.connect()
+        for room in (first, second, other):
+            await communicator.send_json_to({'type': 'subscribe', 'room': room.id})
+        self.assertEqual(await communicator.receive_json_from(), {'type': 'subscribed', 'room': first.id})
+        self.assertEqual(await communicator.receive_json_from(), {'type': 'subscribed', 'room': second.id})
+        self.assertEqual(await communicator.receive_json_from(), {'type': 'error', 'code': 'not_a_member', 'room': other.id})
+        self.assertEqual(metrics.WS_SUBSCRIPTIONS.labels().value, 2)
+
+        # Messages from per-room sockets and from the multiplexed one both arrive tagged by room
+        chat = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'/ws/chat/{second.id}/')
+        await chat.connect()
+        await chat.send_json_to({'message': 'from a room socket', 'user_id': self.user.id})
+        await communicator.send_json_to({'type': 'message', 'room': first.id, 'message': 'hello'})
+        received = {(event['room'], event['message']) for event in
+                    [await communicator.receive_json_from(), await communicator.receive_json_from()]}
+        self.assertEqual(received, {(second.id, 'from a room socket'), (first.id, 'hello')})
+        self.assertEqual((await chat.receive_json_from())['room'], second.id)
+
+        await communicator.send_json_to({'type': 'message', 'room': other.id, 'message': 'nope'})
+        self.assertEqual((await communicator.receive_json_from())['code'], 'not_subscribed')
+
+        await communicator.send_json_to({'type': 'unsubscribe', 'room': second.id})
+        self.assertEqual(await communicator.receive_json_from(), {'type': 'unsubscribed', 'room': second.id})
+        await chat.send_json_to({'message': 'unheard', 'user_id': self.user.id})
+        await chat.receive_json_from()
+        self.assertTrue(await communicator.receive_nothing())
+
+        await communicator.disconnect()
+        await chat.disconnect()
+        self.assertEqual(metrics.WS_SUBSCRIPTIONS.labels().value, 0)
+
+    @override_settings(WS_MAX_SUBSCRIPTIONS=1)
+    async def test_subscription_limit(self):
+        communicator = await self.connect()
+        await communicator.send_json_to({'type': 'subscribe', 'room': self.rooms[0].id})
+        await communicator.send_json_to({'type': 'subscribe', 'room': self.rooms[1].id})
+        await communicator.send_json_to({'type': 'subscribe', 'room': 'lobby'})
+        self.assertEqual((await communicator.receive_json_from())['type'], 'subscribed')
+        self.assertEqual((await communicator.receive_json_from())['code'], 'too_many_subscriptions')
+        self.assertEqual((await communicator.receive_json_from())['code'], 'malformed')
+        await communicator.disconnect()
+
+
+# ==================== MESSAGE SHARDS ====================
+
+@skipUnless(settings.MESSAGE_SHARDS >= 2, 'run with MESSAGE_SHARDS=2 to test message sharding')
+class MessageShardTests(ShardedTransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='host', email='host@example.com')
+        self.rooms = [Room.objects.create(host=self.user, name=f'room {i}') for i in range(2)]
+        self.assertNotEqual(*(sharding.shard_for_room(room.id) for room in self.rooms))
+        self.client = APIClient(HTTP_HOST='localhost')
+        self.client.force_authenticate(self.user)
+
+    def post(self, room, body):
+        return Message.objects.create(user=self.user, room=room, body=body)
+
+    def test_messages_are_written_to_their_rooms_shard(self):
+        messages = [self.post(room, f'{room.name} #{i}') for i in range(2) for room in self.rooms]
+        sharding.seq_flusher.flush()
+
+        self.assertFalse(Message.objects.using('default').exists())
+        for room in self.rooms:
+            stored = sharding.room_messages(room.id).order_by('seq')
+            self.assertEqual([m.seq for m in stored], [1, 2])
+            room.refresh_from_db()
+            self.assertEqual(room.last_seq, 2)
+        self.assertEqual(len({m.id for m in messages}), 4)
+        self.assertEqual({sharding.shard_of_id(m.id) for m in messages[:2]}, {sharding.shard_for_room(r.id) for r in self.rooms})
+
+    def test_api_reads_span_shards(self):
+        first = self.post(self.rooms[0], 'hello')
+        second = self.post(self.rooms[1], 'world')
+
+        by_user = self.client.get(f'/api/v1/messages/?user={self.user.id}').json()
+        self.assertEqual(by_user['count'], 2)
+        self.assertEqual([m['body'] for m in by_user['results']], ['world', 'hello'])
+        self.assertEqual(by_user['results'][0]['user']['username'], 'host')
+        by_room = self.client.get(f'/api/v1/messages/?room={self.rooms[0].id}').json()
+        self.assertEqual([m['body'] for m in by_room['results']], ['hello'])
+
+        for message in (first, second):
+            self.assertEqual(self.client.get(f'/api/v1/messages/{message.id}/').json()['body'], message.body)
+        self.assertEqual(self.client.get('/api/v1/messages/1/').status_code, 404)
+
+        detail = self.client.get(f'/api/v1/rooms/{self.rooms[1].id}/').json()
+        self.assertEqual((detail['message_count'], [m['body'] for m in detail['messages']]), (1, ['world']))
+        history = self.client.get(f'/api/v1/rooms/{self.rooms[0].id}/history/').json()
+        self.assertEqual([m['seq'] for m in history['results']], [1])
+
+    def test_seeded_messages_are_written_to_their_rooms_shards(self):
+        call_command('seed_data', '--users', '5', '--topics', '2', '--rooms', '4', '--messages', '40', stdout=StringIO())
+        self.assertFalse(Message.objects.using('default').exists())
+        rooms = Room.objects.filter(name__startswith='seed:')
+        self.assertEqual(sum(sharding.room_messages(room.id).count() for room in rooms), 40)
+        message = sharding.room_messages(rooms[0].id).first()
+        self.assertEqual(sharding.get_message(message.id).body, message.body)
+
+    def test_rebalance_moves_rows_and_room_delete_cleans_up(self):
+        with self.settings(MESSAGE_SHARDS=1):
+            for room in self.rooms:
+                self.post(room, 'before')
+        self.assertEqual(Message.objects.using('messages_0').count(), 2)
+
+        call_command('rebalance_message_shards', stdout=StringIO())
+        for room in self.rooms:
+            self.assertEqual(sharding.room_messages(room.id).count(), 1)
+        self.assertEqual(sum(Message.objects.using(alias).count() for alias in sharding.aliases()), 2)
+
+        room_id = self.rooms[0].id
+        self.rooms[0].delete()
+        self.assertFalse(sharding.room_messages(room_id).exists())
+
+
+# ==================== ADMIN CHANGELISTS ====================
+
+class AdminChangelistTests(ShardedTestCase):
+
+    def setUp(self):
+        self.admin = User.objects.create(username='admin', email='admin@example.com', is_staff=True, is_superuser=True)
+        self.room = Room.objects.create(host=self.admin, name='Algebra')
+        self.messages = [Message.objects.create(user=self.admin, room=self.room, body=f'#{i}') for i in range(3)]
+        self.client = APIClient(HTTP_HOST='localhost')
+        self.client.force_login(self.admin)
+
+    @skipIf(sharding.enabled(), 'the message changelist lists `default` only')
+    def test_message_changelist_pages_by_id_without_offset(self):
+        with mock.patch.object(admin.MessageAdmin, 'list_per_page', 2):
+            with CaptureQueriesContext(connection) as queries:
+                first = self.client.get('/admin/base/message/')
+            cl = first.context['cl']
+            self.assertEqual([m.body for m in cl.result_list], ['#2', '#1'])
+            self.assertEqual(cl.next_url, f'?id__lt={self.messages[1].id}')
+            self.assertNotIn('OFFSET', ' '.join(q['sql'] for q in queries.captured_queries).upper())
+
+            older = self.client.get('/admin/base/message/' + cl.next_url)
+        cl = older.context['cl']
+        self.assertEqual([m.body for m in cl.result_list], ['#0'])
+        self.assertIsNone(cl.next_url)
+        self.assertEqual(cl.first_url, '?')
+
+    @skipIf(sharding.enabled(), 'the message changelist lists `default` only')
+    def test_large_tables_show_estimated_counts(self):
+        with mock.patch.object(admin, 'estimated_count', return_value=5000000):
+            response = self.client.get('/admin/base/message/')
+        self.assertEqual(response.context['cl'].result_count, 5000000)
+        self.assertContains(response, 'about 5000000 messages')
+
+        # Filtered lists count, but stop one row past the limit
+        with self.settings(ADMIN_EXACT_COUNT_LIMIT=2):
+            response = self.client.get(f'/admin/base/message/?room__id__exact={self.room.id}')
+        self.assertEqual(response.context['cl'].result_count, 3)
+        self.assertContains(response, 'about 3 messages')
+
+    def test_changelist_queries_do_not_grow_with_rows(self):
+        counts = []
+        for path in ('/admin/base/message/', '/admin/base/room/', '/admin/base/user/'):
+            with CaptureQueriesContext(connection) as small:
+                self.client.get(path)
+            counts.append(len(small))
+        for i in range(10):
+            user = User.objects.create(username=f'user{i}', email=f'user{i}@example.com')
+            room = Room.objects.create(host=user, name=f'room {i}')
+            Message.objects.create(user=user, room=room, body='hi')
+        for path, count in zip(('/admin/base/message/', '/admin/base/room/', '/admin/base/user/'), counts):
+            with self.assertNumQueries(count):
+                self.client.get(path)
+
+    def test_foreign_keys_do_not_render_every_row(self):
+        form = self.client.get('/admin/base/message/add/').context['adminform'].form
+        self.assertEqual({type(form.fields[name].widget).__name__ for name in ('user', 'room')}, {'ForeignKeyRawIdWidget'})
+        form = self.client.get('/admin/base/room/add/').context['adminform'].form
+        self.assertEqual(type(form.fields['participants'].widget).__name__, 'ManyToManyRawIdWidget')
+        self.assertEqual(type(form.fields['host'].widget.widget).__name__, 'AutocompleteSelect')
+
+
+# ==================== QUERY PLANS ====================
+
+class QueryPlanTests(ShardedTestCase):
+
+    def test_hot_queries_use_indexes(self):
+        out = StringIO()
+        call_command('check_query_plans', stdout=out)
+        self.assertIn('No unexpected scans or sorts', out.getvalue())
+
+    def test_unindexed_sorts_and_scans_are_reported(self):
+        sql, params = Message.objects.filter(body__startswith='hi').order_by('body').query.sql_with_params()
+        issues = query_plans.explain('default', sql, params)
+        self.assertEqual({kind for kind, _, _ in issues}, {'scan', 'sort'})
+        self.assertEqual(query_plans.allowed('scan', 'base_message', sql), '')
+
+    def test_unexpected_findings_fail_the_command(self):
+        with mock.patch.object(query_plans, 'ALLOWED', []):
+            with self.assertRaisesMessage(CommandError, 'room list: '):
+                call_command('check_query_plans', '--scenario', 'room list', stdout=StringIO())
+
+
+# ==================== AVATARS ====================
+
+def image_bytes(size, fmt='PNG', orientation=None):
+    buffer = io.BytesIO()
+    exif = Image.Exif()
+    if orientation:
+        exif[0x0112] = orientation
+    Image.new('RGB', size, 'teal').save(buffer, fmt, exif=exif.tobytes())
+    return buffer.getvalue()
+
+
+class AvatarTests(TestCase):
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        media_root = self.settings(MEDIA_ROOT=media.name)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+        self.user = User.objects.create(username='avatar', email='avatar@example.com')
+
+    def upload(self, content, name='avatar.png'):
+        self.user.avatar.save(name, ContentFile(content))
+
+    def test_decode_rotates_the_reduced_image(self):
+        with mock.patch.object(avatars.ImageOps, 'exif_transpose', wraps=avatars.ImageOps.exif_transpose) as transpose:
+            image = avatars._decode(io.BytesIO(image_bytes((2000, 1000), orientation=6)), 64)
+        # 1000 // 128 = 7, so rotation ran on a 286x143 bitmap (reduce() rounds up)
+        self.assertEqual(transpose.call_args.args[0].size, (286, 143))
+        self.assertEqual(image.size, (143, 286))
+
+    def test_process_avatars_renders_variants_and_records_hash(self):
+        self.upload(image_bytes((300, 200)))
+        User.objects.create(username='default', email='default@example.com')
+        out = StringIO()
+        call_command('process_avatars', stdout=out)
+        self.assertIn('Processed 1 avatars (0 failed)', out.getvalue())
+
+        self.user.refresh_from_db()
+        digest = self.user.avatar_hash
+        self.assertEqual(len(digest), 32)
+        for size in settings.AVATAR_VARIANT_SIZES:
+            for fmt in settings.AVATAR_VARIANT_FORMATS:
+                self.assertTrue(default_storage.exists(avatars.variant_name(digest, size, fmt)))
+        self.assertTrue(UserSerializer(self.user).data['avatar_small'].endswith(f'{digest}-64.webp'))
+
+        # Users created before avatar_hash existed have '' and are picked up; processed ones are not
+        call_command('process_avatars', stdout=out)
+        self.assertIn('Processed 0 avatars', out.getvalue())
+        call_command('process_avatars', '--all', stdout=out)
+        self.assertIn('Processed 1 avatars', out.getvalue().splitlines()[-1])
+
+    def test_unprocessed_avatars_fall_back_to_the_upload(self):
+        self.upload(b'not an image')
+        err = StringIO()
+        call_command('process_avatars', stdout=StringIO(), stderr=err)
+        self.assertIn(f'User {self.user.id}:', err.getvalue())
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.avatar_hash, '')
+        self.assertEqual(UserSerializer(self.user).data['avatar_small'], self.user.avatar.url)
+        default = User.objects.create(username='default', email='default@example.com')
+        self.assertEqual(UserSerializer(default).data['avatar_small'], '/media/avatar.svg')
+
+
+# ==================== REQUEST INSTRUMENTATION ====================
+
+@override_settings(REQUEST_INSTRUMENTATION_ENABLED=True)
+class RequestInstrumentationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        Topic.objects.create(name='algebra')
+        # A new client builds its middleware chain with the settings above
+        self.client = APIClient(HTTP_HOST='localhost')
+
+    def test_responses_carry_timings_and_log_fields(self):
+        with self.assertLogs('base.middleware', 'INFO') as logs:
+            response = self.client.get('/api/v1/topics/')
+        timing = response['Server-Timing']
+        self.assertRegex(timing, r'^db;dur=[\d.]+;desc="\d+ queries"')
+        self.assertIn('serialize;dur=', timing)
+        self.assertIn('total;dur=', timing)
+        self.assertNotIn('nplusone', timing)
+
+        fields = logs.records[0].request_metrics
+        self.assertEqual(set(fields), {'method', 'path', 'view', 'status', 'queries', 'db_ms', 'serialize_ms', 'render_ms', 'total_ms'})
+        self.assertEqual((fields['method'], fields['path'], fields['view'], fields['status']),
+                         ('GET', '/api/v1/topics/', 'api-topics', 200))
+        self.assertGreater(fields['queries'], 0)
+
+    def test_statements_repeated_threshold_times_are_reported(self):
+        profile = instrumentation.RequestProfile()
+        for _ in range(3):
+            profile.record_query('SELECT 1', 0.0)
+        profile.record_query('SELECT 2', 0.0)
+        self.assertEqual(profile.repeated_queries(3), [('SELECT 1', 3)])
+        self.assertEqual(profile.repeated_queries(4), [])
+
+        with self.settings(REQUEST_INSTRUMENTATION_N_PLUS_ONE_THRESHOLD=1):
+            client = APIClient(HTTP_HOST='localhost')
+            with self.assertLogs('base.middleware', 'WARNING') as logs:
+                response = client.get('/api/v1/topics/')
+        self.assertIn('nplusone;desc=', response['Server-Timing'])
+        record = logs.records[0]
+        self.assertEqual((record.view, record.repeat_count), ('api-topics', 1))
+        self.assertIn('Suspected N+1 in api-topics', record.getMessage())
+
+    @override_settings(REQUEST_INSTRUMENTATION_ENABLED=False)
+    def test_disabled_middleware_leaves_the_stack(self):
+        response = APIClient(HTTP_HOST='localhost').get('/api/v1/topics/')
+        self.assertNotIn('Server-Timing', response)
+
+
+# ==================== METRICS ====================
+
+class MetricsTests(TestCase):
+    def test_registry_renders_prometheus_text(self):
+        registry = metrics.Registry()
+        counter = registry.counter('test_frames_total', 'Frames', ['reason'])
+        counter.labels('too "big"').inc(2)
+        gauge = registry.gauge('test_open', 'Open sockets')
+        gauge.inc(3)
+        gauge.dec()
+        registry.gauge('test_hubs', 'Hubs', callback=lambda: 7)
+        histogram = registry.histogram('test_latency_seconds', 'Latency')
+        for millis in range(1, 101):
+            histogram.observe(millis / 1000)
+        self.assertIs(registry.counter('test_frames_total', 'Frames', ['reason']), counter)
+
+        lines = registry.render().splitlines()
+        self.assertEqual(lines[:5], [
+            '# HELP test_frames_total Frames',
+            '# TYPE test_frames_total counter',
+            'test_frames_total{reason="too \\"big\\""} 2',
+            '# HELP test_open Open sockets',
+            '# TYPE test_open gauge',
+        ])
+        self.assertIn('test_open 2', lines)
+        self.assertIn('test_hubs 7', lines)
+        self.assertIn('# TYPE test_latency_seconds summary', lines)
+        self.assertIn('test_latency_seconds_count 100', lines)
+        quantiles = {line.split('"')[1]: float(line.split()[-1]) for line in lines if 'quantile=' in line}
+        self.assertEqual(set(quantiles), {'0.5', '0.9', '0.99', '0.999'})
+        # Log-linear buckets keep each value within ~6%
+        self.assertAlmostEqual(quantiles['0.5'], 0.050, delta=0.050 * 0.07)
+        self.assertAlmostEqual(quantiles['0.99'], 0.099, delta=0.099 * 0.07)
+        self.assertLessEqual(quantiles['0.999'], 0.1)
+
+        counter.remove('too "big"')
+        self.assertNotIn('reason=', registry.render())
+
+    def test_endpoint_is_admin_only(self):
+        client = APIClient(HTTP_HOST='localhost')
+        self.assertIn(client.get('/api/v1/metrics/').status_code, (401, 403))
+        user = User.objects.create(username='member', email='member@example.com')
+        client.force_authenticate(user)
+        self.assertEqual(client.get('/api/v1/metrics/').status_code, 403)
+
+        staff = User.objects.create(username='staff', email='staff@example.com', is_staff=True)
+        client.force_authenticate(staff)
+        response = client.get('/api/v1/metrics/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        body = response.content.decode()
+        self.assertIn('# TYPE studybud_ws_connections gauge', body)
+        self.assertIn('\nstudybud_ws_connections ', body)
+
+        # Staff signed in to the admin use their session
+        session = APIClient(HTTP_HOST='localhost')
+        session.force_login(staff)
+        self.assertEqual(session.get('/api/v1/metrics/').status_code, 200)
+
+
+# ==================== ACTIVITY FEED ====================
+
+class FeedTests(ShardedTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.alice, self.bob, self.carol = [
+            User.objects.create(username=name, email=f'{name}@example.com') for name in ('alice', 'bob', 'carol')
+        ]
+        self.room = Room.objects.create(host=self.alice, name='Algebra')
+        self.room.participants.add(self.alice, self.bob, self.carol)
+        self.client = APIClient(HTTP_HOST='localhost')
+        self.client.force_authenticate(self.bob)
+
+    def post(self, user, body, room=None):
+        if sharding.enabled():
+            # Ids from different shards are only ordered from one millisecond to the next
+            time.sleep(0.002)
+        message = Message.objects.create(user=user, room=room or self.room, body=body)
+        feed.publish_message(message)
+        return message
+
+    def bodies(self, path='/api/v1/feed/'):
+        return [item['body'] for item in self.client.get(path).json()['results']]
+
+    def test_messages_fan_out_to_other_members(self):
+        message = self.post(self.alice, 'hello')
+        self.assertEqual(
+            sorted(FeedEntry.objects.filter(message_id=message.id).values_list('owner__username', flat=True)),
+            ['bob', 'carol'],
+        )
+        item = self.client.get('/api/v1/feed/').json()['results'][0]
+        self.assertEqual((item['message_id'], item['room_name'], item['body'], item['user']['username']),
+                         (message.id, 'Algebra', 'hello', 'alice'))
+
+    def test_edits_and_deletes_reach_the_feed(self):
+        message = self.post(self.alice, 'first draft')
+        author = APIClient(HTTP_HOST='localhost')
+        author.force_authenticate(self.alice)
+        author.patch(f'/api/v1/messages/{message.id}/', {'body': 'final'}, format='json')
+        self.assertEqual(self.bodies(), ['final'])
+
+        author.delete(f'/api/v1/messages/{message.id}/')
+        self.assertEqual(self.bodies(), [])
+        self.assertFalse(FeedEntry.objects.filter(message_id=message.id).exists())
+
+    @override_settings(FEED_FANOUT_MAX_RECIPIENTS=2)
+    def test_large_rooms_are_merged_in_at_read_time(self):
+        small = Room.objects.create(host=self.alice, name='Small')
+        small.participants.add(self.alice, self.bob)
+        self.post(self.alice, 'big 1')
+        self.post(self.alice, 'small 1', room=small)
+        self.post(self.bob, 'own message')
+        self.post(self.carol, 'big 2')
+
+        # Only the two-member room was fanned out on write
+        self.assertEqual(list(FeedEntry.objects.values_list('preview', flat=True)), ['small 1'])
+        self.assertEqual(self.bodies(), ['big 2', 'small 1', 'big 1'])
+
+        # Entries pushed before the room grew past the limit are not shown twice
+        small.participants.add(self.carol)
+        self.assertEqual(self.bodies(), ['big 2', 'small 1', 'big 1'])
+
+    def test_room_deletes_do_not_load_their_messages(self):
+        queries = []
+        for size in (2, 20):
+            room = Room.objects.create(host=self.alice, name=f'Room of {size}')
+            room.participants.add(self.alice, self.bob)
+            for i in range(size):
+                self.post(self.alice, f'#{i}', room=room)
+            room_id = room.id
+            with CaptureQueriesContext(connection) as captured:
+                room.delete()
+            queries.append(len(captured))
+            self.assertFalse(FeedEntry.objects.filter(room_id=room_id).exists())
+            self.assertFalse(sharding.room_messages(room_id).exists())
+        self.assertEqual(queries[0], queries[1])
+
+    @override_settings(FEED_MAX_LENGTH=2, FEED_TRIM_INTERVAL=1)
+    def test_feeds_are_trimmed_to_the_newest_entries(self):
+        for i in range(4):
+            self.post(self.alice, f'#{i}')
+        self.assertEqual(
+            list(FeedEntry.objects.filter(owner=self.bob).order_by('-message_id').values_list('preview', flat=True)),
+            ['#3', '#2'],
+        )
+
+    def test_before_pages_by_message_id(self):
+        messages = [self.post(self.alice, f'#{i}') for i in range(5)]
+        page = self.client.get('/api/v1/feed/?limit=2').json()
+        self.assertEqual([item['body'] for item in page['results']], ['#4', '#3'])
+        self.assertIn(f'before={messages[3].id}', page['next'])
+
+        page = self.client.get(page['next']).json()
+        self.assertEqual([item['body'] for item in page['results']], ['#2', '#1'])
+        self.assertEqual(self.bodies(f'/api/v1/feed/?before={messages[1].id}&limit=2'), ['#0'])
+
+
+# ==================== STARTUP ====================
+
+class StartupTests(TransactionTestCase):
+    # The ASGI application runs views on other threads, which only see committed data
+
+    def test_warm_up_runs_every_step(self):
+        with self.assertLogs('base.warmup', 'INFO'):
+            timings = warmup.warm_up()
+        self.assertEqual(list(timings), ['urls', 'models', 'serializers', 'database'])
+        self.assertGreater(warmup.compile_urls(), 0)
+
+    def test_failing_step_is_logged_and_the_rest_still_run(self):
+        ran = []
+        steps = (('broken', mock.Mock(side_effect=RuntimeError('boom'))), ('next', lambda: ran.append(True)))
+        with mock.patch.object(warmup, 'STEPS', steps), self.assertLogs('base.warmup', 'ERROR') as logs:
+            timings = warmup.warm_up()
+        self.assertEqual(list(timings), ['broken', 'next'])
+        self.assertEqual(ran, [True])
+        self.assertIn('Warm-up step broken failed', logs.output[0])
+
+    def test_database_step_opens_no_connection(self):
+        opened = []
+
+        def run():
+            warmup.load_database_backends()
+            opened.extend(alias for alias in connections if connections[alias].connection is not None)
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+        self.assertEqual(opened, [])
+
+    def test_requests_go_through_the_asgi_application(self):
+        from StudyBud.asgi import application
+
+        Topic.objects.create(name='algebra')
+        status_code, body = async_to_sync(startup.asgi_get)(application, '/api/v1/topics/?q=alg')
+        self.assertEqual(status_code, 200)
+        self.assertEqual([topic['name'] for topic in json.loads(body)['results']], ['algebra'])
+
+    def test_import_times_are_parsed_and_grouped(self):
+        stderr = '\n'.join([
+            'import time: self [us] | cumulative | imported package',
+            'import time:       100 |        100 |   django.utils',
+            'import time:       250 |        350 | django',
+            'import time:      1500 |       1500 | rest_framework.fields',
+            'Some other output',
+        ])
+        modules = startup.parse_importtime(stderr)
+        self.assertEqual(modules, [
+            ('django.utils', 100, 100), ('django', 250, 350), ('rest_framework.fields', 1500, 1500),
+        ])
+        self.assertEqual(startup.by_package(modules), [('rest_framework', 1.5), ('django', 0.35)])
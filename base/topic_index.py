@@ -0,0 +1,194 @@
+"""
+In-process prefix index over topic names for autocomplete.
+
+Every word-aligned suffix of a topic name ("linear algebra" is stored under
+"linear algebra" and "algebra") is a key in one sorted list, so a prefix
+lookup is a bisect plus a scan over the matching run. Matches are ranked by
+room count, which the index keeps next to the names.
+
+The index is built with one query on first use and kept current by Topic and
+Room signals, applied once the transaction commits. Writes that bypass
+signals (bulk_create, QuerySet.update, other worker processes) are picked up
+by a full rebuild once the index is TOPIC_INDEX_MAX_AGE seconds old.
+"""
+import bisect
+import heapq
+import sys
+import threading
+import time
+from functools import partial
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+
+from .metrics import REGISTRY
+from .models import Room, Topic
+
+
+def normalize(text):
+    return ' '.join(text.casefold().split())
+
+
+def _keys(topic_id, name):
+    words = normalize(name).split(' ')
+    return [(' '.join(words[i:]), topic_id) for i in range(len(words)) if words[i]]
+
+
+class TopicIndex:
+    def __init__(self):
+        # Readers take references to `keys`, `names` and `room_counts` and
+        # never see them change: writers replace them instead of mutating them
+        # (topics are few, so copying a dict per change is cheap). A reader may
+        # pair a new `keys` with an old `names`; search() skips ids it has no
+        # name for and counts missing ones as 0.
+        self.keys = []
+        self.names = {}
+        self.room_counts = {}
+        self.built = None
+        self.lock = threading.Lock()
+        # Ranking for the empty prefix, which would otherwise scan every key
+        self.top = None
+
+    def build(self):
+        keys, names, room_counts = [], {}, {}
+        for topic_id, name, room_count in Topic.objects.annotate(room_count=Count('room')).values_list('id', 'name', 'room_count'):
+            keys.extend(_keys(topic_id, name))
+            names[topic_id] = name
+            room_counts[topic_id] = room_count
+        keys.sort()
+        with self.lock:
+            self.keys, self.names, self.room_counts = keys, names, room_counts
+            self.built = time.monotonic()
+            self.top = None
+
+    def is_stale(self):
+        return self.built is None or time.monotonic() - self.built > settings.TOPIC_INDEX_MAX_AGE
+
+    def search(self, prefix, limit=10):
+        """Up to `limit` topics with a word starting with `prefix`, most rooms first"""
+        prefix = normalize(prefix)
+        keys, names, room_counts = self.keys, self.names, self.room_counts
+        if not prefix:
+            top = self.top
+            if top is None or len(top) < min(limit, len(names)):
+                top = self.top = self.rank(names, names, room_counts, max(limit, settings.TOPIC_AUTOCOMPLETE_MAX_LIMIT))
+            return top[:limit]
+        matched = set()
+        for i in range(bisect.bisect_left(keys, (prefix,)), len(keys)):
+            key, topic_id = keys[i]
+            if not key.startswith(prefix):
+                break
+            matched.add(topic_id)
+        return self.rank(matched, names, room_counts, limit)
+
+    @staticmethod
+    def rank(topic_ids, names, room_counts, limit):
+        best = heapq.nsmallest(
+            limit, (topic_id for topic_id in topic_ids if topic_id in names),
+            key=lambda topic_id: (-room_counts.get(topic_id, 0), names[topic_id].casefold(), topic_id),
+        )
+        return [{'id': topic_id, 'name': names[topic_id], 'room_count': room_counts.get(topic_id, 0)} for topic_id in best]
+
+    def set_topic(self, topic_id, name):
+        with self.lock:
+            keys = [entry for entry in self.keys if entry[1] != topic_id]
+            for entry in _keys(topic_id, name):
+                bisect.insort(keys, entry)
+            self.keys = keys
+            self.names = {**self.names, topic_id: name}
+            if topic_id not in self.room_counts:
+                self.room_counts = {**self.room_counts, topic_id: 0}
+            self.top = None
+
+    def remove_topic(self, topic_id):
+        with self.lock:
+            self.keys = [entry for entry in self.keys if entry[1] != topic_id]
+            self.names = {key: name for key, name in self.names.items() if key != topic_id}
+            self.room_counts = {key: count for key, count in self.room_counts.items() if key != topic_id}
+            self.top = None
+
+    def add_rooms(self, topic_id, delta):
+        with self.lock:
+            if topic_id in self.room_counts:
+                self.room_counts = {**self.room_counts, topic_id: self.room_counts[topic_id] + delta}
+                self.top = None
+
+    def clear(self):
+        with self.lock:
+            self.keys, self.names, self.room_counts = [], {}, {}
+            self.built = None
+            self.top = None
+
+    def memory_usage(self):
+        """Topics, keys and approximate bytes held (containers, tuples, strings and ints)"""
+        keys, names, room_counts = self.keys, self.names, self.room_counts
+        size = sys.getsizeof(keys) + sys.getsizeof(names) + sys.getsizeof(room_counts)
+        size += sum(sys.getsizeof(entry) + sys.getsizeof(entry[0]) for entry in keys)
+        size += sum(sys.getsizeof(topic_id) + sys.getsizeof(name) for topic_id, name in names.items())
+        size += sum(sys.getsizeof(count) for count in room_counts.values())
+        return {'topics': len(names), 'keys': len(keys), 'bytes': size}
+
+
+index = TopicIndex()
+_build_lock = threading.Lock()
+
+TOPIC_INDEX_KEYS = REGISTRY.gauge(
+    'studybud_topic_index_keys', 'Keys in the topic autocomplete index', callback=lambda: len(index.keys))
+TOPIC_INDEX_BYTES = REGISTRY.gauge(
+    'studybud_topic_index_bytes', 'Approximate memory held by the topic autocomplete index',
+    callback=lambda: index.memory_usage()['bytes'])
+
+
+def get_index():
+    """The process-wide index, (re)built if it is missing or older than TOPIC_INDEX_MAX_AGE"""
+    if index.is_stale():
+        with _build_lock:
+            if index.is_stale():
+                index.build()
+    return index
+
+
+def _apply(method, *args):
+    # Nothing to update before the first build, which reads the committed state
+    if index.built is not None:
+        transaction.on_commit(partial(method, *args))
+
+
+@receiver(post_init, sender=Room, dispatch_uid='topic_index_room_init')
+def remember_room_topic(sender, instance, **kwargs):
+    # __dict__ so a deferred topic_id is not loaded just for this
+    instance._indexed_topic_id = instance.__dict__.get('topic_id')
+
+
+@receiver(post_save, sender=Room, dispatch_uid='topic_index_room_saved')
+def room_saved(sender, instance, created, **kwargs):
+    previous = instance._indexed_topic_id
+    current = instance.__dict__.get('topic_id', previous)
+    if created:
+        previous = None
+    if previous != current:
+        if previous is not None:
+            _apply(index.add_rooms, previous, -1)
+        if current is not None:
+            _apply(index.add_rooms, current, 1)
+    instance._indexed_topic_id = current
+
+
+@receiver(post_delete, sender=Room, dispatch_uid='topic_index_room_deleted')
+def room_deleted(sender, instance, **kwargs):
+    topic_id = instance.__dict__.get('topic_id')
+    if topic_id is not None:
+        _apply(index.add_rooms, topic_id, -1)
+
+
+@receiver(post_save, sender=Topic, dispatch_uid='topic_index_topic_saved')
+def topic_saved(sender, instance, **kwargs):
+    _apply(index.set_topic, instance.id, instance.name)
+
+
+@receiver(post_delete, sender=Topic, dispatch_uid='topic_index_topic_deleted')
+def topic_deleted(sender, instance, **kwargs):
+    _apply(index.remove_topic, instance.id)
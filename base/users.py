@@ -0,0 +1,121 @@
+"""
+Shared cache of serialized user records for API responses.
+
+A record is what UserSerializer renders for one user without a request, so
+avatar URLs are cached as paths and made absolute for each response by
+get_records(request=...). get_records() reads records from the default cache
+with one get_many() and loads every miss with one query, so resolving many
+users costs at most one query no matter how many ids are asked for. Records
+are dropped when a user is saved or deleted; writes that bypass signals
+(QuerySet.update) call forget() themselves.
+
+Without a shared CACHES backend each process has its own copy: the process
+that saved a user forgets its record at once, the others serve theirs until
+USER_CACHE_TIMEOUT runs out.
+
+UserLoader merges the lookups made while serializing one response: ids are
+queued with want() as soon as they are known and the first load() resolves
+all of them together, so a room's host and message authors cost one lookup.
+"""
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+User = get_user_model()
+
+
+# Fields UserSerializer renders as absolute URLs when it has a request
+URL_FIELDS = ('avatar', 'avatar_small')
+
+
+def record_key(user_id):
+    return f'user-record:v2:{user_id}'
+
+
+def with_absolute_urls(record, request):
+    """A copy of `record` with its URLs made absolute for `request`"""
+    record = dict(record)
+    for field in URL_FIELDS:
+        if record.get(field):
+            record[field] = request.build_absolute_uri(record[field])
+    return record
+
+
+def get_records(user_ids, request=None):
+    """
+    {user_id: record} for the ids that exist, with one query for the uncached
+    ones; URLs are absolute when `request` is given, as UserSerializer renders them
+    """
+    from .api.serializers import UserSerializer
+
+    user_ids = set(user_ids)
+    if not user_ids:
+        return {}
+    cached = cache.get_many([record_key(user_id) for user_id in user_ids])
+    records = {}
+    for user_id in user_ids:
+        record = cached.get(record_key(user_id))
+        if record is not None:
+            records[user_id] = record
+
+    missing = user_ids - records.keys()
+    if missing:
+        loaded = {record['id']: record for record in UserSerializer(User.objects.filter(id__in=missing), many=True).data}
+        cache.set_many({record_key(user_id): record for user_id, record in loaded.items()}, settings.USER_CACHE_TIMEOUT)
+        records.update(loaded)
+    if request is not None:
+        records = {user_id: with_absolute_urls(record, request) for user_id, record in records.items()}
+    return records
+
+
+def forget(user_id):
+    """Drop a user's cached record, now and again once the transaction commits"""
+    # The second delete evicts a record that a concurrent request cached from
+    # the old row before this transaction committed
+    cache.delete(record_key(user_id))
+    transaction.on_commit(lambda: cache.delete(record_key(user_id)))
+
+
+@receiver(post_save, sender=User, dispatch_uid='user_record_saved')
+def user_saved(sender, instance, update_fields=None, **kwargs):
+    # Logging in only touches last_login, which records do not include
+    if update_fields is not None and set(update_fields) <= {'last_login'}:
+        return
+    forget(instance.pk)
+
+
+@receiver(post_delete, sender=User, dispatch_uid='user_record_deleted')
+def user_deleted(sender, instance, **kwargs):
+    forget(instance.pk)
+
+
+class UserLoader:
+    """Batches the user lookups of one response; see the module docstring"""
+
+    def __init__(self, request=None):
+        self.request = request
+        self.records = {}
+        self.pending = set()
+
+    def want(self, user_ids):
+        """Queue ids to be resolved with the next load()"""
+        self.pending.update(user_id for user_id in user_ids if user_id is not None and user_id not in self.records)
+
+    def load(self, user_id):
+        """The record for `user_id`, or None if there is no such user"""
+        if user_id not in self.records:
+            self.pending.add(user_id)
+            pending, self.pending = self.pending, set()
+            found = get_records(pending, self.request)
+            self.records.update({pending_id: found.get(pending_id) for pending_id in pending})
+        return self.records[user_id]
+
+
+def user_loader(context):
+    """The UserLoader shared by every serializer rendering with `context`"""
+    if 'user_loader' not in context:
+        context['user_loader'] = UserLoader(context.get('request'))
+    return context['user_loader']
@@ -0,0 +1,103 @@
+"""
+Worker warm-up.
+
+Work Django and DRF otherwise defer to the first requests: compiling URL
+patterns, populating model metadata, resolving DRF's import-string settings,
+building serializer fields and loading the database backends. Run from
+asgi.py before the worker starts accepting traffic when WARMUP_ON_STARTUP is
+set.
+
+No connection is opened ahead of time: under ASGI each request runs its sync
+view on a thread of its own (Django's ThreadSensitiveContext), so there is no
+thread whose connection a later request would reuse.
+"""
+import logging
+import time
+
+from django.apps import apps
+from django.db import connections
+from django.urls import get_resolver, reverse
+
+logger = logging.getLogger(__name__)
+
+DRF_SETTINGS = (
+    'DEFAULT_AUTHENTICATION_CLASSES', 'DEFAULT_PERMISSION_CLASSES', 'DEFAULT_THROTTLE_CLASSES',
+    'DEFAULT_RENDERER_CLASSES', 'DEFAULT_PARSER_CLASSES', 'DEFAULT_CONTENT_NEGOTIATION_CLASS',
+    'DEFAULT_PAGINATION_CLASS', 'DEFAULT_FILTER_BACKENDS', 'DEFAULT_VERSIONING_CLASS',
+)
+
+
+def _compile(patterns):
+    count = 0
+    for pattern in patterns:
+        # Route regexes are compiled lazily, on first match
+        pattern.pattern.regex
+        count += 1
+        if hasattr(pattern, 'url_patterns'):
+            count += _compile(pattern.url_patterns)
+    return count
+
+
+def compile_urls():
+    from base.routing import websocket_urlpatterns
+
+    resolver = get_resolver()
+    count = _compile(resolver.url_patterns) + _compile(websocket_urlpatterns)
+    # Builds the reverse lookup tables of every namespace
+    reverse('api-rooms')
+    return count
+
+
+def load_models():
+    for model in apps.get_models():
+        model._meta.get_fields()
+        model._meta.related_objects
+    return len(apps.get_models())
+
+
+def build_serializers():
+    from rest_framework.settings import api_settings
+    from rest_framework_simplejwt.settings import api_settings as jwt_settings
+    from base.api.serializers import (
+        FeedItemSerializer, MessageSerializer, RoomDetailSerializer, RoomSerializer, TopicSerializer, UserSerializer,
+    )
+
+    for name in DRF_SETTINGS:
+        getattr(api_settings, name)
+    jwt_settings.AUTH_TOKEN_CLASSES
+    serializers = (
+        UserSerializer, TopicSerializer, MessageSerializer, RoomSerializer, RoomDetailSerializer, FeedItemSerializer,
+    )
+    for serializer_class in serializers:
+        serializer_class().fields
+    return len(serializers)
+
+
+def load_database_backends():
+    """Import every database's backend and driver, without connecting"""
+    for alias in connections:
+        connections[alias].ops
+    return len(connections.all())
+
+
+STEPS = (
+    ('urls', compile_urls),
+    ('models', load_models),
+    ('serializers', build_serializers),
+    ('database', load_database_backends),
+)
+
+
+def warm_up():
+    """Run every warm-up step; returns {step: milliseconds}"""
+    timings = {}
+    for name, step in STEPS:
+        started = time.perf_counter()
+        try:
+            step()
+        except Exception:
+            logger.exception('Warm-up step %s failed', name)
+        timings[name] = round((time.perf_counter() - started) * 1000, 2)
+    logger.info('Warm-up finished in %.1f ms: %s', sum(timings.values()),
+                ' '.join(f'{name}={ms}' for name, ms in timings.items()))
+    return timings
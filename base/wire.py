@@ -0,0 +1,142 @@
+"""
+Chat WebSocket encodings.
+
+JSON text frames are the default. A client that offers the `studybud.bin.v1`
+subprotocol in Sec-WebSocket-Protocol gets binary frames instead: a one-byte
+type tag followed by fixed-width little-endian fields, strings as UTF-8 with a
+u16 length prefix (the last string of a frame runs to its end), and times as
+epoch milliseconds. A short chat message is about a third of the size of its
+JSON form, and every event is several times cheaper to encode and decode
+(see `bench_wire`).
+
+    message (server)  B tag=1, Q message_id, I seq, Q user_id, q created_ms,
+                      H username length, username, body
+    message (client)  B tag=1, Q user_id, body
+    error             B tag=2, B code, I retry_after_ms (0xffffffff if unknown)
+    typing            B tag=3
+"""
+import json
+import struct
+from datetime import datetime
+
+BINARY_SUBPROTOCOL = 'studybud.bin.v1'
+
+MESSAGE, ERROR, TYPING = 1, 2, 3
+TYPES = {MESSAGE: 'message', ERROR: 'error', TYPING: 'typing'}
+TAGS = {name: tag for tag, name in TYPES.items()}
+# Append only: clients map the index back to the code
+ERROR_CODES = ('frame_too_large', 'connection_rate', 'user_rate', 'malformed', 'message_too_long')
+NO_RETRY = 0xffffffff
+
+_SERVER_MESSAGE = struct.Struct('<BQIQqH')
+_CLIENT_MESSAGE = struct.Struct('<BQ')
+_ERROR = struct.Struct('<BBI')
+
+
+def epoch_ms(value):
+    """Epoch milliseconds of a datetime or ISO 8601 string"""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return int(value.timestamp() * 1000)
+
+
+class JsonCodec:
+    subprotocol = None
+
+    def decode(self, frame):
+        return json.loads(frame)
+
+    def encode_message(self, event):
+        return json.dumps({
+            'type': 'message',
+            'message': event['message'],
+            'user_id': event['user_id'],
+            'username': event['username'],
+            'created': event['created'],
+            'message_id': event['message_id'],
+            'seq': event.get('seq'),
+            'room': event.get('room')
+        })
+
+    def encode_error(self, code, retry_after=None):
+        return json.dumps({
+            'type': 'error',
+            'code': code,
+            'retry_after': round(retry_after, 3) if retry_after is not None else None
+        })
+
+    def decode_server(self, frame):
+        return json.loads(frame)
+
+    def encode_client(self, payload):
+        return json.dumps(payload)
+
+
+class BinaryCodec:
+    subprotocol = BINARY_SUBPROTOCOL
+
+    def decode(self, frame):
+        """Client frame to the dict the JSON codec would produce; ValueError if malformed"""
+        if isinstance(frame, str):
+            raise ValueError('Text frame on a binary connection')
+        try:
+            tag = frame[0]
+            if tag == MESSAGE:
+                _, user_id = _CLIENT_MESSAGE.unpack_from(frame)
+                return {'type': 'message', 'user_id': user_id, 'message': frame[_CLIENT_MESSAGE.size:].decode('utf8')}
+        except (IndexError, struct.error) as exc:
+            raise ValueError(f'Truncated frame: {exc}')
+        if tag not in TYPES:
+            raise ValueError(f'Unknown type tag {tag}')
+        return {'type': TYPES[tag]}
+
+    def encode_message(self, event):
+        created_ms = event.get('created_ms')
+        username = event['username'].encode('utf8')
+        return _SERVER_MESSAGE.pack(
+            MESSAGE, event['message_id'], event.get('seq') or 0, event['user_id'],
+            created_ms if created_ms is not None else epoch_ms(event['created']), len(username),
+        ) + username + event['message'].encode('utf8')
+
+    def encode_error(self, code, retry_after=None):
+        retry_after_ms = NO_RETRY if retry_after is None else min(int(retry_after * 1000), NO_RETRY - 1)
+        return _ERROR.pack(ERROR, ERROR_CODES.index(code), retry_after_ms)
+
+    def decode_server(self, frame):
+        """Server frame to a dict; used by tests and benchmarks in place of a client"""
+        tag = frame[0]
+        if tag == MESSAGE:
+            _, message_id, seq, user_id, created_ms, length = _SERVER_MESSAGE.unpack_from(frame)
+            start = _SERVER_MESSAGE.size
+            return {
+                'type': 'message', 'message_id': message_id, 'seq': seq, 'user_id': user_id,
+                'created_ms': created_ms, 'username': frame[start:start + length].decode('utf8'),
+                'message': frame[start + length:].decode('utf8'),
+            }
+        if tag == ERROR:
+            _, code, retry_after_ms = _ERROR.unpack(frame)
+            return {
+                'type': 'error', 'code': ERROR_CODES[code],
+                'retry_after': None if retry_after_ms == NO_RETRY else retry_after_ms / 1000,
+            }
+        return {'type': TYPES[tag]}
+
+    def encode_client(self, payload):
+        """Client payload dict to a frame; the inverse of decode()"""
+        tag = TAGS[payload.get('type', 'message')]
+        if tag == MESSAGE:
+            return _CLIENT_MESSAGE.pack(MESSAGE, payload['user_id']) + payload['message'].encode('utf8')
+        return bytes([tag])
+
+
+JSON = JsonCodec()
+BINARY = BinaryCodec()
+CODECS = (BINARY, JSON)
+
+
+def negotiate(offered):
+    """The codec for the subprotocols a client offered, JSON if none match"""
+    for codec in CODECS:
+        if codec.subprotocol in offered:
+            return codec
+    return JSON
@@ -3,7 +3,7 @@
 import { useEffect, useState } from 'react'
 import { useRouter } from 'next/navigation'
 import ProtectedRoute from '@/components/ProtectedRoute'
-import { roomService, Room, Topic } from '@/services/roomService'
+import { applyRoomDeltas, roomService, Room, Topic } from '@/services/roomService'
 import { authService } from '@/lib/auth'
 
 export default function DashboardPage() {
@@ -22,12 +22,18 @@ export default function DashboardPage() {
     loadData()
   }, [searchTerm, selectedTopic])
 
+  // Keep the loaded list current without polling; only new rooms need a refetch to place them
+  useEffect(() => {
+    const websocket = roomService.subscribeRooms((events) => {
+      setRooms((prev) => applyRoomDeltas(prev, events))
+      if (events.some((event) => event.op === 'created')) loadData()
+    })
+    return () => websocket.close()
+  }, [searchTerm, selectedTopic])
+
   const loadData = async () => {
     try {
-      const [roomsData, topicsData] = await Promise.all([
-        roomService.getRooms(searchTerm, selectedTopic),
-        roomService.getTopics(),
-      ])
+      const { rooms: roomsData, topics: topicsData } = await roomService.getDashboard(searchTerm, selectedTopic)
       setRooms(roomsData)
       setTopics(topicsData)
     } catch (error) {
@@ -44,10 +44,9 @@ export default function RoomPage() {
 
   const loadRoom = async () => {
     try {
-      const roomData = await roomService.getRoom(roomId)
+      const { room: roomData, messages: messagesData } = await roomService.getRoomWithMessages(roomId)
       setRoom(roomData)
       
-      const messagesData = await roomService.getMessages(roomId)
       setMessages(
         messagesData.map((msg) => ({
           id: msg.id,
@@ -85,6 +84,9 @@ export default function RoomPage() {
             created: data.created,
           },
         ])
+      } else if (data.type === 'error') {
+        // Sent when a frame broke the server's size or rate limits; it was not delivered
+        console.warn('WebSocket message rejected:', data.code, data.retry_after)
       }
     }
 
@@ -93,9 +95,13 @@ export default function RoomPage() {
       setConnected(false)
     }
 
-    websocket.onclose = () => {
+    websocket.onclose = (event) => {
       console.log('WebSocket disconnected')
       setConnected(false)
+      if (event.code === 4009) {
+        // Closed by the server's idle timeout (WS_IDLE_TIMEOUT); reconnect when the user is back
+        window.addEventListener('focus', connectWebSocket, { once: true })
+      }
     }
 
     setWs(websocket)
@@ -0,0 +1,65 @@
+// One WebSocket for every room the user is watching (ws/chat/ on the server)
+
+export interface ChatEvent {
+  type: 'message'
+  room: number
+  message: string
+  user_id: number
+  username: string
+  created: string
+  message_id: number
+  seq: number | null
+}
+
+type Handler = (event: ChatEvent) => void
+
+export class ChatSocket {
+  private websocket: WebSocket
+  private handlers = new Map<number, Handler>()
+  private queue: string[] = []
+
+  constructor(url = 'ws://localhost:8000/ws/chat/') {
+    const token = localStorage.getItem('access_token')
+    this.websocket = new WebSocket(`${url}?token=${encodeURIComponent(token ?? '')}`)
+    this.websocket.onopen = () => {
+      this.queue.forEach((frame) => this.websocket.send(frame))
+      this.queue = []
+    }
+    this.websocket.onmessage = (event) => {
+      const data = JSON.parse(event.data)
+      if (data.type === 'message') {
+        this.handlers.get(data.room)?.(data)
+      } else if (data.type === 'error') {
+        // not_a_member, not_subscribed, too_many_subscriptions or a frame limit
+        console.warn('Chat socket error:', data.code, data.room ?? data.retry_after)
+      }
+    }
+  }
+
+  subscribe(room: number, handler: Handler) {
+    this.handlers.set(room, handler)
+    this.sendFrame({ type: 'subscribe', room })
+  }
+
+  unsubscribe(room: number) {
+    this.handlers.delete(room)
+    this.sendFrame({ type: 'unsubscribe', room })
+  }
+
+  send(room: number, message: string) {
+    this.sendFrame({ type: 'message', room, message })
+  }
+
+  close() {
+    this.websocket.close()
+  }
+
+  private sendFrame(payload: object) {
+    const frame = JSON.stringify(payload)
+    if (this.websocket.readyState === WebSocket.OPEN) {
+      this.websocket.send(frame)
+    } else {
+      this.queue.push(frame)
+    }
+  }
+}
@@ -1,4 +1,5 @@
 import api from '@/lib/api'
+import { User } from '@/lib/auth'
 
 export interface Topic {
   id: number
@@ -16,9 +17,10 @@ export interface Room {
     email: string
   }
   topic: Topic | null
-  participants: any[]
+  participant_preview: User[]
   message_count: number
   participant_count: number
+  last_seq: number
   created: string
   updated: string
 }
@@ -32,11 +34,116 @@ export interface Message {
   }
   room: number
   body: string
+  seq: number
   created: string
   updated: string
 }
 
+export interface FeedItem {
+  message_id: number
+  room: number
+  room_name: string
+  user: {
+    id: number
+    username: string
+    avatar_small: string | null
+  }
+  body: string
+  created: string
+}
+
+export interface HistoryPage {
+  next: string | null
+  results: Message[]
+}
+
+export interface ParticipantPage {
+  count: number
+  next: string | null
+  previous: string | null
+  results: User[]
+}
+
+export interface UserLookup {
+  users: Record<string, User>
+  missing: number[]
+}
+
+export interface UnreadCount {
+  room: number
+  last_seq: number
+  last_read_seq: number
+  unread: number
+}
+
+export interface FeedPage {
+  next: string | null
+  results: FeedItem[]
+}
+
+// Changes pushed by ws/rooms/; created/updated carry the room's name, topic and host id
+export type RoomDelta =
+  | { op: 'created' | 'updated'; id: number; name: string; topic: Topic | null; host: number; participant_count?: number; message_count?: number }
+  | { op: 'counts'; id: number; participant_count: number; message_count: number }
+  | { op: 'deleted'; id: number }
+
+export interface BatchRequest {
+  method?: 'GET' | 'POST' | 'PUT' | 'PATCH' | 'DELETE'
+  path: string
+  body?: unknown
+}
+
+export interface BatchResponse<T = any> {
+  status: number
+  body: T
+}
+
+const unpaginate = (data: any) => data.results || data
+
+// Applies one frame of room list deltas; created rooms are left to `onCreated` since they lack host and previews
+export const applyRoomDeltas = (rooms: Room[], events: RoomDelta[]): Room[] => {
+  const byId = new Map(events.map((event) => [event.id, event]))
+  return rooms.flatMap((room) => {
+    const event = byId.get(room.id)
+    if (!event) return [room]
+    if (event.op === 'deleted') return []
+    if (event.op === 'counts') return [{ ...room, participant_count: event.participant_count, message_count: event.message_count }]
+    return [{ ...room, name: event.name, topic: event.topic, ...(event.participant_count !== undefined && { participant_count: event.participant_count }) }]
+  })
+}
+
 export const roomService = {
+  // Paths are relative to /api, e.g. '/v1/rooms/'
+  async batch(requests: BatchRequest[]): Promise<BatchResponse[]> {
+    const response = await api.post('/v1/batch/', {
+      requests: requests.map((request) => ({ ...request, path: `/api${request.path}` })),
+    })
+    return response.data.responses
+  },
+
+  async getDashboard(search?: string, topic?: string): Promise<{ rooms: Room[]; topics: Topic[] }> {
+    const params = new URLSearchParams()
+    if (search) params.append('q', search)
+    if (topic) params.append('topic', topic)
+
+    const [rooms, topics] = await roomService.batch([
+      { path: `/v1/rooms/?${params.toString()}` },
+      { path: '/v1/topics/' },
+    ])
+    if (rooms.status >= 400 || topics.status >= 400) throw new Error('Failed to load dashboard')
+    return { rooms: unpaginate(rooms.body), topics: unpaginate(topics.body) }
+  },
+
+  async getRoomWithMessages(id: number): Promise<{ room: Room; messages: Message[] }> {
+    const [room, messages] = await roomService.batch([
+      { path: `/v1/rooms/${id}/` },
+      { path: `/v1/messages/?room=${id}` },
+    ])
+    if (room.status >= 400 || messages.status >= 400) throw new Error('Failed to load room')
+    return { room: room.body, messages: unpaginate(messages.body) }
+  },
+
+
   async getRooms(search?: string, topic?: string): Promise<Room[]> {
     const params = new URLSearchParams()
     if (search) params.append('q', search)
@@ -74,12 +181,29 @@ export const roomService = {
     await api.post(`/v1/rooms/${id}/leave/`)
   },
 
+  // One frame per ROOM_LIST_WINDOW at most; pass a topic id to hear about that topic's rooms only
+  subscribeRooms(onEvents: (events: RoomDelta[]) => void, topicId?: number): WebSocket {
+    const query = topicId !== undefined ? `?topic=${topicId}` : ''
+    const websocket = new WebSocket(`ws://localhost:8000/ws/rooms/${query}`)
+    websocket.onmessage = (event) => {
+      const data = JSON.parse(event.data)
+      if (data.type === 'rooms') onEvents(data.events)
+    }
+    return websocket
+  },
+
   async getTopics(): Promise<Topic[]> {
     const response = await api.get('/v1/topics/')
     // Handle paginated response
     return response.data.results || response.data
   },
 
+  async autocompleteTopics(q: string, limit = 10): Promise<Topic[]> {
+    const params = new URLSearchParams({ q, limit: String(limit) })
+    const response = await api.get(`/v1/topics/autocomplete/?${params.toString()}`)
+    return response.data.results
+  },
+
   async createTopic(name: string): Promise<Topic> {
     const response = await api.post('/v1/topics/', { name })
     return response.data
@@ -95,4 +219,40 @@ export const roomService = {
     const response = await api.post('/v1/messages/', { room: roomId, body })
     return response.data
   },
+
+  async getFeed(before?: number): Promise<FeedPage> {
+    const params = new URLSearchParams()
+    if (before) params.append('before', String(before))
+
+    const response = await api.get(`/v1/feed/?${params.toString()}`)
+    return response.data
+  },
+
+  async getHistory(roomId: number, before?: number): Promise<HistoryPage> {
+    const params = new URLSearchParams()
+    if (before) params.append('before', String(before))
+
+    const response = await api.get(`/v1/rooms/${roomId}/history/?${params.toString()}`)
+    return response.data
+  },
+
+  async getParticipants(roomId: number, page = 1): Promise<ParticipantPage> {
+    const response = await api.get(`/v1/rooms/${roomId}/participants/?page=${page}`)
+    return response.data
+  },
+
+  async getUsers(ids: number[]): Promise<UserLookup> {
+    const response = await api.get(`/v1/users/?ids=${ids.join(',')}`)
+    return response.data
+  },
+
+  async getUnreadCounts(): Promise<UnreadCount[]> {
+    const response = await api.get('/v1/rooms/unread/')
+    return response.data.rooms
+  },
+
+  async markRead(rooms: number[] | Record<number, number>): Promise<Record<string, number>> {
+    const response = await api.post('/v1/rooms/read/', { rooms })
+    return response.data.rooms
+  },
 }